@@ -1,7 +1,20 @@
 import awkward as ak, numpy as np
+import json
 from pocket_coffea.lib.cut_definition import Cut
+from pocket_coffea.lib.categorization import StandardSelection, MaskStorage
 from pocket_coffea.parameters.cuts import passthrough
 
+def reads(*fields):
+    '''
+    Declare the event fields a cut function reads, as names or functions of the cut params returning
+    names, so that the workflows compute the event features the cuts need (features.cut_fields).
+    '''
+    def declare(function):
+        function.fields = fields
+        return function
+    return declare
+
+@reads("LeptonGood", "ll", "nElectronGood", "nMuonGood")
 def diLepton(events, params, year, sample, **kwargs):
 
     # Masks for same-flavor (SF) and opposite-sign (OS)
@@ -21,18 +34,22 @@ def diLepton(events, params, year, sample, **kwargs):
     # Pad None values with False
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("nMuonGood")
 def TwoMuons(events, **kwargs):
     mask = (events.nMuonGood >= 2)
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("nElectronGood")
 def TwoElectrons(events, **kwargs):
     mask = (events.nElectronGood >= 2)
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("nJetGood")
 def NJets(events, params, **kwargs):
     mask = (events.nJetGood >= params['nj'])
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("ll", "nElectronGood", "nJetGood", "nLeptonGood", "nMuonGood")
 def TwoLepTwoJets(events, params, **kwargs):
     if params["lep_flav"] not in ['mu','el','both']:
         print("This lepton flavor is not supported:", params["lep_flav"])
@@ -49,6 +66,7 @@ def TwoLepTwoJets(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("ll", "nElectronGood", "nJetGood", "nLeptonGood", "nMuonGood")
 def AntiZFourJets(events, params, **kwargs):
     # This mask is used for TTbar CR
     if params["lep_flav"] not in ['mu','el','both']:
@@ -65,6 +83,7 @@ def AntiZFourJets(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("LeptonGood", "PuppiMET", "nLeptonGood")
 def OneLeptonPlusMet(events, params, **kwargs):
     #mask = (events.nLeptonGood == 1 )
     mask = ( (events.nLeptonGood == 1 )
@@ -73,6 +92,7 @@ def OneLeptonPlusMet(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("LeptonGood", "PuppiMET", "nJetGood", "nLeptonGood")
 def LepMetTwoJets(events, params, **kwargs):
     mask = ( (events.nLeptonGood == 1 )
              & (ak.firsts(events.LeptonGood.pt) > params["pt_lep"])
@@ -81,6 +101,7 @@ def LepMetTwoJets(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("JetGood", "PuppiMET", "nJetGood", "nLeptonGood")
 def MetTwoJetsNoLep(events, params, **kwargs):    
     mask = ( (events.nLeptonGood == 0 )
              & (events.PuppiMET.pt > params["pt_met"])
@@ -90,6 +111,7 @@ def MetTwoJetsNoLep(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("LeptonGood", "PuppiMET", "nElectronGood", "nJetGood", "nMuonGood")
 def WLNuTwoJets(events, params, **kwargs):
     if params["lep_flav"] not in ['mu','el','both']:
         print("This lepton flavor is not supported:", params["lep_flav"])
@@ -114,6 +136,7 @@ def WLNuTwoJets(events, params, **kwargs):
         )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("JetsCvsL")
 def jettag(events, params, **kwargs):
     if params['tagger'] == "PNet":
         CvL = "btagPNetCvL"
@@ -143,6 +166,7 @@ def jettag(events, params, **kwargs):
     
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("dijet_bsort", lambda params: [f"btag_cut_{params['btag_cut']}"])
 def bjettag(events, params, **kwargs):
     if params['tagger'] == "PNet":
         BvL = "btagPNetB"
@@ -173,6 +197,7 @@ def bjettag(events, params, **kwargs):
     
     return ak.where(ak.is_none(mask), False, mask)
   
+@reads("pt_miss")
 def METpTCut(events, params, **kwargs):
     if params["invert"]:
         mask = (events.pt_miss < params["pt_met"])
@@ -181,6 +206,7 @@ def METpTCut(events, params, **kwargs):
       
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("dijet", "dijet_csort", "nJetGood")
 def DiJetPtCut(events, params, **kwargs):
     mask = (  (events.nJetGood >= 2)
               & (events.dijet.pt > params["pt_dijet"])
@@ -188,6 +214,7 @@ def DiJetPtCut(events, params, **kwargs):
             )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("dijet_bsort", "nJetGood")
 def DiBJetPtCut(events, params, **kwargs):
     if params["dijet"]:
         mask = (  (events.nJetGood >= 2)
@@ -201,6 +228,7 @@ def DiBJetPtCut(events, params, **kwargs):
             
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("dijet_csort", "nJetGood")
 def DiJetMassCut(events, params, **kwargs):
 
     if params["invert"]:
@@ -215,6 +243,7 @@ def DiJetMassCut(events, params, **kwargs):
                 )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("dijet_bsort", "nJetGood")
 def DiBJetMassCut(events, params, **kwargs):
 
     if params["invert"]:
@@ -229,6 +258,7 @@ def DiBJetMassCut(events, params, **kwargs):
                 )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("dijet_bsort", "nJetGood")
 def BJetMassCut(events, params, **kwargs):
     mask = (  (events.nJetGood >= 2)          
             & (events.dijet_bsort.j1mass >= params["mass_b1_min"])
@@ -238,6 +268,7 @@ def BJetMassCut(events, params, **kwargs):
     )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("dijet_bsort", "nJetGood")
 def HbbPtCut(events, params, **kwargs):
     
     mask = ( (events.nJetGood >= 2)
@@ -246,41 +277,50 @@ def HbbPtCut(events, params, **kwargs):
     )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("dijet_bsort", "nJetGood")
 def DiBJetDeltaEtaCut(events, params, **kwargs):
     mask = ( (events.nJetGood >= 2) & (events.dijet_bsort.deltaEta < params["bb_deta"]) )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("VHbb_deltaPhi")
 def DeltaPhiVHCut(events, params, **kwargs):
     mask = ( events.VHbb_deltaPhi > params["VHdPhi"] )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("VHbb_deltaR")
 def DeltaRVHCut(events, params, **kwargs):
     mask = ( events.VHbb_deltaR < params["VHdR"] )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("VHbb_deltaEta")
 def DeltaEtaVHCut(events, params, **kwargs):
     mask = ( events.VHbb_deltaEta < params["VHdEta"] )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("VHbb_pt_ratio")
 def HVpTRatioCut(events, params, **kwargs):
     mask = ( (events.VHbb_pt_ratio >= params["HVpTRatio_min"]) 
          & (events.VHbb_pt_ratio <= params["HVpTRatio_max"])
          )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("deltaPhi_l1_MET")
 def LepMetDeltaPhi(events, params, **kwargs):
     mask = ( events.deltaPhi_l1_MET <= params["lepmetdphi"] )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("NaL")
 def AddLepCut(events, params, **kwargs):
     mask = ( events.NaL == params["add_lep"] )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("NaJ")
 def AddJetCut(events, params, **kwargs):
     if params["equal"]: mask = ( events.NaJ == params["add_jet"] )
     else: mask = ( events.NaJ <= params["add_jet"] )
     return ak.where(ak.is_none(mask), False, mask)
 
+@reads("ll")
 def DiLeptonMassCut(events, params, **kwargs):
     if params["invert"]:
         mask = (  (events.ll.mass < params["mll"]["low"]) | (events.ll.mass > params["mll"]["high"]) )
@@ -289,11 +329,13 @@ def DiLeptonMassCut(events, params, **kwargs):
         mask = (  (events.ll.mass >= params["mll"]["low"]) & (events.ll.mass <= params["mll"]["high"]) )
         return ak.where(ak.is_none(mask), False, mask)
     
+@reads("ll")
 def DiLeptonPtCut(events, params, **kwargs):
     mask = (  (events.ll.pt > params["ptll"]["low"]) & (events.ll.pt < params["ptll"]["high"]) )
     return ak.where(ak.is_none(mask), False, mask)
 
 
+@reads("deltaPhi_jet1_MET", "deltaPhi_jet2_MET")
 def DeltaPhiJetMetCut(events, params, **kwargs):
     mask = ( (events['deltaPhi_jet1_MET'] > params["jet_met_dphi_cut"])
              & (events['deltaPhi_jet2_MET'] > params["jet_met_dphi_cut"])
@@ -301,6 +343,7 @@ def DeltaPhiJetMetCut(events, params, **kwargs):
     return ak.where(ak.is_none(mask), False, mask)
 
 
+@reads("GenJet", "GenPart")
 def TrueJetFlavors(events, params, **kwargs):
     gen_jets = events.GenJet
     gen_parts = events.GenPart
@@ -547,6 +590,7 @@ def ZNNHBB_2J():
     )
 
 # Common Selectors for the 0L channel
+@reads("MET_used", "NaL", "VHbb_deltaPhi", "VHbb_pt_ratio", "dijet_bsort", "nJetGood")
 def ZNuNuHBB_Common_Selectors(events, params, **kwargs):
     
     two_J = (events.nJetGood >= 2)
@@ -612,6 +656,7 @@ def bJ_pt_cut(b1_pt = 60, b2_pt = 35):
 
 import numpy as np
 
+@reads("deltaPhi_jet1_MET", "deltaPhi_jet2_MET")
 def min_dPhi_bJ_MET(events, params, **kwargs):
     mask = ( np.minimum(events.deltaPhi_jet1_MET, events.deltaPhi_jet2_MET) <= params["max_min_dPhi"] )
     return ak.where(ak.is_none(mask), False, mask)
@@ -665,6 +710,7 @@ def WLNuHBB_2J(lep_flav='both', pt_w=0):
     )
 
 # Common selectors for the SL channel
+@reads("NaL", "VHbb_deltaEta", "VHbb_deltaPhi", "VHbb_pt_ratio", "W_pt", "dijet_bsort", "nElectronGood", "nJetGood", "nLeptonGood", "nMuonGood", "pt_miss")
 def WLNuHBB_Common_Selectors(events, params, **kwargs):
     two_J = (events.nJetGood >= 2)
     
@@ -804,6 +850,7 @@ def ZLLHBB_2J(lep_flav='both'):
     )
 
 # VHbb DiLepton channel common selections
+@reads("NaL", "VHbb_deltaPhi", "VHbb_deltaR", "VHbb_pt_ratio", "dijet_bsort", "ll", "nElectronGood", "nJetGood", "nLeptonGood", "nMuonGood", "pt_miss")
 def ZLLHBB_Common_Selectors(events, params, **kwargs):
     if params["lep_flav"] not in ['mu','el','both']:
         print("This lepton flavor is not supported:", params["lep_flav"])
@@ -1029,6 +1076,7 @@ def ll_antiZ_4j(lep_flav='both'):
     )
 
 # 
+@reads("Hcc_flag")
 def Hcc_flag_func(events, params, **kwargs):
     if params["invert"]: mask = ( events.Hcc_flag < 1 )
     else: mask = ( events.Hcc_flag > 0 )
@@ -1043,3 +1091,119 @@ def Hcc_flag( invert = False ):
         }
     )
 
+
+# Memoized evaluation of the category and subsample cuts
+def popcount(words):
+    '''Number of set bits of each uint64 word (np.bitwise_count with NumPy >= 2).'''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    words = words - ((words >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    words = (words & np.uint64(0x3333333333333333)) + ((words >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    words = (words + (words >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (words * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+class CutCache():
+    '''
+    Masks of the Cuts of one chunk and variation, by (function, collection, parameters): each distinct
+    cut is evaluated once, whatever its name and the number of categories and subsamples using it.
+    reset must be called when the events change (new chunk or variation). evaluated and reused count
+    the cuts evaluated and taken from the cache since the last reset.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.masks = {}
+        self.evaluated = 0
+        self.reused = 0
+
+    def get_mask(self, cut, events, processor_params, **kwargs):
+        key = (cut.function, cut.collection, json.dumps(cut.params, sort_keys=True))
+        if key in self.masks:
+            self.reused += 1
+        else:
+            self.masks[key] = cut.get_mask(events, processor_params, **kwargs)
+            self.evaluated += 1
+        return self.masks[key]
+
+class MemoizedSelection(StandardSelection):
+    '''
+    StandardSelection reading the masks of its cuts from a CutCache, which can be shared by several selections.
+
+    prepare encodes the categories of each event as a bitset (membership: one uint64 word per 64
+    categories and event, bit i of word i//64 for the i-th category) and drops the masks of the cuts.
+    get_mask decodes the boolean mask of a category from its bit, as pocket_coffea expects (the
+    histograms, columns and weights use these masks), any_of gives the events in any of several
+    categories from one AND over the words and count the events of a category by popcount of the
+    words. Selections with cuts on a collection (multidim) keep the masks of StandardSelection.
+    '''
+    def __init__(self, categories, cache=None):
+        super().__init__(categories)
+        self.cache = cache if cache is not None else CutCache()
+        self.category_bits = {category: divmod(i, 64) for i, category in enumerate(self.categories)}
+        self.membership = None
+
+    @classmethod
+    def from_selection(cls, selection, cache=None):
+        '''MemoizedSelection with the categories of a StandardSelection; other selections are returned as they are.'''
+        if type(selection) is not StandardSelection:
+            return selection
+        return cls({category: [selection.cut_dict[id] for id in ids] for category, ids in selection.categories.items()}, cache)
+
+    def prepare(self, events, processor_params, **kwargs):
+        # As StandardSelection.prepare, with the masks from the cache
+        if self.is_multidim:
+            dim = 2
+            if f"n{self.multidim_collection}" in events.fields:
+                counts = events[f"n{self.multidim_collection}"]
+            else:
+                counts = ak.num(events[self.multidim_collection])
+        else:
+            counts = None
+            dim = 1
+        self.storage = MaskStorage(dim=dim, counts=counts)
+        for cut in self.cut_functions:
+            self.storage.add(cut.id, self.cache.get_mask(cut, events, processor_params, **kwargs))
+        self.ready = True
+
+        self.membership = None
+        if self.is_multidim:
+            return
+        membership = np.zeros((len(events), (len(self.categories) + 63)//64), dtype=np.uint64)
+        for category, (word, bit) in self.category_bits.items():
+            mask = np.asarray(self.storage.all(self.categories[category]), dtype=np.uint64)
+            membership[:, word] |= mask << np.uint64(bit)
+        # The masks of the cuts are not needed anymore
+        self.storage = None
+        self.membership = membership
+
+    def get_mask(self, category):
+        if self.membership is None:
+            return super().get_mask(category)
+        word, bit = self.category_bits[category]
+        return ((self.membership[:, word] >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+
+    def any_of(self, categories):
+        '''Mask of the events in any of the categories.'''
+        if self.membership is None:
+            mask = np.zeros(len(self.get_mask(next(iter(self.categories)))), dtype=bool)
+            for category in categories:
+                mask |= np.asarray(self.get_mask(category))
+            return mask
+        pattern = np.zeros(self.membership.shape[1], dtype=np.uint64)
+        for category in categories:
+            word, bit = self.category_bits[category]
+            pattern[word] |= np.uint64(1) << np.uint64(bit)
+        return (self.membership & pattern).any(axis=1)
+
+    def count(self, category, other=None, other_category=None):
+        '''
+        Number of events in the category, and in other_category of the MemoizedSelection other if given
+        (e.g. a subsample): popcount of the bitset words, without decoding the masks.
+        '''
+        word, bit = self.category_bits[category]
+        words = self.membership[:, word] & (np.uint64(1) << np.uint64(bit))
+        if other is not None:
+            other_word, other_bit = other.category_bits[other_category]
+            words &= ((other.membership[:, other_word] >> np.uint64(other_bit)) & np.uint64(1)) << np.uint64(bit)
+        return int(popcount(words).sum())
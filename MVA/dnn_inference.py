@@ -0,0 +1,156 @@
+import json
+import numpy as np
+
+_ACTIVATIONS = ("linear", "relu", "leaky_relu", "sigmoid", "tanh", "softmax")
+
+def _activate(x, activation, alpha):
+    # In place on the float32 batch buffer
+    if activation == "linear":
+        return x
+    if activation == "relu":
+        return np.maximum(x, 0, out=x)
+    if activation == "leaky_relu":
+        return np.where(x > 0, x, alpha*x).astype(x.dtype, copy=False)
+    if activation == "sigmoid":
+        with np.errstate(over="ignore"):
+            np.negative(x, out=x)
+            np.exp(x, out=x)
+            x += 1
+            return np.reciprocal(x, out=x)
+    if activation == "tanh":
+        return np.tanh(x, out=x)
+    if activation == "softmax":
+        x -= x.max(axis=1, keepdims=True)
+        np.exp(x, out=x)
+        x /= x.sum(axis=1, keepdims=True)
+        return x
+    raise NotImplementedError(f"Unsupported activation: {activation}")
+
+def _find_weights(group, layer_name):
+    # Keras 3 nests the weights as <layer>/<model>/<layer>/<weight>, Keras 2 as <layer>/<layer>/<weight>:0
+    weights = {}
+    def visit(name, obj):
+        if hasattr(obj, "shape"):
+            weights[name.split("/")[-1].split(":")[0]] = np.asarray(obj, dtype=np.float64)
+    group[layer_name].visititems(visit)
+    return weights
+
+class DenseNetwork():
+    '''
+    Pure NumPy version of the sequential Keras DNNs trained with training_lgbm_dnn.py.
+
+    Batch normalisation layers are folded into the preceding Dense layer, so inference is one
+    matmul, bias and activation per layer, evaluated on large float32 batches.
+    '''
+    def __init__(self, weights, biases, activations, alphas):
+        self.weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+        self.activations = list(activations)
+        self.alphas = [float(a) for a in alphas]
+
+    @classmethod
+    def from_h5(cls, model_file):
+        import h5py
+
+        weights, biases, activations, alphas = [], [], [], []
+        with h5py.File(model_file, "r") as f:
+            config = json.loads(f.attrs["model_config"])
+            if config["class_name"] != "Sequential":
+                raise NotImplementedError(f"Only Sequential models are supported, got {config['class_name']}")
+            group = f["model_weights"] if "model_weights" in f else f
+
+            for layer in config["config"]["layers"]:
+                kind, cfg = layer["class_name"], layer["config"]
+                if kind in ("InputLayer", "Dropout"):
+                    continue
+                if kind == "Dense":
+                    w = _find_weights(group, cfg["name"])
+                    weights.append(w["kernel"])
+                    biases.append(w.get("bias", np.zeros(w["kernel"].shape[1])))
+                    activations.append(cfg.get("activation", "linear"))
+                    alphas.append(0.)
+                elif kind == "BatchNormalization":
+                    w = _find_weights(group, cfg["name"])
+                    scale = w.get("gamma", 1.)/np.sqrt(w["moving_variance"] + cfg.get("epsilon", 1e-3))
+                    shift = w.get("beta", 0.) - w["moving_mean"]*scale
+                    if weights and activations[-1] == "linear":
+                        weights[-1] = weights[-1]*scale
+                        biases[-1] = biases[-1]*scale + shift
+                    else:
+                        weights.append(np.diag(scale))
+                        biases.append(shift)
+                        activations.append("linear")
+                        alphas.append(0.)
+                elif kind in ("LeakyReLU", "ReLU", "Activation"):
+                    if kind == "LeakyReLU":
+                        activation = "leaky_relu"
+                        alpha = cfg.get("negative_slope", cfg.get("alpha", 0.3))
+                    elif kind == "ReLU":
+                        activation, alpha = "relu", 0.
+                    else:
+                        activation, alpha = cfg["activation"], 0.
+                    if not weights or activations[-1] != "linear":
+                        raise NotImplementedError(f"Activation layer {cfg['name']} does not follow a linear layer")
+                    activations[-1] = activation
+                    alphas[-1] = alpha
+                else:
+                    raise NotImplementedError(f"Unsupported layer type: {kind}")
+
+        for activation in activations:
+            if activation not in _ACTIVATIONS:
+                raise NotImplementedError(f"Unsupported activation: {activation}")
+        return cls(weights, biases, activations, alphas)
+
+    @classmethod
+    def from_npz(cls, bundle_file):
+        with np.load(bundle_file) as bundle:
+            layers = json.loads(str(bundle["layers"]))
+            return cls([bundle[f"W{i}"] for i in range(len(layers))],
+                       [bundle[f"b{i}"] for i in range(len(layers))],
+                       [layer["activation"] for layer in layers],
+                       [layer["alpha"] for layer in layers])
+
+    @classmethod
+    def from_file(cls, model_file):
+        if model_file.endswith(".npz"):
+            return cls.from_npz(model_file)
+        return cls.from_h5(model_file)
+
+    def to_arrays(self):
+        '''Weights and layer metadata of the network, see from_arrays and model_store.py.'''
+        arrays = {}
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            arrays[f"W{i}"] = w
+            arrays[f"b{i}"] = b
+        return arrays, {"layers": [{"activation": a, "alpha": alpha} for a, alpha in zip(self.activations, self.alphas)]}
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        layers = meta["layers"]
+        return cls([arrays[f"W{i}"] for i in range(len(layers))],
+                   [arrays[f"b{i}"] for i in range(len(layers))],
+                   [layer["activation"] for layer in layers],
+                   [layer["alpha"] for layer in layers])
+
+    def save(self, bundle_file):
+        arrays, meta = self.to_arrays()
+        np.savez(bundle_file, layers=json.dumps(meta["layers"]), **arrays)
+
+    def num_inputs(self):
+        return self.weights[0].shape[0]
+
+    def predict(self, data, batch_size=65536):
+        '''Scores of shape (n events, n outputs). NaN inputs give NaN scores, as in Keras.'''
+        X = np.asarray(data, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.num_inputs():
+            raise ValueError(f"Expected an array with {self.num_inputs()} columns, got shape {X.shape}")
+
+        out = np.empty((X.shape[0], self.weights[-1].shape[1]), dtype=np.float32)
+        for start in range(0, X.shape[0], batch_size):
+            h = X[start:start + batch_size]
+            for w, b, activation, alpha in zip(self.weights, self.biases, self.activations, self.alphas):
+                h = h @ w
+                h += b
+                h = _activate(h, activation, alpha)
+            out[start:start + batch_size] = h
+        return out
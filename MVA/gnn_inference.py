@@ -0,0 +1,121 @@
+import os, time, warnings
+import numpy as np
+import torch
+
+# Number of padded objects and channel index used by process_gnn_inputs
+NJETS, NLEPS = 6, 2
+CHANNELS = {"ZNuNu": (0, 0), "WLNu": (1, 1), "ZLL": (2, 2)}   # proc_type: (channel, leptons)
+# Argument order of GraphAttentionClassifier.forward, as named by gnn_inputs
+INPUTS = ["jet", "jetP4", "lep", "lepP4", "VP4", "global", "category"]
+# Peak memory of the forward pass per event on CPU (mostly the pairwise attention activations),
+# measured with the Global model (hyperembeddim 48, attention_dim 320)
+BYTES_PER_EVENT = 72*1024
+# Linear layers kept in float by quantize_gnn: they are fed with the raw kinematics (GeV-scale pT,
+# masses and pairwise features) or with the concatenated attention outputs, where the per-batch int8
+# scale of the inputs shifts the scores by up to O(1)
+FLOAT_LAYERS = ["embedjets", "edgejet", "embedjl", "embedjll", "embedjjll", "fc1"]
+
+def example_inputs(nevents, proc_type="ZLL", era=1, seed=0):
+    '''
+    Random GNN inputs with the shapes and zero padding of process_gnn_inputs for one channel,
+    in the argument order of GraphAttentionClassifier.forward.
+    '''
+    gen = torch.Generator().manual_seed(seed)
+    channel, nleps = CHANNELS[proc_type]
+
+    def uniform(low, high, *shape):
+        return low + (high - low)*torch.rand(*shape, generator=gen)
+
+    njets = torch.randint(2, NJETS + 1, (nevents,), generator=gen)
+    jetmask = (torch.arange(NJETS)[None, :] < njets[:, None]).float()[..., None]
+    jet = torch.rand(nevents, NJETS, 2, generator=gen)*jetmask
+    jetp4 = torch.stack([uniform(20, 300, nevents, NJETS), uniform(-2.5, 2.5, nevents, NJETS),
+                         uniform(-torch.pi, torch.pi, nevents, NJETS), uniform(5, 30, nevents, NJETS)], -1)*jetmask
+
+    lepmask = (torch.arange(NLEPS) < nleps).float()[None, :, None]
+    lep = uniform(0, 0.1, nevents, NLEPS, 2)*lepmask
+    lepp4 = torch.stack([uniform(20, 200, nevents, NLEPS), uniform(-2.5, 2.5, nevents, NLEPS),
+                         uniform(-torch.pi, torch.pi, nevents, NLEPS), torch.full((nevents, NLEPS), 0.1)], -1)*lepmask
+
+    vp4 = torch.stack([uniform(50, 400, nevents), uniform(-2.5, 2.5, nevents),
+                       uniform(-torch.pi, torch.pi, nevents), uniform(80, 100, nevents)], -1)
+    glo = torch.stack([uniform(0, 200, nevents), uniform(-torch.pi, torch.pi, nevents),
+                       torch.randint(10, 60, (nevents,), generator=gen).float(),
+                       uniform(0, 150, nevents) if proc_type == "WLNu" else torch.zeros(nevents)], -1)
+    cat = torch.stack([torch.randint(0, 2, (nevents,), generator=gen) if nleps else torch.zeros(nevents, dtype=torch.int64),
+                       torch.full((nevents,), channel), torch.full((nevents,), era)], -1)
+    return jet, jetp4, lep, lepp4, vp4, glo, cat
+
+def export_gnn(model, device="cpu"):
+    '''
+    Frozen and optimized TorchScript version of a GraphAttentionClassifier.
+
+    The model is traced rather than scripted (torch.jit.script does not support its forward).
+    The trace does not depend on the batch size or on the input values, since the number
+    of jets and leptons is fixed by the padding.
+    '''
+    model = model.eval()
+    example = [t.to(device) for t in example_inputs(256)]
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore")     # TracerWarnings about shapes converted to constants
+        traced = torch.jit.trace(model, tuple(example), check_trace=False)
+        frozen = torch.jit.freeze(traced)
+        return torch.jit.optimize_for_inference(frozen)
+
+def quantize_gnn(model, float_layers=None):
+    '''
+    Int8 dynamic quantization of the nn.Linear layers of a GraphAttentionClassifier, except float_layers:
+    the weights are stored in int8 and the inputs are quantized batch by batch. CPU only. The projections
+    inside nn.MultiheadAttention are not quantized by torch and stay in float.
+    '''
+    if float_layers is None:
+        float_layers = FLOAT_LAYERS
+    layers = {name for name, module in model.named_modules()
+              if type(module) is torch.nn.Linear and name not in float_layers}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")     # deprecation warnings of torch.ao.quantization
+        return torch.ao.quantization.quantize_dynamic(model.eval(), layers, dtype=torch.qint8)
+
+def worker_cores():
+    '''
+    Number of cores allocated to this process: OMP_NUM_THREADS if set (HTCondor sets it
+    to request_cpus), otherwise the CPUs the process may run on.
+    '''
+    if os.environ.get("OMP_NUM_THREADS", "").isdigit():
+        return max(1, int(os.environ["OMP_NUM_THREADS"]))
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+def set_threads(num_threads):
+    '''Set the torch intra-op threads: a number, "auto" for the cores of the worker, 0 to keep the default.'''
+    if num_threads == "auto":
+        num_threads = worker_cores()
+    if num_threads > 0 and torch.get_num_threads() != num_threads:
+        torch.set_num_threads(num_threads)
+
+def batch_size_for(memory_mb, bytes_per_event=BYTES_PER_EVENT, min_size=256):
+    '''Largest batch whose forward pass fits in memory_mb.'''
+    return max(min_size, int(memory_mb*1024**2) // bytes_per_event)
+
+def run_batched(model, inputs, batch_size, device="cpu", report=False, names=INPUTS):
+    '''
+    Score of the first class for the NumPy inputs of gnn_inputs (the model arguments names, in order),
+    evaluated in batches. The batches are views of the inputs; torch tensors (the placeholder inputs of
+    the models without leptons) are passed whole to every batch. With report, the batch latencies are printed.
+    '''
+    nevents = len(inputs[names[0]])
+    scores = np.empty(nevents, dtype=np.float32)
+    latencies = []
+    constant = {name: inputs[name].to(device) for name in names if isinstance(inputs[name], torch.Tensor)}
+    with torch.inference_mode():
+        for start in range(0, nevents, batch_size):
+            t0 = time.perf_counter()
+            batch = [constant[name] if name in constant else torch.from_numpy(inputs[name][start:start + batch_size]).to(device)
+                     for name in names]
+            scores[start:start + batch_size] = model(*batch)[:, 0].cpu().numpy()
+            latencies.append(time.perf_counter() - t0)
+    if report and latencies:
+        latencies = np.array(latencies)*1e3
+        print(f"GNN inference: {nevents} events in {len(latencies)} batches of {batch_size} "
+              f"with {torch.get_num_threads()} threads, latency per batch mean {latencies.mean():.1f} ms, "
+              f"max {latencies.max():.1f} ms, {nevents/latencies.sum()*1e3:.0f} events/s")
+    return scores
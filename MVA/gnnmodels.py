@@ -1,16 +1,11 @@
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader, Dataset, random_split, WeightedRandomSampler, Subset
-from alive_progress import alive_bar
 import numpy as np
 import torch.nn.functional as F
 import torch.optim.lr_scheduler as lr_scheduler
 import os, math
-import matplotlib.pyplot as plt
-import mplhep as hep
 from contextlib import nullcontext
-plt.style.use(hep.style.CMS)
-import optuna
 import copy, pickle, gc
 
 def count_parameters(model):
@@ -416,7 +411,13 @@ def getinputs(data,device):
     return jet,jetp4,lep,lepp4,llp4,glo,cat,label,weight
 
 def runGNNtraining(tensordict, y, outdir, test=False, w=None, e=None, weightedsampling=False, trial=None, ngpu=1, cpulist=None, loadmodel=None):
+    # Training-only dependencies, not needed to evaluate the model in the workflows
+    from alive_progress import alive_bar
+    import matplotlib.pyplot as plt
+    import mplhep as hep
+    import optuna
     from training import evaluate_model
+    plt.style.use(hep.style.CMS)
     outhandle = outhandler(outdir)
     outhandle.addcustom("signweighted")
     ncpu=4
@@ -713,6 +714,7 @@ class outhandler():
         return newval
 
 def dumploss(loss,minloss,outfl,lrcurve=None,valloss=None):
+    import matplotlib.pyplot as plt
     plt.clf()
     fig, ax1 = plt.subplots()
     ax1.plot(range(1,len(loss)+1), loss, label="Loss")
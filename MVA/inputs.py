@@ -0,0 +1,140 @@
+import numpy as np
+import awkward as ak
+import pandas as pd
+
+# Names of fields of the event collections, e.g. for the saved columns and the GNN inputs, read from
+# the collection (JetGood_pt is JetGood.pt) instead of being copied into the events
+PROJECTIONS = {
+    **{f"JetGood_{var}": ("JetGood", var) for var in ["btagCvL","btagCvB","pt","eta","phi","mass"]},
+    **{f"LeptonGood_{var}": ("LeptonGood", var) for var in ["miniPFRelIso_all","pfRelIso03_all","pt","eta","phi","mass"]},
+    **{f"ll_{var}": ("ll", var) for var in ["pt","eta","phi","mass"]},
+    "PuppiMET_pt": ("PuppiMET", "pt"),
+    "PuppiMET_phi": ("PuppiMET", "phi"),
+    "nPV": ("PV", "npvsGood"),
+}
+
+def has_field(events, name):
+    return name in events.fields or (name in PROJECTIONS and PROJECTIONS[name][0] in events.fields)
+
+def event_field(events, name):
+    '''The event field name, or the field of a collection it is a projection of (PROJECTIONS).'''
+    if name in events.fields or name not in PROJECTIONS:
+        return events[name]
+    collection, field = PROJECTIONS[name]
+    return events[collection][field]
+
+def feature_matrix(events, fields, dtype=np.float32):
+    '''
+    Contiguous (events x fields) matrix of event-level features, with NaN for the missing values,
+    and the mask of the events with all the features defined.
+
+    Fields with at most one entry per event (e.g. an object picked with argmin(keepdims=True))
+    are taken from their first entry, missing if the event has none.
+    '''
+    X = np.empty((len(events), len(fields)), dtype=dtype)
+    for i, field in enumerate(fields):
+        column = event_field(events, field)
+        if column.ndim > 1:
+            column = ak.firsts(column, axis=1)
+        X[:, i] = ak.to_numpy(ak.fill_none(column, np.nan))
+    return X, ~np.isnan(X).any(axis=1)
+
+def feature_frame(events, fields, dtype=np.float32):
+    '''
+    feature_matrix as a DataFrame with one column per field, for the models that match their inputs
+    by name. The DataFrame is a view of the matrix, nothing is copied.
+    '''
+    X, valid = feature_matrix(events, fields, dtype)
+    return pd.DataFrame(X, columns=list(fields), copy=False), valid
+
+def take_rows(data, rows):
+    '''Rows of data (array, DataFrame or dict of arrays with one row per event) selected by a mask or an index.'''
+    if isinstance(data, dict):
+        return {name: values[rows] for name, values in data.items()}
+    return data[rows]
+
+def evaluate_masked(evaluate, data, mask):
+    '''
+    Evaluate a model on the rows of data selected by mask and return the scores as an option-typed
+    awkward array over all the rows, None where the mask is False.
+    '''
+    scores = np.full(len(mask), np.nan)
+    if mask.any():
+        scores[mask] = evaluate(take_rows(data, mask))
+    return ak.mask(scores, mask)
+
+def evaluate_partitions(data, key, models):
+    '''
+    Evaluate a model split in partitions of the rows (e.g. dilep_pt bins or EventNr parity).
+    key gives the partition of each row of data and models maps each partition to the function
+    scoring its rows. Partitions without rows are not evaluated, rows outside all partitions get NaN.
+    The scores are written into one array, in the original order of the rows.
+    '''
+    out = np.full(len(data), np.nan)
+    for partition, evaluate in models.items():
+        index = np.flatnonzero(key == partition)
+        if len(index):
+            out[index] = evaluate(data.iloc[index] if isinstance(data, pd.DataFrame) else data[index])
+    return out
+
+def partition_key(values, edges=None, modulo=None):
+    '''Partition index of each value: the bin between the edges, or the remainder of the division by modulo.'''
+    values = ak.to_numpy(ak.fill_none(values, np.nan))
+    if modulo is not None:
+        return values % modulo
+    return np.digitize(values, list(edges))
+
+def pad_objects(events, fields, max_objects, out=None, dtype=np.float32):
+    '''
+    Fixed-size (events x max_objects x fields) array of per-object fields (e.g. JetGood_pt): the first
+    max_objects objects of each event, zero-padded. Missing values and fields absent from events are 0.
+
+    The values are scattered from the flat content and the counts of each field, without padding
+    the awkward arrays. out, if given, is a preallocated buffer of the right shape to fill.
+    '''
+    if out is None:
+        out = np.zeros((len(events), max_objects, len(fields)), dtype=dtype)
+    else:
+        out[...] = 0
+    counts, index = None, None
+    for i, field in enumerate(fields):
+        if not has_field(events, field):
+            continue
+        column = event_field(events, field)
+        field_counts = ak.to_numpy(ak.fill_none(ak.num(column, axis=1), 0))
+        if counts is None or not np.array_equal(field_counts, counts):
+            # Event and object index of each object, shared by the fields of the same collection
+            counts = field_counts
+            starts = np.cumsum(counts) - counts
+            objects = np.arange(counts.sum()) - np.repeat(starts, counts)
+            keep = objects < max_objects
+            index = (np.repeat(np.arange(len(counts)), counts)[keep], objects[keep])
+        values = ak.to_numpy(ak.fill_none(ak.flatten(column, axis=1), 0))
+        out[index + (i,)] = values[keep]
+    return out
+
+GNN_JETS = ["JetGood_btagCvL","JetGood_btagCvB",
+            "JetGood_pt","JetGood_eta","JetGood_phi","JetGood_mass"]
+GNN_LEPTONS = ["LeptonGood_miniPFRelIso_all","LeptonGood_pfRelIso03_all",
+               "LeptonGood_pt","LeptonGood_eta","LeptonGood_phi","LeptonGood_mass"]
+GNN_FLAT = ["V_pt","V_eta","V_phi","V_mass",
+            "PuppiMET_pt","PuppiMET_phi","nPV","W_m",
+            "LeptonCategory","channel","era"]
+
+def gnn_inputs(events, njets=6, nleps=2, flat=None):
+    '''
+    Inputs of the GraphAttentionClassifier as NumPy arrays: jets and leptons padded to njets and nleps
+    objects, the V four-vector, the global variables and the categories. Absent lepton fields (0L) are
+    all zeros. flat, if given, is the (events x GNN_FLAT) matrix already extracted from the events.
+    '''
+    if flat is None:
+        flat, _ = feature_matrix(events, GNN_FLAT)
+    return {
+        "jet":      pad_objects(events, GNN_JETS[:2], njets),
+        "jetP4":    pad_objects(events, GNN_JETS[2:], njets),
+        "lep":      pad_objects(events, GNN_LEPTONS[:2], nleps),
+        "lepP4":    pad_objects(events, GNN_LEPTONS[2:], nleps),
+        "VP4":      np.ascontiguousarray(flat[:, :4]),
+        "global":   np.ascontiguousarray(flat[:, 4:8]),
+        "category": flat[:, 8:].astype(np.int64),
+    }
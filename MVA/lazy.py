@@ -0,0 +1,77 @@
+import sys, importlib, importlib.util
+
+class LazyModule():
+    '''
+    Placeholder for a module that is imported on first attribute access.
+
+    The placeholder is what gets cloudpickled with the processor, so neither the client
+    nor the workers import the module until a chunk actually needs it. With by_value=True
+    the source of the module is shipped along, for analysis modules (e.g. MVA.gnnmodels)
+    that are registered with cloudpickle.register_pickle_by_value and are not importable
+    on the workers. A shipped source is always the one executed, so that a worker that can import
+    another version of the module (e.g. an older checkout in its PYTHONPATH) still runs the code of
+    the client; an imported module is only reused if its source is the shipped one.
+    '''
+    def __init__(self, name, by_value=False, source=None, filename=None):
+        self._name = name
+        self._by_value = by_value
+        self._source = source
+        self._filename = filename
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = self._import()
+        return self._module
+
+    def _import(self):
+        module = sys.modules.get(self._name)
+        if self._source is None:
+            return module if module is not None else importlib.import_module(self._name)
+        if module is not None and _source_of(module) == self._source:
+            return module
+        module = importlib.util.module_from_spec(importlib.util.spec_from_loader(self._name, loader=None, origin=self._filename))
+        module.__file__ = self._filename
+        module.__lazy_source__ = self._source
+        previous = sys.modules.get(self._name)
+        sys.modules[self._name] = module
+        try:
+            exec(compile(self._source, self._filename, "exec"), module.__dict__)
+        except BaseException:
+            if previous is None:
+                del sys.modules[self._name]
+            else:
+                sys.modules[self._name] = previous
+            raise
+        return module
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __reduce__(self):
+        source, filename = self._source, self._filename
+        if self._by_value and source is None:
+            filename = importlib.util.find_spec(self._name).origin
+            with open(filename) as f:
+                source = f.read()
+        return (LazyModule, (self._name, self._by_value, source, filename))
+
+    def __repr__(self):
+        state = "loaded" if self._name in sys.modules else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+def _source_of(module):
+    # Source a module was executed from: the shipped one, or the file it was imported from
+    source = getattr(module, "__lazy_source__", None)
+    if source is None:
+        try:
+            with open(module.__file__) as f:
+                source = f.read()
+        except (OSError, TypeError, AttributeError):
+            pass
+    return source
+
+def lazy_import(name, by_value=False):
+    return LazyModule(name, by_value)
@@ -0,0 +1,254 @@
+import numpy as np
+import awkward as ak
+import warnings
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def _lightgbm():
+    # lightgbm, only imported (when installed) on workers without numba
+    try:
+        import lightgbm
+    except ImportError:
+        return None
+    return lightgbm
+
+# Same conventions as LightGBM's NumericalDecision (include/LightGBM/tree.h)
+_CATEGORICAL_MASK = 1
+_DEFAULT_LEFT_MASK = 2
+_MISSING_NONE, _MISSING_ZERO, _MISSING_NAN = 0, 1, 2
+_ZERO_THRESHOLD = 1e-35
+
+def _traverse(X, roots, feature, threshold, decision, left, right, leaf_value, out):
+    # Tree-major loop: the nodes of one tree stay in cache while all events walk it
+    out[:] = 0.
+    for t in range(roots.shape[0]):
+        for i in range(X.shape[0]):
+            node = roots[t]
+            while node >= 0:
+                fval = X[i, feature[node]]
+                missing = (decision[node] >> 2) & 3
+                if np.isnan(fval) and missing != _MISSING_NAN:
+                    fval = 0.
+                if ((missing == _MISSING_ZERO and -_ZERO_THRESHOLD <= fval <= _ZERO_THRESHOLD)
+                        or (missing == _MISSING_NAN and np.isnan(fval))):
+                    if decision[node] & _DEFAULT_LEFT_MASK:
+                        node = left[node]
+                    else:
+                        node = right[node]
+                elif fval <= threshold[node]:
+                    node = left[node]
+                else:
+                    node = right[node]
+            out[i] += leaf_value[~node]
+    return out
+
+if numba is not None:
+    _traverse_compiled = numba.njit(nogil=True)(_traverse)
+
+def _traverse_numpy(X, roots, feature, threshold, decision, left, right, leaf_value, out):
+    # Vectorised over events: all events descend one tree level per iteration
+    out[:] = 0.
+    rows = np.arange(X.shape[0])
+    for root in roots:
+        if root < 0:
+            out += leaf_value[~root]
+            continue
+        node = np.full(X.shape[0], root, dtype=np.int32)
+        active = rows
+        while active.size:
+            idx = node[active]
+            fval = X[active, feature[idx]]
+            missing = (decision[idx] >> 2) & 3
+            isnan = np.isnan(fval)
+            fval = np.where(isnan & (missing != _MISSING_NAN), 0., fval)
+            use_default = (((missing == _MISSING_ZERO) & (np.abs(fval) <= _ZERO_THRESHOLD))
+                           | ((missing == _MISSING_NAN) & isnan))
+            go_left = np.where(use_default, (decision[idx] & _DEFAULT_LEFT_MASK) > 0, fval <= threshold[idx])
+            node[active] = np.where(go_left, left[idx], right[idx])
+            active = active[node[active] >= 0]
+        out += leaf_value[~node]
+    return out
+
+class LightGBMTrees():
+    '''
+    Tree ensemble read from a LightGBM text model, evaluated without the lightgbm runtime.
+
+    All trees are flattened into shared node arrays. Children are global node indices,
+    leaves are encoded as ~(global leaf index), so every tree is walked by the same loop.
+    Without numba, the model file is evaluated with lightgbm.Booster if lightgbm is installed
+    (the NumPy loop is several times slower), and with NumPy otherwise.
+    '''
+    def __init__(self, feature_names, objective, roots, feature, threshold, decision, left, right, leaf_value,
+                 model_file=None):
+        self.model_file = model_file
+        self._booster = None
+        self.feature_names = feature_names
+        self.objective = objective
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.decision = decision
+        self.left = left
+        self.right = right
+        self.leaf_value = leaf_value
+
+        self.sigmoid = None
+        if objective.startswith("binary"):
+            self.sigmoid = 1.
+            for token in objective.split()[1:]:
+                if token.startswith("sigmoid:"):
+                    self.sigmoid = float(token.split(":")[1])
+        elif objective.split()[0] not in ("regression", "regression_l1", "huber", "fair", "quantile", "mape"):
+            raise NotImplementedError(f"Unsupported LightGBM objective: {objective}")
+
+    @classmethod
+    def from_file(cls, model_file):
+        with open(model_file) as f:
+            lines = f.read().splitlines()
+
+        header = {}
+        trees = []
+        tree = None
+        for line in lines:
+            if line.startswith("Tree="):
+                tree = {}
+                trees.append(tree)
+            elif line == "end of trees":
+                break
+            elif "=" in line:
+                key, value = line.split("=", 1)
+                if tree is None:
+                    header[key] = value
+                else:
+                    tree[key] = value
+            elif line == "average_output":
+                raise NotImplementedError("Random forest models (average_output) are not supported")
+
+        if "feature_names" not in header or not trees:
+            raise ValueError(f"{model_file} is not a LightGBM text model")
+        if int(header.get("num_class", 1)) != 1:
+            raise NotImplementedError("Only single class LightGBM models are supported")
+
+        roots, feature, threshold, decision, left, right, leaf_value = [], [], [], [], [], [], []
+        n_nodes = n_leaves = 0
+        for tree in trees:
+            if int(tree.get("num_cat", 0)) > 0 or int(tree.get("is_linear", 0)) > 0:
+                raise NotImplementedError("Categorical splits and linear trees are not supported")
+            leaves = np.array(tree["leaf_value"].split(), dtype=np.float64)
+            if int(tree["num_leaves"]) == 1:
+                roots.append(~n_leaves)
+            else:
+                children = []
+                for key in ("left_child", "right_child"):
+                    child = np.array(tree[key].split(), dtype=np.int32)
+                    children.append(np.where(child >= 0, child + n_nodes, ~(~child + n_leaves)))
+                roots.append(n_nodes)
+                feature.append(np.array(tree["split_feature"].split(), dtype=np.int32))
+                threshold.append(np.array(tree["threshold"].split(), dtype=np.float64))
+                decision.append(np.array(tree["decision_type"].split(), dtype=np.int8))
+                left.append(children[0])
+                right.append(children[1])
+                n_nodes += len(feature[-1])
+            leaf_value.append(leaves)
+            n_leaves += len(leaves)
+
+        decision = np.concatenate(decision) if decision else np.zeros(0, dtype=np.int8)
+        if np.any(decision & _CATEGORICAL_MASK):
+            raise NotImplementedError("Categorical splits are not supported")
+
+        def concat(arrays, dtype):
+            return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+        return cls(
+            feature_names = [name.removeprefix("events_") for name in header["feature_names"].split()],
+            objective = header.get("objective", "regression"),
+            roots = np.array(roots, dtype=np.int32),
+            feature = concat(feature, np.int32),
+            threshold = concat(threshold, np.float64),
+            decision = decision,
+            left = concat(left, np.int32),
+            right = concat(right, np.int32),
+            leaf_value = concat(leaf_value, np.float64),
+            model_file = model_file,
+        )
+
+    _ARRAYS = ("roots", "feature", "threshold", "decision", "left", "right", "leaf_value")
+
+    def to_arrays(self):
+        '''Node arrays and metadata of the model, see from_arrays and model_store.py.'''
+        return ({name: getattr(self, name) for name in self._ARRAYS},
+                {"feature_names": self.feature_names, "objective": self.objective, "model_file": self.model_file})
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        # The arrays are used as they are, e.g. read-only views of a memory-mapped file
+        return cls(meta["feature_names"], meta["objective"], **{name: arrays[name] for name in cls._ARRAYS},
+                   model_file=meta.get("model_file"))
+
+    def num_trees(self):
+        return len(self.roots)
+
+    def num_feature(self):
+        return len(self.feature_names)
+
+    def to_matrix(self, data):
+        '''
+        Input matrix with one column per model feature.
+        Named inputs (DataFrame, dict, awkward record array) are matched to the features by name,
+        2D arrays are taken in the order they were trained with.
+        '''
+        if isinstance(data, np.ndarray):
+            if data.ndim != 2 or data.shape[1] != self.num_feature():
+                raise ValueError(f"Expected an array with {self.num_feature()} columns, got shape {data.shape}")
+            return np.ascontiguousarray(data, dtype=np.float64)
+
+        names = list(data.fields) if isinstance(data, ak.Array) else list(data.keys())
+        if all(name in names for name in self.feature_names):
+            columns = [data[name] for name in self.feature_names]
+        elif len(names) == self.num_feature():
+            warnings.warn(f"Input columns do not match the model features {self.feature_names}, using them by position")
+            columns = [data[name] for name in names]
+        else:
+            missing = [name for name in self.feature_names if name not in names]
+            raise KeyError(f"Missing model features: {missing}")
+
+        X = np.empty((len(columns[0]), len(columns)), dtype=np.float64)
+        for i, col in enumerate(columns):
+            if isinstance(col, ak.Array):
+                col = ak.to_numpy(ak.fill_none(col, np.nan))
+            X[:, i] = col
+        return X
+
+    def predict_raw(self, data, backend="auto"):
+        X = self.to_matrix(data)
+        out = np.empty(X.shape[0], dtype=np.float64)
+        if backend == "auto":
+            if numba is not None:
+                backend = "numba"
+            elif self.model_file is not None and _lightgbm() is not None:
+                backend = "lightgbm"
+            else:
+                backend = "numpy"
+        if backend == "lightgbm":
+            if self._booster is None:
+                self._booster = _lightgbm().Booster(model_file=self.model_file)
+            return self._booster.predict(X, raw_score=True).astype(np.float64)
+        if backend == "numba":
+            traverse = _traverse_compiled
+        elif backend == "numpy":
+            traverse = _traverse_numpy
+        elif backend == "python":
+            traverse = _traverse
+        else:
+            raise ValueError(f"Unknown backend {backend}")
+        return traverse(X, self.roots, self.feature, self.threshold, self.decision,
+                        self.left, self.right, self.leaf_value, out)
+
+    def predict(self, data, backend="auto"):
+        score = self.predict_raw(data, backend)
+        if self.sigmoid is not None:
+            score = 1./(1. + np.exp(-self.sigmoid*score))
+        return score
@@ -0,0 +1,150 @@
+import os, sys, types, pickle, warnings
+from collections import OrderedDict
+from functools import partial
+from MVA.lazy import lazy_import
+
+# The inference backends are only imported when a model of that kind is loaded
+torch = lazy_import("torch")
+lgbm_inference = lazy_import("MVA.lgbm_inference", by_value=True)
+dnn_inference = lazy_import("MVA.dnn_inference", by_value=True)
+gnn_inference = lazy_import("MVA.gnn_inference", by_value=True)
+gnnmodels = lazy_import("MVA.gnnmodels", by_value=True)
+model_store = lazy_import("MVA.model_store", by_value=True)
+
+_ANCHOR = "_vhccpoco_model_registry"
+
+class ModelRegistry():
+    '''
+    Worker-level cache of the MVA models evaluated by the VHcc and VHbb processors.
+
+    Each model is loaded once per process and kept until it is evicted.
+    Entries are keyed by (kind, channel, era) and by the path, mtime and size of every
+    file the model is built from, so a model file replaced on disk is reloaded.
+    The cache is bounded by the summed on-disk size of the cached models: when the
+    bound is exceeded the least recently used models are dropped.
+    '''
+    def __init__(self, max_size_mb=512):
+        self.max_size = max_size_mb*1024**2
+        self.models = OrderedDict()
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, paths):
+        out = []
+        for path in paths:
+            stat = os.stat(path)
+            out.append((os.path.realpath(path), stat.st_mtime_ns, stat.st_size))
+        return tuple(out)
+
+    def get(self, kind, channel, era, loader, *paths):
+        files = self.fingerprint(paths)
+        key = (kind, channel, era, files)
+        if key in self.models:
+            self.models.move_to_end(key)
+            self.hits += 1
+            return self.models[key]
+
+        self.misses += 1
+        # Drop outdated versions of the same model files
+        stale = [k for k in self.models if k[:3] == key[:3] and [f[0] for f in k[3]] == [f[0] for f in files]]
+        for k in stale:
+            self.drop(k)
+
+        model = loader(*paths)
+        self.models[key] = model
+        self.sizes[key] = sum(f[2] for f in files)
+        self.evict()
+        return model
+
+    def drop(self, key):
+        del self.models[key]
+        del self.sizes[key]
+
+    def evict(self):
+        # The most recently used model is always kept, even if it alone exceeds the bound
+        while len(self.models) > 1 and sum(self.sizes.values()) > self.max_size:
+            key = next(iter(self.models))
+            self.drop(key)
+
+    def clear(self):
+        self.models.clear()
+        self.sizes.clear()
+
+    def __len__(self):
+        return len(self.models)
+
+    def __repr__(self):
+        return f"ModelRegistry({len(self.models)} models, {sum(self.sizes.values())/1024**2:.1f}/{self.max_size/1024**2:.0f} MB, hits={self.hits}, misses={self.misses})"
+
+def get_registry(max_size_mb=512):
+    '''
+    Return the registry shared by all processors running in this process.
+
+    MVA is shipped to the workers by value with cloudpickle, so the globals of this
+    module are rebuilt each time a chunk unpickles the processor. The registry is
+    therefore anchored in sys.modules, which lives as long as the worker process.
+    '''
+    anchor = sys.modules.get(_ANCHOR)
+    if anchor is None:
+        anchor = types.ModuleType(_ANCHOR)
+        anchor.registry = ModelRegistry(max_size_mb)
+        sys.modules[_ANCHOR] = anchor
+    return anchor.registry
+
+# With a store_dir the model weights are memory-mapped from a store file (model_store.py),
+# shared by all the worker processes of a node, instead of being loaded in each process
+
+def load_bdt(model_file, store_dir=None):
+    cls = lgbm_inference.LightGBMTrees
+    if store_dir:
+        return model_store.load_stored(store_dir, "BDT", [model_file], partial(cls.from_file, model_file),
+                                       cls.to_arrays, cls.from_arrays)
+    return cls.from_file(model_file)
+
+def load_dnn(model_file, store_dir=None):
+    # Keras .h5 models and converted .npz bundles are both evaluated with NumPy
+    cls = dnn_inference.DenseNetwork
+    if store_dir:
+        return model_store.load_stored(store_dir, "DNN", [model_file], partial(cls.from_file, model_file),
+                                       cls.to_arrays, cls.from_arrays)
+    return cls.from_file(model_file)
+
+def _gnn_params(params_file):
+    with open(params_file,'rb') as f:
+        return pickle.load(f)
+
+def _gnn_from_file(model_file, params_file):
+    model = gnnmodels.GraphAttentionClassifier(**_gnn_params(params_file))
+    model.load_state_dict(torch.load(model_file,weights_only=True,map_location="cpu"))
+    return model
+
+def _gnn_to_arrays(params_file, model):
+    return {k: v.cpu().numpy() for k, v in model.state_dict().items()}, {"modelparams": _gnn_params(params_file)}
+
+def _gnn_from_arrays(arrays, meta):
+    model = gnnmodels.GraphAttentionClassifier(**meta["modelparams"])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")     # the memory-mapped arrays are read-only, the model never writes them
+        state = {k: torch.from_numpy(v) for k, v in arrays.items()}
+    # assign keeps the memory-mapped tensors instead of copying them into the parameters
+    model.load_state_dict(state, assign=True)
+    return model
+
+def load_gnn(model_file, params_file, device="cpu", export=False, store_dir=None, quantize=False, float_layers=None):
+    # quantize: int8 dynamic quantization for the CPU (gnn_inference.quantize_gnn), before the export
+    if store_dir:
+        model = model_store.load_stored(store_dir, "GNN", [model_file, params_file],
+                                        partial(_gnn_from_file, model_file, params_file),
+                                        partial(_gnn_to_arrays, params_file), _gnn_from_arrays)
+    else:
+        model = _gnn_from_file(model_file, params_file)
+    model.to(device)
+    model.eval()
+    if quantize:
+        if device != "cpu":
+            raise ValueError(f"The quantized GNN runs on the CPU only, not on {device}")
+        model = gnn_inference.quantize_gnn(model, float_layers)
+    if export:
+        return gnn_inference.export_gnn(model, device)
+    return model
@@ -0,0 +1,92 @@
+import os, json, hashlib
+import numpy as np
+
+_MAGIC = b"VHCCPOCO-MODEL-STORE-1\n"
+_ALIGN = 64
+
+def _aligned(offset):
+    return -(-offset//_ALIGN)*_ALIGN
+
+def write_store(path, arrays, meta):
+    '''
+    Write the arrays (dict of name: ndarray) and the JSON-serializable meta into one file:
+    a header followed by the raw arrays, each aligned to 64 bytes.
+    The file is written under a temporary name and renamed, so readers never see it half written.
+    '''
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    layout, offset = {}, 0
+    for name, a in arrays.items():
+        offset = _aligned(offset)
+        layout[name] = {"dtype": a.dtype.str, "shape": list(a.shape), "offset": offset}
+        offset += a.nbytes
+    header = json.dumps({"meta": meta, "arrays": layout}).encode()
+    start = _aligned(len(_MAGIC) + 8 + len(header))
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for name, a in arrays.items():
+            f.seek(start + layout[name]["offset"])
+            f.write(a.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp, path)
+
+def read_store(path):
+    '''
+    Arrays and meta of a store file. The arrays are read-only views of a memory map of the file,
+    so nothing is deserialized and all the processes reading the file share the same pages.
+    '''
+    mm = np.memmap(path, dtype=np.uint8, mode="r")
+    if bytes(mm[:len(_MAGIC)]) != _MAGIC:
+        raise ValueError(f"{path} is not a model store file")
+    size = int.from_bytes(bytes(mm[len(_MAGIC):len(_MAGIC) + 8]), "little")
+    header = json.loads(bytes(mm[len(_MAGIC) + 8:len(_MAGIC) + 8 + size]))
+    start = _aligned(len(_MAGIC) + 8 + size)
+
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype, shape = np.dtype(spec["dtype"]), tuple(spec["shape"])
+        count = int(np.prod(shape))
+        if count == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=start + spec["offset"]).reshape(shape)
+    return arrays, header["meta"]
+
+def store_path(store_dir, kind, paths):
+    # One store file per version of the model files: a replaced model gets a new store file
+    files = []
+    for path in paths:
+        stat = os.stat(path)
+        files.append((os.path.realpath(path), stat.st_mtime_ns, stat.st_size))
+    digest = hashlib.sha1(json.dumps([kind, files]).encode()).hexdigest()[:20]
+    return os.path.join(store_dir, f"{kind}-{digest}.bin")
+
+def load_stored(store_dir, kind, paths, build, to_arrays, from_arrays):
+    '''
+    Load a model from its store file in store_dir, creating the file first if needed.
+
+    build() loads the model from the original files, to_arrays(model) returns its (arrays, meta)
+    and from_arrays(arrays, meta) rebuilds it on top of the memory-mapped arrays. The first process
+    on a node writes the file, the others only map it. {uid} in store_dir is replaced by the user id
+    of the process. If store_dir is not writable, or the store file cannot be read, the model is
+    loaded from the original files.
+    '''
+    store_dir = store_dir.format(uid=os.getuid())
+    path = store_path(store_dir, kind, paths)
+    model = None
+    if not os.path.exists(path):
+        model = build()
+        try:
+            os.makedirs(store_dir, exist_ok=True)
+            write_store(path, *to_arrays(model))
+        except OSError as e:
+            print(f"Cannot write the model store {path} ({e}), using the model from {paths[0]}")
+            return model
+    try:
+        return from_arrays(*read_store(path))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Cannot read the model store {path} ({e}), using the model from {paths[0]}")
+        return model if model is not None else build()
@@ -0,0 +1,182 @@
+import os, time, resource
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import awkward as ak
+import pandas as pd
+from MVA.inputs import feature_matrix, evaluate_masked, take_rows, gnn_inputs, GNN_FLAT
+
+def memory_mb():
+    '''Resident and peak resident memory of the process in MB. The resident memory is NaN without /proc.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/1024**2
+    except OSError:
+        rss = np.nan
+    return rss, peak
+
+def row_hash(data, extra=None):
+    '''
+    64-bit hash of the bytes of each row of data (an array, a DataFrame or a dict of arrays with one row
+    per event) and of the extra arrays: FNV-1a over the 32-bit words of the row, vectorized over the rows.
+    '''
+    if isinstance(data, pd.DataFrame):
+        arrays = [data.to_numpy()]
+    elif isinstance(data, dict):
+        arrays = list(data.values())
+    else:
+        arrays = [data]
+    arrays += list(extra or [])
+    nrows = len(arrays[0])
+    keys = np.full(nrows, 0xcbf29ce484222325, dtype=np.uint64)
+    prime = np.uint64(0x100000001b3)
+    for a in arrays:
+        words = np.ascontiguousarray(a).reshape(nrows, -1).view(np.uint32)
+        for j in range(words.shape[1]):
+            keys ^= words[:, j]
+            keys *= prime
+    return keys
+
+class ScoreCache():
+    '''
+    Scores of one MVA head keyed by the hash of the input row of each event (row_hash), kept as sorted
+    arrays. Events with the same inputs, e.g. in the shape variations of a chunk that do not change
+    them, are only scored once.
+    '''
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.scores = np.empty(0)
+
+    def lookup(self, keys):
+        '''Mask of the keys found and their scores (undefined where not found).'''
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool), np.empty(len(keys))
+        index = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[index] == keys, self.scores[index]
+
+    def add(self, keys, scores):
+        keys, first = np.unique(np.concatenate([keys, self.keys]), return_index=True)
+        self.scores = np.concatenate([scores, self.scores])[first]
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys)
+
+class MVAStage():
+    '''
+    The MVA heads of one channel (BDT, DNN, GNN) evaluated on inputs extracted once from the events.
+
+    The event-level inputs of all the heads are written into one matrix, features first: the BDT and DNN
+    heads get a DataFrame view of the features, the GNN head its global inputs from the same matrix
+    and the padded jets and leptons. gnn_fields maps the GNN global inputs (inputs.GNN_FLAT) to the
+    event field they are read from, or to a constant; the others are read from the field of the same name.
+
+    Each head is evaluated on its rows only (all the events if rows is None), and the feature heads
+    only on the events with all the features defined. The time and memory of the input extraction
+    and of each head are kept in stats.
+
+    With a cache (a dict of ScoreCache by head name, kept for the whole chunk), the events whose input
+    row was already scored, e.g. in a previous shape variation, get the cached score and only the
+    others are evaluated.
+
+    Heads added with background=True are started first, each in its own thread, and their scores are
+    returned as futures: the caller goes on (e.g. fills the histograms that do not use them) and waits
+    for them with result(). Torch releases the GIL, so the GNN runs alongside the NumPy work. The memory
+    of a background head is measured on the whole process, including the work done meanwhile.
+    '''
+    def __init__(self, features, gnn_fields=None, cache=None):
+        self.features = list(features)
+        self.gnn_fields = dict(gnn_fields or {})
+        self.cache = cache
+        self.heads = {}
+        self.stats = {}
+
+    def add_head(self, name, evaluate, inputs="features", rows=None, extra=None, background=False):
+        '''
+        evaluate scores the rows of the inputs: a DataFrame of the features, or the dict of gnn_inputs with
+        inputs="gnn". extra are arrays (one entry per event) the scores depend on besides the inputs,
+        e.g. the partition of split models, added to the key of the cache. evaluate must not use state
+        shared with the main thread (e.g. load models) if background is True.
+        '''
+        if inputs not in ("features", "gnn"):
+            raise ValueError(f"Unknown inputs {inputs} of the MVA head {name}")
+        self.heads[name] = (evaluate, inputs, rows, extra, background)
+
+    def extract(self, events):
+        '''Inputs of the heads and the mask of the events with all the features defined.'''
+        columns = list(self.features)
+        gnn = any(head[1] == "gnn" for head in self.heads.values())
+        sources = [self.gnn_fields.get(name, name) for name in GNN_FLAT] if gnn else []
+        columns += list(dict.fromkeys(s for s in sources if isinstance(s, str) and s not in columns))
+        X, _ = feature_matrix(events, columns)
+
+        nfeatures = len(self.features)
+        data = {"features": pd.DataFrame(X[:, :nfeatures], columns=self.features, copy=False)}
+        valid = ~np.isnan(X[:, :nfeatures]).any(axis=1)
+        if gnn:
+            flat = np.empty((len(X), len(GNN_FLAT)), dtype=X.dtype)
+            for i, source in enumerate(sources):
+                flat[:, i] = X[:, columns.index(source)] if isinstance(source, str) else source
+            data["gnn"] = gnn_inputs(events, flat=flat)
+        return data, valid
+
+    def measure(self, name, nevents, start, memory_start, scored=None):
+        rss, peak = memory_mb()
+        self.stats[name] = {"events": nevents, "scored": nevents if scored is None else scored,
+                            "time": time.perf_counter() - start,
+                            "rss_mb": rss - memory_start[0], "peak_mb": peak - memory_start[1]}
+
+    def evaluate_cached(self, name, evaluate, data, rows, extra):
+        '''Scores of the rows (all the events if None) from the cache, evaluating only the rows not found.'''
+        cache = self.cache.setdefault(name, ScoreCache())
+        keys = row_hash(data, extra)
+        found, scores = cache.lookup(keys)
+        scores = np.where(found, scores, np.nan)
+        todo = ~found if rows is None else rows & ~found
+        if todo.any():
+            scores[todo] = evaluate(take_rows(data, todo))
+            cache.add(keys[todo], scores[todo])
+        if rows is None:
+            return scores, int(todo.sum())
+        return ak.mask(scores, rows), int(todo.sum())
+
+    def run(self, events):
+        '''
+        Scores of all the heads, by name. The scores of the heads evaluated on a subset of the events
+        are option-typed awkward arrays, None for the events that were not scored. The scores of the
+        background heads are futures.
+        '''
+        self.stats = {}
+        start, memory_start = time.perf_counter(), memory_mb()
+        data, valid = self.extract(events)
+        self.measure("inputs", len(events), start, memory_start)
+
+        scores = {}
+        # The background heads first, so that they run alongside the others
+        for name, (evaluate, inputs, rows, extra, background) in sorted(self.heads.items(), key=lambda item: not item[1][4]):
+            if inputs == "features":
+                rows = valid if rows is None else rows & valid
+            if background:
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"MVA-{name}")
+                scores[name] = executor.submit(self.evaluate_head, name, evaluate, data[inputs], rows, extra)
+                # The thread exits once the head is evaluated
+                executor.shutdown(wait=False)
+            else:
+                scores[name] = self.evaluate_head(name, evaluate, data[inputs], rows, extra)
+        return {name: scores[name] for name in self.heads}
+
+    def evaluate_head(self, name, evaluate, data, rows, extra):
+        start, memory_start = time.perf_counter(), memory_mb()
+        scored = None
+        if self.cache is not None:
+            scores, scored = self.evaluate_cached(name, evaluate, data, rows, extra)
+        elif rows is None:
+            scores = evaluate(data)
+        else:
+            scores = evaluate_masked(evaluate, data, rows)
+        self.measure(name, len(scores) if rows is None else int(rows.sum()), start, memory_start, scored)
+        return scores
+
+    def report(self):
+        return ", ".join(f"{name} {s['events']} events ({s['scored']} scored) {s['time']:.2f} s "
+                         f"{s['rss_mb']:+.0f} MB (peak {s['peak_mb']:+.0f} MB)" for name, s in self.stats.items())
@@ -1,19 +1,14 @@
-import pandas as pd
-import lightgbm as lgb
-from sklearn.model_selection import train_test_split
 import argparse
 import glob
 import os, gc
-import matplotlib.pyplot as plt
-from sklearn.metrics import roc_curve, roc_auc_score, log_loss
-
-from imblearn.over_sampling import SMOTE
 import numpy as np
 import awkward as ak
-from coffea.util import load
 from concurrent.futures import ThreadPoolExecutor
-cpucount = len(os.sched_getaffinity(0))
-print(f"Found {cpucount} CPUs.")
+try:
+    from MVA.inputs import gnn_inputs
+except ImportError:
+    # Run as a script from the MVA folder
+    from inputs import gnn_inputs
 
 def get_inputs(channel,model_type='gnn'):
     if model_type in ["lgbm","dnn"]:
@@ -205,6 +200,7 @@ def getcols(channel,model_type='gnn'):
 
 # Function to load data
 def load_data(dir_path, test, coffea):
+    from coffea.util import load
     signal_files = [] 
 
     if isinstance(dir_path,str):
@@ -266,6 +262,7 @@ def load_data(dir_path, test, coffea):
 
 
 def splitdata(X,y,e=None):
+    from sklearn.model_selection import train_test_split
     if e is None:
         print("Using random split.")
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
@@ -282,6 +279,8 @@ def splitdata(X,y,e=None):
 
 
 def evaluate_model(y, input_y_pred, input_y_wts=None, plot_dir=None, suff=""):
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import roc_curve, roc_auc_score, log_loss
 
     y_pred = input_y_pred
     data_pred = None
@@ -329,66 +328,11 @@ def evaluate_model(y, input_y_pred, input_y_wts=None, plot_dir=None, suff=""):
     return auc
 
 
-def resize_arr(arr,target):
-    m, n, p = arr.shape
-    
-    if n > target:
-        return arr[:, :target, :]
-    elif n < target:
-        padding = numpy.zeros([m, target - n, p])
-        return numpy.concatenate([arr, padding], dim=1)
-    else:
-        return arr
-
-def process_jagged(arr,maxelems=6):
-    N = np.max(ak.num(arr, axis=1))  
-    padded = ak.pad_none(arr, max(N,maxelems), axis=1)
-    unzipped = ak.unzip(padded)
-    padded = [ak.fill_none(p,0.).to_numpy() for p in unzipped]
-    arr = np.array(padded)
-    arr = np.transpose(arr, (1,2,0))
-    arr = resize_arr(arr,maxelems)
-    return arr
-
-def process_gnn_inputs(df,intype="pd",removenans=True,verbose=False):
-    #TODO: intype "ak" does not work yet
-
+def process_gnn_inputs(df,removenans=True,verbose=False):
     import torch
     
-    tensors = {}
-
-    jetelems =  ["JetGood_btagCvL","JetGood_btagCvB",
-                "JetGood_pt","JetGood_eta","JetGood_phi","JetGood_mass"]
-    lepelems =  ["LeptonGood_miniPFRelIso_all","LeptonGood_pfRelIso03_all",
-                "LeptonGood_pt","LeptonGood_eta","LeptonGood_phi","LeptonGood_mass"]
-    flatelems = ["V_pt","V_eta","V_phi","V_mass",
-                "PuppiMET_pt","PuppiMET_phi","nPV","W_m",
-                "LeptonCategory","channel","era"]
-    
-    X = df[jetelems + lepelems + flatelems]
-    del df
-
-    if verbose: print("Processing jets...")
-    thisX = X[jetelems]  
-    thisX = process_jagged(thisX,6)
-    tensors["jet"] = torch.tensor(thisX[:,:,:2],dtype=torch.float32)
-    tensors["jetP4"] = torch.tensor(thisX[:,:,2:],dtype=torch.float32)
-
-    if verbose: print("Processing leptons...")
-    thisX = X[lepelems]
-    thisX = process_jagged(thisX,2)
-    tensors["lep"] = torch.tensor(thisX[:,:,:2],dtype=torch.float32)
-    tensors["lepP4"] = torch.tensor(thisX[:,:,2:],dtype=torch.float32)
-
-    if verbose: print("Processing other variables...")
-    thisX = ak.unzip(X[flatelems])
-    thisX = [a.to_numpy() for a in thisX]
-    thisX = np.transpose(np.array(thisX))
-
-
-    tensors["VP4"] = torch.tensor(thisX[:,:4],dtype=torch.float32)
-    tensors["global"] = torch.tensor(thisX[:,4:8],dtype=torch.float32)
-    tensors["category"] = torch.tensor(thisX[:,8:],dtype=torch.int64)
+    if verbose: print("Padding jets and leptons...")
+    tensors = {k: torch.from_numpy(v) for k, v in gnn_inputs(df).items()}
 
     nanmask = None
     if removenans:
@@ -462,6 +406,8 @@ def train_gnn(X, y, signame, test, w=None, e=None, hyperparameter=False, ntrials
 
 # Main function to load data and train/evaluate model
 def main():
+    cpucount = len(os.sched_getaffinity(0))
+    print(f"Found {cpucount} CPUs.")
     parser = argparse.ArgumentParser(description='Train or evaluate a GNN model.')
     parser.add_argument('--dir_path', '-d', type=str, nargs='+', help='Path to the directory containing input files.')
     parser.add_argument('--model', type=str, help='Path to the model file (for evaluation only).')
@@ -9,6 +9,8 @@ from pocket_coffea.lib.weights.common.common import common_weights
 import vjet_weights
 from vjet_weights import *
 
+import MVA
+
 import click
 
 import workflow_VHbb
@@ -21,6 +23,7 @@ import cloudpickle
 cloudpickle.register_pickle_by_value(workflow_VHbb)
 cloudpickle.register_pickle_by_value(CommonSelectors)
 cloudpickle.register_pickle_by_value(vjet_weights)
+cloudpickle.register_pickle_by_value(MVA)
 
 import os
 localdir = os.path.dirname(os.path.abspath(__file__))
@@ -64,6 +67,7 @@ parameters["save_arrays"] = False
 parameters["separate_models"] = False
 parameters["run_bdt"] = False
 parameters['run_dnn'] = False
+parameters["kinematics_backend"] = None    # "numba" or "numpy" for the kernels of kinematics.py, default numba if installed
 ctx = click.get_current_context()
 outputdir = ctx.params.get('outputdir')
 
@@ -10,7 +10,6 @@ import vjet_weights
 from vjet_weights import *
 
 import MVA
-from MVA.gnnmodels import GraphAttentionClassifier
 
 import click
 
@@ -68,6 +67,7 @@ parameters["save_arrays"] = True
 parameters["separate_models"] = False
 parameters["run_bdt"] = False
 parameters['run_dnn'] = False
+parameters["kinematics_backend"] = None    # "numba" or "numpy" for the kernels of kinematics.py, default numba if installed
 parameters['run_gnn'] = False
 ctx = click.get_current_context()
 outputdir = ctx.params.get('outputdir')
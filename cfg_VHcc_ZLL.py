@@ -14,14 +14,14 @@ from CommonSelectors import *
 import vjet_weights 
 from vjet_weights import *
 import MVA
-from MVA.gnnmodels import GraphAttentionClassifier
-from MVA.training import process_gnn_inputs
+import features
 
 import cloudpickle
 cloudpickle.register_pickle_by_value(workflow_VHcc)
 cloudpickle.register_pickle_by_value(CommonSelectors)
 cloudpickle.register_pickle_by_value(vjet_weights)
 cloudpickle.register_pickle_by_value(MVA)
+cloudpickle.register_pickle_by_value(features)
 
 import os
 localdir = os.path.dirname(os.path.abspath(__file__))
@@ -63,6 +63,7 @@ parameters["proc_type"] = "ZLL"
 parameters["save_arrays"] = True
 parameters["separate_models"] = False
 parameters['run_dnn'] = False
+parameters["kinematics_backend"] = None    # "numba" or "numpy" for the kernels of kinematics.py, default numba if installed
 parameters['run_gnn'] = True
 ctx = click.get_current_context()
 outputdir = ctx.params.get('outputdir')
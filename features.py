@@ -0,0 +1,134 @@
+import numpy as np
+import awkward as ak
+
+class FeatureRegistry():
+    '''
+    Event features declared once with the fields they depend on, and computed only when requested.
+
+    A feature is a function of (events, processor) returning the values of the field, registered for
+    all the channels or for some of them (a channel-specific definition takes precedence). compute
+    writes into processor.events the requested features and the features they depend on, in
+    dependency order; the fields that are not features (NanoAOD branches, objects defined by the
+    workflow) are expected to be in the events already.
+    '''
+    def __init__(self):
+        self.features = {}
+        self.aliases = set()
+
+    def add(self, name, compute, depends=(), channels=(None,)):
+        for channel in channels:
+            self.features[(name, channel)] = (compute, tuple(depends))
+
+    def feature(self, name, depends=(), channels=(None,)):
+        '''Decorator registering a function as the feature name.'''
+        def register(compute):
+            self.add(name, compute, depends, channels)
+            return compute
+        return register
+
+    def alias(self, name, source, channels=(None,)):
+        '''Feature name read from the field of an object, e.g. alias("dijet_m", "dijet_csort.mass").'''
+        collection, field = source.split(".")
+        self.add(name, lambda events, processor: events[collection][field], [collection], channels)
+        self.aliases.update((name, channel) for channel in channels)
+
+    def get(self, name, channel):
+        return self.features.get((name, channel), self.features.get((name, None)))
+
+    def is_alias(self, name, channel):
+        key = (name, channel) if (name, channel) in self.features else (name, None)
+        return key in self.aliases
+
+    def names(self, channel):
+        return {name for name, c in self.features if c in (None, channel)}
+
+    def resolve(self, names, channel):
+        '''Features to compute for the requested names (all the features if None), dependencies first.'''
+        order, visiting = [], set()
+        def visit(name):
+            if name in order or self.get(name, channel) is None:
+                return
+            if name in visiting:
+                raise ValueError(f"Circular dependency of the feature {name}")
+            visiting.add(name)
+            for dependency in self.get(name, channel)[1]:
+                visit(dependency)
+            order.append(name)
+        for name in sorted(self.names(channel) if names is None else names):
+            visit(name)
+        return order
+
+    def compute(self, processor, names, channel, float32=False, float64=()):
+        '''
+        Write the requested features (all if names is None) and their dependencies into processor.events.
+        With float32 the float64 features are stored as float32, except the ones in float64, the objects
+        (records), which the other features are computed from, and the aliases, which are views of their
+        object: a copy would add to the memory of the object. The objects are made in float32 instead
+        (e.g. the dtype of kinematics.wlnu_candidates).
+        Returns the bytes owned by each feature as computed and as stored: the buffers that are not
+        shared with a feature computed before it, 0 for the aliases.
+        '''
+        nbytes, seen = {}, set()
+        for name in self.resolve(names, channel):
+            values = self.get(name, channel)[0](processor.events, processor)
+            if self.is_alias(name, channel):
+                nbytes[name] = (0, 0)
+            elif float32 and name not in float64 and primitive_dtype(values) == "float64":
+                # The float64 buffers are freed after the cast, their addresses are not kept
+                computed = owned_nbytes(values, set(seen))
+                values = ak.values_astype(values, np.float32)
+                nbytes[name] = (computed, owned_nbytes(values, seen))
+            else:
+                computed = owned_nbytes(values, seen)
+                nbytes[name] = (computed, computed)
+            processor.events[name] = values
+        return nbytes
+
+def owned_nbytes(values, seen):
+    '''Bytes of the buffers of values whose address is not in seen; their addresses are added to seen.'''
+    nbytes = 0
+    for buffer in ak.to_buffers(ak.Array(values))[2].values():
+        buffer = np.asarray(buffer)
+        address = buffer.__array_interface__["data"][0]
+        if address not in seen:
+            seen.add(address)
+            nbytes += buffer.nbytes
+    return nbytes
+
+def primitive_dtype(values):
+    '''dtype name of the numbers of a flat, jagged or optional array, None for records.'''
+    t = ak.type(values)
+    while hasattr(t, "type"):
+        t = t.type
+    return getattr(t, "dtype", None)
+
+def cut_fields(cut):
+    '''
+    Event fields a pocket_coffea Cut reads, as declared on its function with CommonSelectors.reads.
+    The cuts of pocket_coffea read no event features (empty set); None for the other cuts that do
+    not declare them.
+    '''
+    declared = getattr(cut.function, "fields", None)
+    if declared is None:
+        return set() if getattr(cut.function, "__module__", "").startswith("pocket_coffea.") else None
+    fields = set()
+    for field in declared:
+        fields.update([field] if isinstance(field, str) else field(cut.params))
+    return fields
+
+def find_cuts(obj, depth=6):
+    '''The pocket_coffea Cuts in a selection object (categories, subsamples), searched through its attributes.'''
+    from pocket_coffea.lib.cut_definition import Cut
+    if isinstance(obj, Cut):
+        return {obj}
+    if depth == 0:
+        return set()
+    if isinstance(obj, dict):
+        children = list(obj.values())
+    elif isinstance(obj, (list, tuple, set)):
+        children = list(obj)
+    elif any(cls.__module__.startswith("pocket_coffea.lib") for cls in type(obj).__mro__):
+        children = list(vars(obj).values())
+    else:
+        return set()
+    return set().union(*(find_cuts(child, depth - 1) for child in children))
@@ -0,0 +1,463 @@
+import numpy as np
+import awkward as ak
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+W_MASS = 80.38
+
+def _cartesian(pt, eta, phi, mass, px, py, pz, energy):
+    for i in range(pt.shape[0]):
+        px[i] = pt[i]*np.cos(phi[i])
+        py[i] = pt[i]*np.sin(phi[i])
+        pz[i] = pt[i]*np.sinh(eta[i])
+        energy[i] = np.sqrt(px[i]**2 + py[i]**2 + pz[i]**2 + mass[i]**2)
+
+if numba is not None:
+    _cartesian_compiled = numba.njit(nogil=True)(_cartesian)
+
+def _cartesian_numpy(pt, eta, phi, mass, px, py, pz, energy):
+    np.multiply(pt, np.cos(phi), out=px)
+    np.multiply(pt, np.sin(phi), out=py)
+    np.multiply(pt, np.sinh(eta), out=pz)
+    np.sqrt(px**2 + py**2 + pz**2 + mass**2, out=energy)
+
+def _backend(backend):
+    if backend is None:
+        return "numba" if numba is not None else "numpy"
+    if backend not in ("numba", "numpy"):
+        raise ValueError(f"Unknown kinematics backend {backend}, use numba or numpy")
+    if backend == "numba" and numba is None:
+        raise ImportError("The numba kinematics backend needs numba")
+    return backend
+
+def _content(array):
+    # Flat float64 values of an array with at most one level of nesting (None -> NaN), and its counts
+    counts = None
+    if isinstance(array, np.ndarray):
+        values = array
+    elif array.ndim > 1:
+        counts = ak.num(array, axis=1)
+        values = ak.to_numpy(ak.fill_none(ak.flatten(array, axis=1), np.nan))
+    else:
+        values = ak.to_numpy(ak.fill_none(array, np.nan))
+    return np.ascontiguousarray(values, dtype=np.float64), counts
+
+def to_cartesian(pt, eta, phi, mass, backend=None):
+    '''
+    px, py, pz and energy of four-vectors given as pt, eta, phi and mass: NumPy arrays, or awkward arrays
+    with one entry per event or one list per event (e.g. Jet.pt). The conversion runs on the flat float64
+    values, with a numba kernel or NumPy (backend "numba" or "numpy", default numba if installed), and
+    the results have the structure of pt. Not used by the workflows (only by scripts/benchmark_four_vectors.py).
+    '''
+    pt, counts = _content(pt)
+    eta, phi, mass = (_content(x)[0] for x in (eta, phi, mass))
+    out = [np.empty_like(pt) for _ in range(4)]
+    kernel = _cartesian_compiled if _backend(backend) == "numba" else _cartesian_numpy
+    kernel(pt, eta, phi, mass, *out)
+    if counts is not None:
+        return tuple(ak.unflatten(x, counts) for x in out)
+    return tuple(out)
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(ak.to_numpy(counts), out=offsets[1:])
+    return offsets
+
+def _top_k(offsets, score, k, index, counts):
+    # Insertion of each object into the k best of its event: O(n k) instead of sorting the n objects
+    for i in range(offsets.shape[0] - 1):
+        n = 0
+        out = index[i*k:(i + 1)*k]
+        for j in range(offsets[i + 1] - offsets[i]):
+            value = score[offsets[i] + j]
+            # Objects with the same score keep their order, NaN scores go last
+            pos = n
+            while pos > 0:
+                previous = score[offsets[i] + out[pos - 1]]
+                if not (value > previous or (np.isnan(previous) and not np.isnan(value))):
+                    break
+                pos -= 1
+            if pos >= k:
+                continue
+            for m in range(min(n, k - 1), pos, -1):
+                out[m] = out[m - 1]
+            out[pos] = j
+            n = min(n + 1, k)
+        counts[i] = n
+
+if numba is not None:
+    _top_k_compiled = numba.njit(nogil=True)(_top_k)
+
+def top_k(collection, score, k=2, backend=None):
+    '''
+    The k objects of each event with the highest score (e.g. the b-tagging score of the jets), in
+    decreasing score: the first k objects of collection[ak.argsort(score, ascending=False)], without
+    sorting the whole collection. Objects with the same score keep their order (NaN scores go last with numba).
+    k=None sorts all the objects, as does the numpy backend (a vectorised selection is slower than ak.argsort).
+    '''
+    if k is None or _backend(backend) == "numpy":
+        return collection[ak.argsort(score, axis=1, ascending=False)][:, :k]
+    values, counts = _content(score)
+    index = np.zeros(len(counts)*k, dtype=np.int64)
+    selected = np.empty(len(counts), dtype=np.int64)
+    _top_k_compiled(_offsets(counts), values, k, index, selected)
+    keep = np.arange(k) < selected[:, None]
+    return collection[ak.unflatten(index.reshape(-1, k)[keep], selected)]
+
+def _merge(offsets_a, a, offsets_b, b, index):
+    # Merge of two lists sorted in decreasing order, a first for equal values; False if one is not sorted
+    out = 0
+    for i in range(offsets_a.shape[0] - 1):
+        ia, na = offsets_a[i], offsets_a[i + 1] - offsets_a[i]
+        ib, nb = offsets_b[i], offsets_b[i + 1] - offsets_b[i]
+        for j in range(1, na):
+            if a[ia + j] > a[ia + j - 1]:
+                return False
+        for j in range(1, nb):
+            if b[ib + j] > b[ib + j - 1]:
+                return False
+        ja, jb = 0, 0
+        while ja < na or jb < nb:
+            if jb == nb or (ja < na and a[ia + ja] >= b[ib + jb]):
+                index[out] = ja
+                ja += 1
+            else:
+                index[out] = na + jb
+                jb += 1
+            out += 1
+    return True
+
+if numba is not None:
+    _merge_compiled = numba.njit(nogil=True)(_merge)
+
+def merge_sorted(first, second, key="pt", backend=None):
+    '''
+    Concatenation of two collections of the same events, each sorted by decreasing key (e.g. MuonGood and
+    ElectronGood by pt), in decreasing key: the same as sorting ak.concatenate((first, second), axis=1)
+    with a stable ak.argsort, by merging the two lists of each event. If a collection is not sorted in
+    some event, or without numba, the concatenation is sorted.
+    '''
+    both = ak.concatenate((first, second), axis=1)
+    if _backend(backend) == "numba":
+        a, counts_a = _content(first[key])
+        b, counts_b = _content(second[key])
+        index = np.empty(len(a) + len(b), dtype=np.int64)
+        if _merge_compiled(_offsets(counts_a), a, _offsets(counts_b), b, index):
+            return both[ak.unflatten(index, ak.to_numpy(counts_a) + ak.to_numpy(counts_b))]
+    return both[ak.argsort(both[key], axis=1, ascending=False)]
+
+# Jet tagger scores of the dijet candidates (j1BvsL, j2CvsL, ...) by tagger
+TAGGER_FIELDS = {
+    "PNet":       {"BvsL": "btagPNetB", "CvsL": "btagPNetCvL", "CvsB": "btagPNetCvB"},
+    "DeepFlav":   {"BvsL": "btagDeepFlavB", "CvsL": "btagDeepFlavCvL", "CvsB": "btagDeepFlavCvB"},
+    "RobustParT": {"BvsL": "btagRobustParTAK4B", "CvsL": "btagRobustParTAK4CvL", "CvsB": "btagRobustParTAK4CvB"},
+}
+DIJET_FIELDS = ["pt", "eta", "phi", "mass", "deltaR", "deltaPhi", "deltaEta",
+                "j1Phi", "j2Phi", "j1pt", "j2pt", "j1eta", "j2eta", "j1mass", "j2mass", "lead_pt", "sublead_pt"]
+
+def _dijet(offsets, pt, eta, phi, mass, tags, out):
+    # One pass over the events: the first two jets of each event, 0 (four-vector) or -1 (the rest) without them
+    ntags = tags.shape[0]
+    for i in range(offsets.shape[0] - 1):
+        j1, j2 = offsets[i], offsets[i] + 1
+        if offsets[i + 1] - offsets[i] < 2:
+            out[:4, i] = 0.
+            out[4:, i] = -1.
+            continue
+        px = pt[j1]*np.cos(phi[j1]) + pt[j2]*np.cos(phi[j2])
+        py = pt[j1]*np.sin(phi[j1]) + pt[j2]*np.sin(phi[j2])
+        pz = pt[j1]*np.sinh(eta[j1]) + pt[j2]*np.sinh(eta[j2])
+        energy = (np.sqrt((pt[j1]*np.cosh(eta[j1]))**2 + mass[j1]**2)
+                  + np.sqrt((pt[j2]*np.cosh(eta[j2]))**2 + mass[j2]**2))
+        dphi = (phi[j1] - phi[j2] + np.pi) % (2*np.pi) - np.pi
+        deta = eta[j1] - eta[j2]
+        out[0, i] = np.sqrt(px**2 + py**2)
+        out[1, i] = np.arcsinh(pz/out[0, i])
+        out[2, i] = np.arctan2(py, px)
+        out[3, i] = np.sqrt(max(energy**2 - px**2 - py**2 - pz**2, 0.))
+        out[4, i] = np.sqrt(deta**2 + dphi**2)
+        out[5, i] = abs(dphi)
+        out[6, i] = abs(deta)
+        out[7, i], out[8, i] = phi[j1], phi[j2]
+        out[9, i], out[10, i] = pt[j1], pt[j2]
+        out[11, i], out[12, i] = eta[j1], eta[j2]
+        out[13, i], out[14, i] = mass[j1], mass[j2]
+        out[15, i], out[16, i] = max(pt[j1], pt[j2]), min(pt[j1], pt[j2])
+        for t in range(ntags):
+            out[17 + 2*t, i] = tags[t, j1]
+            out[18 + 2*t, i] = tags[t, j2]
+    return out
+
+if numba is not None:
+    _dijet_compiled = numba.njit(nogil=True)(_dijet)
+
+def _dijet_numpy(offsets, pt, eta, phi, mass, tags, out):
+    # Same as _dijet, vectorised over the events with two jets or more
+    has2 = np.diff(offsets) >= 2
+    j1 = offsets[:-1][has2]
+    j2 = j1 + 1
+    out[:4, ~has2] = 0.
+    out[4:, ~has2] = -1.
+    px = pt[j1]*np.cos(phi[j1]) + pt[j2]*np.cos(phi[j2])
+    py = pt[j1]*np.sin(phi[j1]) + pt[j2]*np.sin(phi[j2])
+    pz = pt[j1]*np.sinh(eta[j1]) + pt[j2]*np.sinh(eta[j2])
+    energy = np.sqrt((pt[j1]*np.cosh(eta[j1]))**2 + mass[j1]**2) + np.sqrt((pt[j2]*np.cosh(eta[j2]))**2 + mass[j2]**2)
+    dphi = (phi[j1] - phi[j2] + np.pi) % (2*np.pi) - np.pi
+    deta = eta[j1] - eta[j2]
+    dijet_pt = np.sqrt(px**2 + py**2)
+    columns = [dijet_pt, np.arcsinh(pz/dijet_pt), np.arctan2(py, px),
+               np.sqrt(np.maximum(energy**2 - px**2 - py**2 - pz**2, 0.)),
+               np.sqrt(deta**2 + dphi**2), np.abs(dphi), np.abs(deta),
+               phi[j1], phi[j2], pt[j1], pt[j2], eta[j1], eta[j2], mass[j1], mass[j2],
+               np.maximum(pt[j1], pt[j2]), np.minimum(pt[j1], pt[j2])]
+    for t in range(tags.shape[0]):
+        columns += [tags[t, j1], tags[t, j2]]
+    for k, column in enumerate(columns):
+        out[k, has2] = column
+    return out
+
+def build_dijet(jets, tags=None, pt_ordered=None, backend=None, dtype=None):
+    '''
+    Dijet candidate of the first two jets of each event, in one pass over the jets: the four-vector sum
+    (pt, eta, phi, mass), deltaR, deltaPhi, deltaEta, and pt, eta, phi and mass of each jet (j1pt, j2pt, ...).
+    tags maps names to jet fields, e.g. {"CvsL": "btagCvL"} (TAGGER_FIELDS[tagger] for a tagger), giving
+    j1CvsL and j2CvsL. pt_ordered, if given, is a pair of names for the larger and smaller pt of the two jets.
+
+    Events with less than two jets get 0 for the four-vector and -1 for the rest, as pocket_coffea's
+    get_dijet. The fields are computed in float64 on the flat jet values (backend "numba" or "numpy",
+    default numba if installed) and returned as a PtEtaPhiMCandidate with the given dtype, by default
+    the dtype of the jet pt.
+    '''
+    tags = dict(tags or {})
+    pt, counts = _content(jets.pt)
+    offsets = _offsets(counts)
+    eta, phi, mass = (_content(jets[field])[0] for field in ("eta", "phi", "mass"))
+    tag_values = np.empty((len(tags), len(pt)))
+    for t, field in enumerate(tags.values()):
+        tag_values[t] = _content(jets[field])[0]
+
+    names = DIJET_FIELDS + [f"j{k}{tag}" for tag in tags for k in (1, 2)]
+    out = np.empty((len(names), len(counts)))
+    kernel = _dijet_compiled if _backend(backend) == "numba" else _dijet_numpy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        kernel(offsets, pt, eta, phi, mass, tag_values, out)
+
+    if dtype is None:
+        dtype = ak.to_numpy(ak.flatten(jets.pt[:1], axis=None)).dtype
+    fields = {name: out[k].astype(dtype) for k, name in enumerate(names)}
+    lead, sublead = fields.pop("lead_pt"), fields.pop("sublead_pt")
+    if pt_ordered is not None:
+        fields[pt_ordered[0]], fields[pt_ordered[1]] = lead, sublead
+    return ak.zip(fields, with_name="PtEtaPhiMCandidate")
+
+def _neutrino_pz(px, py, pz, E2, met_px, met_py, mW):
+    # pz of the neutrino from the W-mass constraint: the smallest of the two solutions,
+    # their real part if they are complex
+    met2 = met_px**2 + met_py**2
+    mu = mW**2/2 + met_px*px + met_py*py
+    a = mu*pz/(E2 - pz**2)
+    discriminant = a**2 - (E2*met2 - mu**2)/(E2 - pz**2)
+    if discriminant < 0:
+        return a
+    root = np.sqrt(discriminant)
+    return a + root if abs(a + root) < abs(a - root) else a - root
+
+if numba is not None:
+    # Plain Python when called from Python, compiled into the numba kernels calling it
+    _neutrino_pz = numba.extending.register_jitable(_neutrino_pz)
+
+def _neutrino_pz_numpy(px, py, pz, E2, met_px, met_py, mW):
+    # Same as _neutrino_pz, vectorised over the events
+    met2 = met_px**2 + met_py**2
+    mu = mW**2/2 + met_px*px + met_py*py
+    a = mu*pz/(E2 - pz**2)
+    discriminant = a**2 - (E2*met2 - mu**2)/(E2 - pz**2)
+    root = np.sqrt(np.maximum(discriminant, 0))
+    pznu = np.where(np.abs(a + root) < np.abs(a - root), a + root, a - root)
+    return np.where(discriminant >= 0, pznu, a)
+
+def _neutrino(lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, mW, eta_out):
+    # One pass per event: W-mass constraint on the neutrino pz, then its pseudorapidity
+    for i in range(lep_pt.shape[0]):
+        px = lep_pt[i]*np.cos(lep_phi[i])
+        py = lep_pt[i]*np.sin(lep_phi[i])
+        pz = lep_pt[i]*np.sinh(lep_eta[i])
+        E2 = lep_mass[i]**2 + (lep_pt[i]*np.cosh(lep_eta[i]))**2
+        met_px = met_pt[i]*np.cos(met_phi[i])
+        met_py = met_pt[i]*np.sin(met_phi[i])
+        pznu = _neutrino_pz(px, py, pz, E2, met_px, met_py, mW)
+        theta = np.arctan2(np.sqrt(met_px**2 + met_py**2), pznu)
+        eta_out[i] = -np.log(np.tan(theta/2))
+    return eta_out
+
+if numba is not None:
+    _neutrino_compiled = numba.njit(nogil=True)(_neutrino)
+
+def _neutrino_numpy(lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, mW, eta_out):
+    # Same as _neutrino, vectorised over the events, without numba
+    px = lep_pt*np.cos(lep_phi)
+    py = lep_pt*np.sin(lep_phi)
+    pz = lep_pt*np.sinh(lep_eta)
+    E2 = lep_mass**2 + (lep_pt*np.cosh(lep_eta))**2
+    met_px = met_pt*np.cos(met_phi)
+    met_py = met_pt*np.sin(met_phi)
+    pznu = _neutrino_pz_numpy(px, py, pz, E2, met_px, met_py, mW)
+    eta_out[:] = -np.log(np.tan(np.arctan2(np.sqrt(met_px**2 + met_py**2), pznu)/2))
+    return eta_out
+
+def neutrino_from_W(lepton, met, mW=W_MASS, backend=None):
+    '''
+    Neutrino four-momentum of a leptonic W decay: the transverse momentum of the MET and the pz solving
+    the W-mass constraint for the lepton, the solution of smallest |pz| (the real part of the solutions
+    if they are complex). The neutrino is massless.
+
+    lepton and met have one entry per event (None for events without one); the result is a
+    PtEtaPhiMCandidate, None where the lepton or the MET is. The kernel runs on the flat float64
+    buffers of the fields and the result has the dtype of the lepton pt; backend is "numba" or "numpy"
+    (default numba if installed).
+    '''
+    lep_pt, met_pt, met_phi = (_content(x)[0] for x in (lepton.pt, met.pt, met.phi))
+    eta = np.empty_like(lep_pt)
+    kernel = _neutrino_compiled if _backend(backend) == "numba" else _neutrino_numpy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        kernel(lep_pt, _content(lepton.eta)[0], _content(lepton.phi)[0], _content(lepton.mass)[0], met_pt, met_phi, mW, eta)
+
+    dtype = ak.to_numpy(ak.flatten(lepton.pt[:1], axis=None)).dtype
+    neutrino = ak.zip({"pt": met_pt.astype(dtype), "eta": eta.astype(dtype),
+                       "phi": met_phi.astype(dtype), "mass": np.zeros(len(eta), dtype=dtype)},
+                      with_name="PtEtaPhiMCandidate")
+    valid = ~(ak.to_numpy(ak.is_none(lepton.pt)) | ak.to_numpy(ak.is_none(met.pt)))
+    return ak.mask(neutrino, valid)
+
+# Fields of the W candidate (one per event) and of the b-jet closest to the lepton and the top candidate
+WLNU_FIELDS = ["W_m", "W_pt", "W_candidate_phi", "W_mt"]
+WLNU_BJET_FIELDS = ["deltaPhi_l1_b", "deltaEta_l1_b", "deltaR_l1_b", "top_mass"]
+
+def _wlnu(lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, offsets, b_pt, b_eta, b_phi, b_mass, b_tags, mW, out, b_out):
+    # One pass over the events: W candidate, b-jet closest to the lepton, neutrino pz and top candidate.
+    # The b-jet fields are NaN without b-jet
+    ntags = b_tags.shape[0]
+    for i in range(lep_pt.shape[0]):
+        px = lep_pt[i]*np.cos(lep_phi[i])
+        py = lep_pt[i]*np.sin(lep_phi[i])
+        pz = lep_pt[i]*np.sinh(lep_eta[i])
+        E2 = lep_mass[i]**2 + (lep_pt[i]*np.cosh(lep_eta[i]))**2
+        met_px = met_pt[i]*np.cos(met_phi[i])
+        met_py = met_pt[i]*np.sin(met_phi[i])
+        # W: lepton + MET (massless, eta 0)
+        W_px, W_py = px + met_px, py + met_py
+        W_E = np.sqrt(E2) + met_pt[i]
+        out[0, i] = np.sqrt(max(W_E**2 - W_px**2 - W_py**2 - pz**2, 0.))
+        out[1, i] = np.sqrt(W_px**2 + W_py**2)
+        out[2, i] = np.arctan2(W_py, W_px)
+        out[3, i] = np.sqrt(2*lep_pt[i]*met_pt[i]*(1 - np.cos(lep_phi[i] - met_phi[i])))
+
+        # b-jet closest to the lepton in deltaR, the first one if several are
+        best, best_dr2 = -1, np.inf
+        for j in range(offsets[i], offsets[i + 1]):
+            dphi = (b_phi[j] - lep_phi[i] + np.pi) % (2*np.pi) - np.pi
+            dr2 = (b_eta[j] - lep_eta[i])**2 + dphi**2
+            if dr2 < best_dr2:
+                best, best_dr2 = j, dr2
+        if best < 0:
+            b_out[:, i] = np.nan
+            continue
+        b_out[0, i] = abs((lep_phi[i] - b_phi[best] + np.pi) % (2*np.pi) - np.pi)
+        b_out[1, i] = abs(lep_eta[i] - b_eta[best])
+        # As the deltaR_l1_b of the models: phi difference not wrapped around
+        b_out[2, i] = np.sqrt((lep_eta[i] - b_eta[best])**2 + (lep_phi[i] - b_phi[best])**2)
+
+        # top: lepton + b-jet + neutrino (massless, pz from the W-mass constraint)
+        pznu = _neutrino_pz(px, py, pz, E2, met_px, met_py, mW)
+        b_px = b_pt[best]*np.cos(b_phi[best])
+        b_py = b_pt[best]*np.sin(b_phi[best])
+        b_pz = b_pt[best]*np.sinh(b_eta[best])
+        b_E = np.sqrt(b_mass[best]**2 + (b_pt[best]*np.cosh(b_eta[best]))**2)
+        t_px, t_py, t_pz = W_px + b_px, W_py + b_py, pz + pznu + b_pz
+        t_E = np.sqrt(E2) + np.sqrt(met_px**2 + met_py**2 + pznu**2) + b_E
+        b_out[3, i] = np.sqrt(max(t_E**2 - t_px**2 - t_py**2 - t_pz**2, 0.))
+        for t in range(ntags):
+            b_out[4 + t, i] = b_tags[t, best]
+    return out, b_out
+
+if numba is not None:
+    _wlnu_compiled = numba.njit(nogil=True)(_wlnu)
+
+def _wlnu_numpy(lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, offsets, b_pt, b_eta, b_phi, b_mass, b_tags, mW, out, b_out):
+    # Same as _wlnu, vectorised over the events and the b-jets
+    px = lep_pt*np.cos(lep_phi)
+    py = lep_pt*np.sin(lep_phi)
+    pz = lep_pt*np.sinh(lep_eta)
+    E2 = lep_mass**2 + (lep_pt*np.cosh(lep_eta))**2
+    met_px = met_pt*np.cos(met_phi)
+    met_py = met_pt*np.sin(met_phi)
+    W_px, W_py = px + met_px, py + met_py
+    W_E = np.sqrt(E2) + met_pt
+    out[0] = np.sqrt(np.maximum(W_E**2 - W_px**2 - W_py**2 - pz**2, 0.))
+    out[1] = np.sqrt(W_px**2 + W_py**2)
+    out[2] = np.arctan2(W_py, W_px)
+    out[3] = np.sqrt(2*lep_pt*met_pt*(1 - np.cos(lep_phi - met_phi)))
+
+    # b-jet closest to the lepton: the first of each event once sorted by event and deltaR (stable)
+    counts = np.diff(offsets)
+    event = np.repeat(np.arange(len(counts)), counts)
+    dphi = (b_phi - lep_phi[event] + np.pi) % (2*np.pi) - np.pi
+    dr2 = (b_eta - lep_eta[event])**2 + dphi**2
+    has_b = counts > 0
+    best = np.lexsort((dr2, event))[offsets[:-1][has_b]]
+    i = np.flatnonzero(has_b)
+    b_out[:, ~has_b] = np.nan
+    b_out[0, i] = np.abs((lep_phi[i] - b_phi[best] + np.pi) % (2*np.pi) - np.pi)
+    b_out[1, i] = np.abs(lep_eta[i] - b_eta[best])
+    b_out[2, i] = np.sqrt((lep_eta[i] - b_eta[best])**2 + (lep_phi[i] - b_phi[best])**2)
+
+    pznu = _neutrino_pz_numpy(px[i], py[i], pz[i], E2[i], met_px[i], met_py[i], mW)
+    b_E = np.sqrt(b_mass[best]**2 + (b_pt[best]*np.cosh(b_eta[best]))**2)
+    t_px = W_px[i] + b_pt[best]*np.cos(b_phi[best])
+    t_py = W_py[i] + b_pt[best]*np.sin(b_phi[best])
+    t_pz = pz[i] + pznu + b_pt[best]*np.sinh(b_eta[best])
+    t_E = np.sqrt(E2[i]) + np.sqrt(met_px[i]**2 + met_py[i]**2 + pznu**2) + b_E
+    b_out[3, i] = np.sqrt(np.maximum(t_E**2 - t_px**2 - t_py**2 - t_pz**2, 0.))
+    for t in range(b_tags.shape[0]):
+        b_out[4 + t, i] = b_tags[t, best]
+    return out, b_out
+
+def wlnu_candidates(lepton, met, bjets, tags=None, mW=W_MASS, backend=None, dtype=None):
+    '''
+    Kinematics of the WLNu channel in one pass over the leptons, the MET and the b-jets: the W candidate
+    (lepton + MET) W_m, W_pt, W_candidate_phi and W_mt, and for the b-jet closest to the lepton
+    deltaPhi_l1_b, deltaEta_l1_b, deltaR_l1_b, the mass of the top candidate (lepton + b-jet + neutrino,
+    as neutrino_from_W) top_mass, and the b-jet fields of tags, e.g. {"b_CvsL": "btagCvL"}.
+
+    lepton and met have one entry per event, bjets one list per event. The b-jet fields are lists of one
+    entry, None without b-jet, as for a b-jet picked with argmin(keepdims=True). All the fields are None
+    where the lepton or the MET is. The kernel runs on the flat float64 values (backend "numba" or
+    "numpy", default numba if installed) and the fields have the given dtype, by default the dtype of
+    the lepton pt.
+    '''
+    tags = dict(tags or {})
+    lep_pt, met_pt, met_phi = (_content(x)[0] for x in (lepton.pt, met.pt, met.phi))
+    b_pt, counts = _content(bjets.pt)
+    offsets = _offsets(counts)
+    b_tags = np.empty((len(tags), len(b_pt)))
+    for t, field in enumerate(tags.values()):
+        b_tags[t] = _content(bjets[field])[0]
+    out = np.empty((len(WLNU_FIELDS), len(lep_pt)))
+    b_out = np.empty((len(WLNU_BJET_FIELDS) + len(tags), len(lep_pt)))
+    kernel = _wlnu_compiled if _backend(backend) == "numba" else _wlnu_numpy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        kernel(lep_pt, _content(lepton.eta)[0], _content(lepton.phi)[0], _content(lepton.mass)[0], met_pt, met_phi,
+               offsets, b_pt, *(_content(bjets[field])[0] for field in ("eta", "phi", "mass")), b_tags, mW, out, b_out)
+
+    if dtype is None:
+        dtype = ak.to_numpy(ak.flatten(lepton.pt[:1], axis=None)).dtype
+    fields = {name: out[k].astype(dtype) for k, name in enumerate(WLNU_FIELDS)}
+    has_b = ak.to_numpy(counts) > 0
+    one = np.ones(len(lep_pt), dtype=np.int64)
+    for k, name in enumerate(WLNU_BJET_FIELDS + list(tags)):
+        fields[name] = ak.unflatten(ak.mask(b_out[k].astype(dtype), has_b), one)
+    valid = ~(ak.to_numpy(ak.is_none(lepton.pt)) | ak.to_numpy(ak.is_none(met.pt)))
+    return ak.mask(ak.zip(fields, depth_limit=1), valid)
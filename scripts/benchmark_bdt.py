@@ -0,0 +1,83 @@
+'''
+Parity check and throughput benchmark of the LightGBM-free BDT evaluator (MVA/lgbm_inference.py)
+against lightgbm.Booster.predict, for each LightGBM text model given on the command line.
+
+Inputs are sampled uniformly inside the feature ranges stored in the model file, with a fraction
+of NaN and zero values to exercise the missing value handling. The reference path reproduces the
+one used in the workflows: columns -> pandas DataFrame -> Booster.predict.
+'''
+import os, sys, glob, time
+import argparse
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MVA.lgbm_inference import LightGBMTrees, numba
+
+def feature_ranges(model_file):
+    with open(model_file) as f:
+        for line in f:
+            if line.startswith("feature_infos="):
+                ranges = []
+                for info in line.strip().split("=", 1)[1].split():
+                    if info.startswith("["):
+                        low, high = info[1:-1].split(":")
+                        ranges.append((float(low), float(high)))
+                    else:
+                        ranges.append((0., 1.))
+                return ranges
+    return None
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the compiled BDT evaluator with lightgbm.Booster")
+    parser.add_argument("models", nargs="*", default=sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../MVA/BDT_models/*.txt"))), help="LightGBM text models (default: MVA/BDT_models/*.txt)")
+    parser.add_argument("-n", "--nevents", type=int, default=300000, help="Number of events per model (default: chunksize of run_options.yaml)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of timed repetitions, the fastest is reported")
+    parser.add_argument("--nan-fraction", type=float, default=0.02, help="Fraction of inputs set to NaN")
+    parser.add_argument("--zero-fraction", type=float, default=0.02, help="Fraction of inputs set to zero")
+    parser.add_argument("--tolerance", type=float, default=1e-9, help="Maximum allowed absolute score difference")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    backends = ["numba", "numpy"] if numba is not None else ["numpy"]
+    failed = False
+
+    print(f"{'model':<55} {'trees':>6} {'backend':>8} {'max|diff|':>10} {'Booster [ms]':>13} {'new [ms]':>9} {'speedup':>8}")
+    for model_file in args.models:
+        name = os.path.basename(model_file)
+        try:
+            model = LightGBMTrees.from_file(model_file)
+        except (ValueError, NotImplementedError) as e:
+            print(f"{name:<55} skipped: {e}")
+            continue
+        booster = lgb.Booster(model_file=model_file)
+
+        ranges = feature_ranges(model_file)
+        low, high = np.array(ranges).T
+        X = low + (high - low)*rng.random((args.nevents, model.num_feature()))
+        X[rng.random(X.shape) < args.nan_fraction] = np.nan
+        X[rng.random(X.shape) < args.zero_fraction] = 0.
+        columns = {feature: X[:, i] for i, feature in enumerate(model.feature_names)}
+
+        t_ref, reference = timeit(lambda: booster.predict(pd.DataFrame(columns)), args.repeat)
+        for backend in backends:
+            model.predict(X[:10], backend=backend)  # compile outside of the timing
+            t_new, scores = timeit(lambda: model.predict(columns, backend=backend), args.repeat)
+            diff = np.max(np.abs(scores - reference))
+            failed |= not diff <= args.tolerance
+            print(f"{name:<55} {model.num_trees():>6} {backend:>8} {diff:>10.2e} {1e3*t_ref:>13.1f} {1e3*t_new:>9.1f} {t_ref/t_new:>7.1f}x")
+
+    if failed:
+        print(f"Parity check FAILED: differences above {args.tolerance}")
+        sys.exit(1)
+    print("Parity check passed")
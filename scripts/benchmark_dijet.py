@@ -0,0 +1,129 @@
+'''
+Parity check and benchmark of the dijet candidate kernel (kinematics.build_dijet, numba and NumPy
+backends) against the awkward implementation the VHbb workflow used before (get_dibjet, copied below),
+on jets sorted by their b-tagging score as for dijet_bsort.
+
+Jets are sampled as float32 with a Poisson multiplicity, so that some events have less than two jets.
+All the fields of the candidate are compared.
+'''
+import os, sys, time
+import argparse
+import numpy as np
+import awkward as ak
+from coffea.nanoevents.methods import candidate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from kinematics import build_dijet, TAGGER_FIELDS, numba
+
+def get_dibjet(jets, tagger = 'PNet'):
+
+    fields = {
+        "pt": 0.,
+        "eta": 0.,
+        "phi": 0.,
+        "mass": 0.,
+    }
+
+    jets = ak.pad_none(jets, 2)
+    njet = ak.num(jets[~ak.is_none(jets, axis=1)])
+
+    dijet = jets[:, 0] + jets[:, 1]
+
+    for var in fields.keys():
+        fields[var] = ak.where(
+            (njet >= 2),
+            getattr(dijet, var),
+            fields[var]
+        )
+
+    fields["deltaR"] = ak.where( (njet >= 2), jets[:,0].delta_r(jets[:,1]), -1)
+    fields["deltaPhi"] = ak.where( (njet >= 2), abs(jets[:,0].delta_phi(jets[:,1])), -1)
+    fields["deltaEta"] = ak.where( (njet >= 2), abs(jets[:,0].eta - jets[:,1].eta), -1)
+    fields["j1Phi"] = ak.where( (njet >= 2), jets[:,0].phi, -1)
+    fields["j2Phi"] = ak.where( (njet >= 2), jets[:,1].phi, -1)
+    fields["j1pt"] = ak.where( (njet >= 2), jets[:,0].pt, -1)
+    fields["j2pt"] = ak.where( (njet >= 2), jets[:,1].pt, -1)
+    fields["j1mass"] = ak.where( (njet >= 2), jets[:,0].mass, -1)
+    fields["j2mass"] = ak.where( (njet >= 2), jets[:,1].mass, -1)
+
+    BvL, CvL, CvB = (TAGGER_FIELDS[tagger][tag] for tag in ("BvsL", "CvsL", "CvsB"))
+    fields["j1BvsL"] = ak.where( (njet >= 2), jets[:,0][BvL], -1)
+    fields["j2BvsL"] = ak.where( (njet >= 2), jets[:,1][BvL], -1)
+    fields["j1CvsL"] = ak.where( (njet >= 2), jets[:,0][CvL], -1)
+    fields["j2CvsL"] = ak.where( (njet >= 2), jets[:,1][CvL], -1)
+    fields["j1CvsB"] = ak.where( (njet >= 2), jets[:,0][CvB], -1)
+    fields["j2CvsB"] = ak.where( (njet >= 2), jets[:,1][CvB], -1)
+
+    # Lead b-jet pt: larger of the first two jets' pt
+    fields["leadb_pt"] = ak.where( njet >= 2, ak.max(ak.Array([jets[:, 0].pt, jets[:, 1].pt]), axis=0), -1)
+
+    # Sublead b-jet pt: smaller of the first two jets' pt
+    fields["subleadb_pt"] = ak.where(njet >= 2, ak.min(ak.Array([jets[:, 0].pt, jets[:, 1].pt]), axis=0), -1)
+
+    dibjet = ak.zip(fields, with_name="PtEtaPhiMCandidate")
+    return dibjet
+
+def sample(nevents, multiplicity, tagger, rng, dtype):
+    counts = rng.poisson(multiplicity, nevents)
+    n = counts.sum()
+    jets = {
+        "pt": 20 + rng.exponential(40, n),
+        "eta": rng.uniform(-2.5, 2.5, n),
+        "phi": rng.uniform(-np.pi, np.pi, n),
+        "mass": rng.exponential(8, n),
+        "charge": np.zeros(n),
+    }
+    jets.update({field: rng.random(n) for field in TAGGER_FIELDS[tagger].values()})
+    jets = ak.zip({k: ak.unflatten(v.astype(dtype), counts) for k, v in jets.items()},
+                  with_name="PtEtaPhiMCandidate", behavior=candidate.behavior)
+    return jets[ak.argsort(jets[TAGGER_FIELDS[tagger]["BvsL"]], axis=1, ascending=False)]
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the dijet candidate kernel with the awkward get_dibjet")
+    parser.add_argument("-n", "--nevents", type=int, default=300000, help="Number of events (default: chunksize of run_options.yaml)")
+    parser.add_argument("-m", "--multiplicity", type=float, default=3., help="Mean number of jets per event")
+    parser.add_argument("--tagger", type=str, default="PNet", choices=list(TAGGER_FIELDS))
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of timed repetitions, the fastest is reported")
+    parser.add_argument("--tolerance", type=float, default=1e-9, help="Maximum allowed difference, relative to the value")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    jets32 = sample(args.nevents, args.multiplicity, args.tagger, rng, np.float32)
+    jets64 = ak.values_astype(jets32, np.float64)
+    options = dict(tags=TAGGER_FIELDS[args.tagger], pt_ordered=("leadb_pt", "subleadb_pt"))
+
+    reference = get_dibjet(jets64, args.tagger)
+    t_ref, _ = timeit(lambda: get_dibjet(jets32, args.tagger), args.repeat)
+    backends = ["numba", "numpy"] if numba is not None else ["numpy"]
+
+    print(f"{args.nevents} events, {ak.sum(ak.num(jets32) < 2)} with less than two jets")
+    print(f"{'backend':>8} {'max rel diff':>13} {'worst field':>12} {'missing':>8} {'awkward [ms]':>13} {'new [ms]':>9} {'speedup':>8}")
+    failed = False
+    for backend in backends:
+        build_dijet(jets32[:10], backend=backend, **options)  # compile outside of the timing
+        t_new, _ = timeit(lambda: build_dijet(jets32, backend=backend, **options), args.repeat)
+        new = build_dijet(jets64, backend=backend, **options)
+        missing = [field for field in reference.fields if field not in new.fields]
+        diffs = {}
+        for field in reference.fields:
+            if field in missing:
+                continue
+            x, y = ak.to_numpy(new[field]), ak.to_numpy(reference[field])
+            diffs[field] = np.max(np.abs(x - y)/np.maximum(np.abs(y), 1.))
+        worst = max(diffs, key=diffs.get)
+        failed |= not (diffs[worst] <= args.tolerance and not missing)
+        print(f"{backend:>8} {diffs[worst]:>13.2e} {worst:>12} {len(missing):>8} {1e3*t_ref:>13.1f} {1e3*t_new:>9.1f} {t_ref/t_new:>7.1f}x")
+
+    if failed:
+        print(f"Parity check FAILED: differences above {args.tolerance} or missing fields")
+        sys.exit(1)
+    print("Parity check passed")
@@ -0,0 +1,72 @@
+'''
+Parity check and benchmark of the pt, eta, phi, mass -> px, py, pz, energy conversion of kinematics.py
+(to_cartesian, numba and NumPy backends) against awkward array arithmetic on the jagged arrays.
+
+Jets are sampled with a Poisson multiplicity and falling pt spectrum, as float32 like the NanoAOD
+branches. The backends run on the flat float64 values and give back jagged arrays.
+'''
+import os, sys, time
+import argparse
+import numpy as np
+import awkward as ak
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from kinematics import to_cartesian, numba
+
+def reference(pt, eta, phi, mass):
+    px = pt * np.cos(phi)
+    py = pt * np.sin(phi)
+    pz = pt * np.sinh(eta)
+    return px, py, pz, np.sqrt(px**2 + py**2 + pz**2 + mass**2)
+
+def sample(nevents, multiplicity, rng):
+    counts = rng.poisson(multiplicity, nevents)
+    n = counts.sum()
+    jets = {
+        "pt": 20 + rng.exponential(40, n),
+        "eta": rng.uniform(-2.5, 2.5, n),
+        "phi": rng.uniform(-np.pi, np.pi, n),
+        "mass": rng.exponential(8, n),
+    }
+    return {k: ak.unflatten(v.astype(np.float32), counts) for k, v in jets.items()}
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the compiled four-vector conversion with awkward arithmetic")
+    parser.add_argument("-n", "--nevents", type=int, default=300000, help="Number of events (default: chunksize of run_options.yaml)")
+    parser.add_argument("-m", "--multiplicity", type=float, default=5., help="Mean number of jets per event")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of timed repetitions, the fastest is reported")
+    parser.add_argument("--tolerance", type=float, default=1e-9, help="Maximum allowed relative difference")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    jets = sample(args.nevents, args.multiplicity, rng)
+    jets64 = {k: ak.values_astype(v, np.float64) for k, v in jets.items()}
+    expected = [ak.to_numpy(ak.flatten(x)) for x in reference(**jets64)]
+    t_ref, _ = timeit(lambda: reference(**jets), args.repeat)
+    backends = ["numba", "numpy"] if numba is not None else ["numpy"]
+
+    print(f"{args.nevents} events, {len(expected[0])} jets")
+    print(f"{'backend':>8} {'max rel diff':>13} {'awkward [ms]':>13} {'new [ms]':>9} {'speedup':>8}")
+    failed = False
+    for backend in backends:
+        to_cartesian(*(x[:10] for x in jets.values()), backend=backend)  # compile outside of the timing
+        t_new, result = timeit(lambda: to_cartesian(**jets, backend=backend), args.repeat)
+        same_counts = all(np.array_equal(ak.to_numpy(ak.num(x)), ak.to_numpy(ak.num(jets["pt"]))) for x in result)
+        result = to_cartesian(**jets64, backend=backend)
+        diff = max(np.max(np.abs(ak.to_numpy(ak.flatten(x)) - y)/np.maximum(np.abs(y), 1e-9)) for x, y in zip(result, expected))
+        failed |= not (diff <= args.tolerance and same_counts)
+        print(f"{backend:>8} {diff:>13.2e} {1e3*t_ref:>13.1f} {1e3*t_new:>9.1f} {t_ref/t_new:>7.1f}x")
+
+    if failed:
+        print(f"Parity check FAILED: differences above {args.tolerance} or different jet counts")
+        sys.exit(1)
+    print("Parity check passed")
@@ -0,0 +1,59 @@
+'''
+CPU benchmark of the GNN inference: eager GraphAttentionClassifier vs the frozen TorchScript
+export (MVA/gnn_inference.py) used by the workflows, for the ZLL, WLNu and ZNuNu input shapes.
+Reports events/s for each mode and thread count, and the maximum score difference.
+'''
+import os, sys, time
+import argparse
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MVA.model_registry import load_gnn
+from MVA.gnn_inference import example_inputs, export_gnn, CHANNELS
+
+def run(model, inputs, batch_size):
+    scores = []
+    with torch.inference_mode():
+        for start in range(0, len(inputs[0]), batch_size):
+            scores.append(model(*[t[start:start + batch_size] for t in inputs])[:, 0])
+    return torch.cat(scores)
+
+def events_per_second(model, inputs, batch_size, repeat):
+    run(model, inputs, batch_size)  # warm up (profiling runs of the TorchScript executor)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(model, inputs, batch_size)
+        times.append(time.perf_counter() - start)
+    return len(inputs[0])/min(times)
+
+if __name__ == "__main__":
+    modeldir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../MVA/GNN_models/Global")
+    parser = argparse.ArgumentParser(description="Benchmark eager vs exported GNN inference on CPU")
+    parser.add_argument("--model-file", type=str, default=f"{modeldir}/gnn.pt", help="GNN state dict")
+    parser.add_argument("--params-file", type=str, default=f"{modeldir}/modelparams.pkl", help="GNN hyperparameters")
+    parser.add_argument("-n", "--nevents", type=int, default=32768, help="Number of events per channel")
+    parser.add_argument("-b", "--batch-size", type=int, default=8192, help="Inference batch size")
+    parser.add_argument("-t", "--threads", type=int, nargs="+", default=[1], help="Intra-op thread counts to test")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of timed repetitions, the fastest is reported")
+    parser.add_argument("-c", "--channels", nargs="+", default=list(CHANNELS), choices=list(CHANNELS))
+    parser.add_argument("--save", type=str, default=None, help="Also save the exported model to this file (torch.jit.load-able)")
+    args = parser.parse_args()
+
+    eager = load_gnn(args.model_file, args.params_file)
+    start = time.perf_counter()
+    exported = export_gnn(eager)
+    print(f"Export took {time.perf_counter() - start:.1f} s")
+    if args.save:
+        torch.jit.save(exported, args.save)
+        print(f"Exported model saved in {args.save}")
+
+    print(f"{'channel':<8} {'threads':>7} {'eager [ev/s]':>13} {'exported [ev/s]':>16} {'speedup':>8} {'max|diff|':>10}")
+    for channel in args.channels:
+        inputs = example_inputs(args.nevents, channel)
+        diff = (run(eager, inputs, args.batch_size) - run(exported, inputs, args.batch_size)).abs().max().item()
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            rate_eager = events_per_second(eager, inputs, args.batch_size, args.repeat)
+            rate_exported = events_per_second(exported, inputs, args.batch_size, args.repeat)
+            print(f"{channel:<8} {threads:>7} {rate_eager:>13.0f} {rate_exported:>16.0f} {rate_exported/rate_eager:>7.2f}x {diff:>10.2e}")
@@ -0,0 +1,109 @@
+'''
+Memory and load time of the MVA models in several worker processes running at the same time,
+with the weights loaded in each process or memory-mapped from the shared store files (MVA/model_store.py).
+
+Each process loads all the models, then the proportional set size (PSS, shared pages divided among
+the processes that map them) and the resident set size are read from /proc once all processes are
+loaded. The scores of the stored models are also compared with the ones of the original models.
+'''
+import os, sys, json, glob, tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+WORKER = '''
+import sys, time, json
+sys.path.insert(0, {repo!r})
+import numpy as np
+from MVA.model_registry import load_bdt, load_dnn, load_gnn
+# Import the backends first, so that only the models are measured
+import h5py, MVA.lgbm_inference, MVA.dnn_inference, MVA.model_store
+if {gnns!r}:
+    import MVA.gnnmodels, MVA.gnn_inference
+
+def memory():
+    out = {{}}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, *value = line.split()
+            if key in ("Rss:", "Pss:"):
+                out[key[:-1]] = int(value[0])/1024
+    return out
+
+before = memory()
+start = time.perf_counter()
+models = [load_bdt(f, store_dir={store_dir!r}) for f in {bdts!r}]
+models += [load_dnn(f, store_dir={store_dir!r}) for f in {dnns!r}]
+models += [load_gnn(*f, store_dir={store_dir!r}) for f in {gnns!r}]
+elapsed = time.perf_counter() - start
+print("ready", flush=True)
+sys.stdin.readline()
+after = memory()
+print(json.dumps({{"time": elapsed, "rss": after["Rss"] - before["Rss"], "pss": after["Pss"] - before["Pss"]}}), flush=True)
+'''
+
+def run_workers(nproc, repo, store_dir, models):
+    code = WORKER.format(repo=repo, store_dir=store_dir, **models)
+    procs = [subprocess.Popen([sys.executable, "-c", code], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True) for _ in range(nproc)]
+    for p in procs:
+        if p.stdout.readline().strip() != "ready":
+            raise RuntimeError("A worker failed to load the models")
+    results = []
+    for p in procs:
+        p.stdin.write("\n")
+        p.stdin.flush()
+    for p in procs:
+        results.append(json.loads(p.stdout.readline()))
+        p.wait()
+    return results
+
+def check_parity(models, store_dir, nevents=10000):
+    import numpy as np
+    from MVA.model_registry import load_bdt, load_dnn, load_gnn
+    rng = np.random.default_rng(0)
+    diff = 0.
+    for f in models["bdts"]:
+        ref, stored = load_bdt(f), load_bdt(f, store_dir=store_dir)
+        X = rng.normal(size=(nevents, ref.num_feature()))
+        diff = max(diff, np.max(np.abs(ref.predict(X) - stored.predict(X))))
+    for f in models["dnns"]:
+        ref, stored = load_dnn(f), load_dnn(f, store_dir=store_dir)
+        X = rng.normal(size=(nevents, ref.num_inputs())).astype(np.float32)
+        diff = max(diff, np.max(np.abs(ref.predict(X) - stored.predict(X))))
+    for f in models["gnns"]:
+        import torch
+        from MVA.gnn_inference import example_inputs
+        ref, stored = load_gnn(*f), load_gnn(*f, store_dir=store_dir)
+        inputs = example_inputs(nevents)
+        with torch.inference_mode():
+            diff = max(diff, (ref(*inputs) - stored(*inputs)).abs().max().item())
+    return diff
+
+if __name__ == "__main__":
+    repo = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    parser = argparse.ArgumentParser(description="Compare per-process memory of the MVA models with and without the shared model store")
+    parser.add_argument("-j", "--nproc", type=int, default=4, help="Number of worker processes")
+    parser.add_argument("--store-dir", type=str, default=None, help="Store folder (default: a temporary folder)")
+    parser.add_argument("--no-gnn", action="store_true", help="Do not load the GNN (no torch needed)")
+    args = parser.parse_args()
+
+    models = {
+        "bdts": [f for f in sorted(glob.glob(f"{repo}/MVA/BDT_models/*.txt")) if not f.endswith("file.txt")],
+        "dnns": sorted(glob.glob(f"{repo}/MVA/DNN_models/*.h5")),
+        "gnns": [] if args.no_gnn else [(f"{repo}/MVA/GNN_models/Global/gnn.pt", f"{repo}/MVA/GNN_models/Global/modelparams.pkl")],
+    }
+    print(f"{len(models['bdts'])} BDTs, {len(models['dnns'])} DNNs, {len(models['gnns'])} GNNs, {args.nproc} processes")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store_dir = args.store_dir if args.store_dir else tmpdir
+        # Write the store files once, as the first worker of a node would
+        run_workers(1, repo, store_dir, models)
+
+        print(f"{'mode':<10} {'load [s]':>9} {'RSS [MB]':>9} {'PSS [MB]':>9}")
+        for mode, directory in (("private", None), ("store", store_dir)):
+            results = run_workers(args.nproc, repo, directory, models)
+            mean = {k: sum(r[k] for r in results)/len(results) for k in ("time", "rss", "pss")}
+            print(f"{mode:<10} {mean['time']:>9.2f} {mean['rss']:>9.1f} {mean['pss']:>9.1f}")
+
+        print(f"max|diff| of the scores, stored vs original models: {check_parity(models, store_dir):.2e}")
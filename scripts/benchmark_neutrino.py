@@ -0,0 +1,119 @@
+'''
+Parity check and micro-benchmark of the compiled neutrino reconstruction (kinematics.neutrino_from_W)
+against the awkward implementation the workflows used before (get_nu_4momentum, copied below).
+
+Leptons and MET are sampled with WLNu-like spectra, with a fraction of events without a lepton (None),
+as lead_lep = ak.firsts(LeptonGood). The reference is evaluated on float64 inputs for the parity check,
+and timed on the float32 inputs of NanoAOD as in the workflows.
+'''
+import os, sys, time
+import argparse
+import numpy as np
+import awkward as ak
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from kinematics import neutrino_from_W, numba
+
+def get_nu_4momentum(Lepton, PuppiMET):
+    mW = 80.38
+
+    # Convert pt, eta, phi, m to px, py, pz, E
+    px = Lepton.pt * np.cos(Lepton.phi)
+    py = Lepton.pt * np.sin(Lepton.phi)
+    pz = Lepton.pt * np.sinh(Lepton.eta)
+    E = np.sqrt(Lepton.mass**2 + Lepton.pt**2 * np.cosh(Lepton.eta)**2)
+
+    MET_px = PuppiMET.pt * np.cos(PuppiMET.phi)
+    MET_py = PuppiMET.pt * np.sin(PuppiMET.phi)
+
+    MisET2 = (MET_px**2 + MET_py**2)
+    mu = (mW**2) / 2 + MET_px * px + MET_py * py
+    a = (mu * pz) / (E**2 - pz**2)
+    a2 = a**2
+    b = ((E**2) * (MisET2) - mu**2) / (E**2 - pz**2)
+
+    condition = a2 - b >= 0
+
+    # Vectorized handling of conditions
+    root = np.sqrt(ak.where(condition, a2 - b, ak.zeros_like(a2)))
+    pz1 = a + root
+    pz2 = a - root
+    pznu = ak.where(np.abs(pz1) < np.abs(pz2), pz1, pz2)
+    Enu = np.sqrt(MisET2 + pznu**2)
+
+    # Handle cases where condition is False using your fallback logic
+    # Adapted to take into account the real parts of the roots if discriminant is negative
+    real_part = ak.where(condition, ak.zeros_like(a), a)  # Use 'a' as the real part when condition is False
+    pznu = ak.where(condition, pznu, real_part)  # Update pznu to use real_part when condition is False
+    Enu = np.sqrt(MisET2 + pznu**2)  # Recalculate Enu with the updated pznu
+
+    p4nu_rec = ak.Array([MET_px, MET_py, pznu, Enu])
+    pt = np.sqrt(MET_px**2 + MET_py**2)
+    phi = np.arctan2(MET_py, MET_px)
+    theta = np.arctan2(pt, pznu)
+    eta = -np.log(np.tan(theta / 2))
+    m = np.sqrt(np.maximum(Enu**2 - (MET_px**2 + MET_py**2 + pznu**2), 0))
+
+    return ak.zip({"pt": pt, "eta": eta, "phi": phi, "mass": m},with_name="PtEtaPhiMCandidate")
+
+def sample(nevents, missing, rng, dtype):
+    leptons = {
+        "pt": 25 + rng.exponential(30, nevents),
+        "eta": rng.uniform(-2.5, 2.5, nevents),
+        "phi": rng.uniform(-np.pi, np.pi, nevents),
+        "mass": np.where(rng.random(nevents) < 0.5, 0.000511, 0.10566),
+    }
+    met = {"pt": rng.exponential(40, nevents), "phi": rng.uniform(-np.pi, np.pi, nevents)}
+    counts = (rng.random(nevents) >= missing).astype(np.int64)
+    lepton = ak.zip({k: ak.unflatten(v[counts == 1].astype(dtype), counts) for k, v in leptons.items()})
+    return ak.firsts(lepton), ak.zip({k: v.astype(dtype) for k, v in met.items()})
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def max_diff(a, b):
+    a, b = ak.to_numpy(ak.fill_none(a, 0.)), ak.to_numpy(ak.fill_none(b, 0.))
+    with np.errstate(invalid="ignore"):
+        return np.nanmax(np.abs(a - b))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the compiled neutrino reconstruction with the awkward one")
+    parser.add_argument("-n", "--nevents", type=int, default=300000, help="Number of events (default: chunksize of run_options.yaml)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of timed repetitions, the fastest is reported")
+    parser.add_argument("--missing", type=float, default=0.05, help="Fraction of events without a lepton")
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="Maximum allowed absolute difference of pt, eta and phi")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    lepton64, met64 = sample(args.nevents, args.missing, rng, np.float64)
+    lepton32, met32 = ak.values_astype(lepton64, np.float32), ak.values_astype(met64, np.float32)
+    backends = ["numba", "numpy"] if numba is not None else ["numpy"]
+
+    reference = get_nu_4momentum(lepton64, met64)
+    t_ref, _ = timeit(lambda: get_nu_4momentum(lepton32, met32), args.repeat)
+    # The reference mass is only the rounding of E^2 - p^2, the new one is 0
+    print(f"{args.nevents} events, reference mass up to {ak.max(reference.mass):.2e} GeV")
+    print(f"{'backend':>8} {'max|dpt|':>10} {'max|deta|':>10} {'max|dphi|':>10} {'None ok':>8} {'awkward [ms]':>13} {'new [ms]':>9} {'speedup':>8}")
+    failed = False
+    for backend in backends:
+        neutrino_from_W(lepton32[:10], met32[:10], backend=backend)  # compile outside of the timing
+        new = neutrino_from_W(lepton64, met64, backend=backend)
+        # The reference pt and phi are defined without a lepton, the new neutrino is None
+        valid = ~ak.to_numpy(ak.is_none(new))
+        diffs = [max_diff(new[f][valid], reference[f][valid]) for f in ("pt", "eta", "phi")]
+        none_ok = np.array_equal(~valid, ak.to_numpy(ak.is_none(reference.eta)))
+        failed |= not (max(diffs) <= args.tolerance and none_ok)
+        t_new, _ = timeit(lambda: neutrino_from_W(lepton32, met32, backend=backend), args.repeat)
+        print(f"{backend:>8} {diffs[0]:>10.2e} {diffs[1]:>10.2e} {diffs[2]:>10.2e} {str(none_ok):>8} "
+              f"{1e3*t_ref:>13.1f} {1e3*t_new:>9.1f} {t_ref/t_new:>7.1f}x")
+
+    if failed:
+        print(f"Parity check FAILED: differences above {args.tolerance}")
+        sys.exit(1)
+    print("Parity check passed")
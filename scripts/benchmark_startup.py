@@ -0,0 +1,94 @@
+'''
+Measure the config-load and worker-startup cost of the analysis modules, each in a fresh interpreter.
+
+- config load: time to import a cfg_*.py (what `runner --cfg` does before the first chunk)
+- worker startup: time to unpickle the processor class shipped by value with cloudpickle,
+  in an interpreter where the analysis directory is not importable (as on a dask/condor worker)
+
+For each step the heavy frameworks that ended up imported are listed. To compare before/after
+a change, run the script on two checkouts, e.g. `git worktree add /tmp/before <commit>` and
+`--repo /tmp/before`.
+'''
+import os, sys, json, glob, tempfile
+import argparse
+import subprocess
+
+HEAVY = ["torch", "tensorflow", "keras", "lightgbm", "sklearn", "imblearn", "matplotlib", "optuna", "numba", "h5py"]
+
+CONFIG_LOAD = '''
+import sys, time, json
+sys.path.insert(0, {repo!r})
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+CLIENT = '''
+import sys, cloudpickle
+sys.path.insert(0, {repo!r})
+import MVA, CommonSelectors, {workflow}
+for module in (MVA, CommonSelectors, {workflow}):
+    cloudpickle.register_pickle_by_value(module)
+with open({outfile!r}, "wb") as f:
+    f.write(cloudpickle.dumps({workflow}.{processor}))
+'''
+
+WORKER = '''
+import sys, time, json
+start = time.perf_counter()
+import cloudpickle
+with open({outfile!r}, "rb") as f:
+    processor = cloudpickle.loads(f.read())
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+def run(code, cwd):
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    return json.loads(result.stdout.strip().splitlines()[-1]), None
+
+def best_of(code, cwd, repeat):
+    results = []
+    for _ in range(repeat):
+        result, error = run(code, cwd)
+        if error:
+            return None, error
+        results.append(result)
+    return min(results, key=lambda r: r["time"]), None
+
+def report(name, result, error):
+    if error:
+        print(f"{name:<32} {'failed':>8}  {error}")
+    else:
+        print(f"{name:<32} {result['time']:>8.2f}  {', '.join(result['heavy']) or '-'}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure config-load and worker-startup time")
+    parser.add_argument("--repo", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."), help="Analysis checkout to measure (default: this one)")
+    parser.add_argument("-c", "--cfg", nargs="+", default=None, help="Config files to load (default: all cfg_*.py)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of measurements per step, the fastest is reported")
+    args = parser.parse_args()
+
+    repo = os.path.abspath(args.repo)
+    cfgs = args.cfg if args.cfg else sorted(glob.glob(f"{repo}/cfg_*.py"))
+
+    print(f"{'config load':<32} {'time [s]':>8}  heavy modules imported")
+    for cfg in cfgs:
+        module = os.path.basename(cfg).replace(".py", "")
+        report(module, *best_of(CONFIG_LOAD.format(repo=repo, module=module, heavy=HEAVY), repo, args.repeat))
+
+    print(f"\n{'worker startup':<32} {'time [s]':>8}  heavy modules imported")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for workflow, processor in [("workflow_VHcc", "VHccBaseProcessor"), ("workflow_VHbb", "VHbbBaseProcessor")]:
+            if not os.path.exists(f"{repo}/{workflow}.py"):
+                continue
+            outfile = f"{tmpdir}/{workflow}.pkl"
+            _, error = run(CLIENT.format(repo=repo, workflow=workflow, processor=processor, outfile=outfile), repo)
+            if error:
+                report(workflow, None, error)
+                continue
+            # Run from the temporary folder, where the analysis modules are not importable
+            report(workflow, *best_of(WORKER.format(outfile=outfile, heavy=HEAVY), tmpdir, args.repeat))
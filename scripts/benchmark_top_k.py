@@ -0,0 +1,72 @@
+'''
+Parity check and benchmark of the tagger-ordered jet selection (kinematics.top_k) against the full
+ak.argsort used before (CvsLsorted, BvsLsorted), and of the merge of the pt-sorted muons and electrons
+into LeptonGood (kinematics.merge_sorted) against the sort of their concatenation.
+
+Jets, muons and electrons are sampled with Poisson multiplicities; the scores are rounded so that
+some jets have the same score, whose order must be kept.
+'''
+import os, sys, time
+import argparse
+import numpy as np
+import awkward as ak
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from kinematics import top_k, merge_sorted, numba
+
+def collection(counts, rng, **fields):
+    n = counts.sum()
+    return ak.zip({name: ak.unflatten(make(n).astype(np.float32), counts) for name, make in fields.items()})
+
+def pt_sorted(objects):
+    return objects[ak.argsort(objects.pt, axis=1, ascending=False)]
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the top-k jet selection and the lepton merge with ak.argsort")
+    parser.add_argument("-n", "--nevents", type=int, default=300000, help="Number of events (default: chunksize of run_options.yaml)")
+    parser.add_argument("-m", "--multiplicity", type=float, default=5., help="Mean number of jets per event")
+    parser.add_argument("-k", type=int, nargs="+", default=[2], help="Number of jets kept")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of timed repetitions, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    jets = collection(rng.poisson(args.multiplicity, args.nevents), rng,
+                      pt=lambda n: 20 + rng.exponential(40, n), btag=lambda n: np.round(rng.random(n), 2))
+    muons = pt_sorted(collection(rng.poisson(1., args.nevents), rng, pt=lambda n: 10 + rng.exponential(30, n)))
+    electrons = pt_sorted(collection(rng.poisson(0.8, args.nevents), rng, pt=lambda n: 10 + rng.exponential(30, n)))
+    backends = ["numba", "numpy"] if numba is not None else ["numpy"]
+    failed = False
+
+    print(f"{args.nevents} events, {ak.sum(ak.num(jets))} jets, {ak.sum(ak.num(muons)) + ak.sum(ak.num(electrons))} leptons")
+    print(f"{'selection':<16} {'backend':>8} {'identical':>9} {'argsort [ms]':>13} {'new [ms]':>9} {'speedup':>8}")
+    t_ref, reference = timeit(lambda: jets[ak.argsort(jets.btag, axis=1, ascending=False)], args.repeat)
+    for k in args.k:
+        expected = ak.to_list(reference[:, :k])
+        for backend in backends:
+            top_k(jets[:10], jets.btag[:10], k, backend=backend)  # compile outside of the timing
+            t_new, selected = timeit(lambda: top_k(jets, jets.btag, k, backend=backend), args.repeat)
+            same = ak.to_list(selected) == expected
+            failed |= not same
+            print(f"{f'top {k} jets':<16} {backend:>8} {str(same):>9} {1e3*t_ref:>13.1f} {1e3*t_new:>9.1f} {t_ref/t_new:>7.1f}x")
+
+    t_ref, reference = timeit(lambda: pt_sorted(ak.concatenate((muons, electrons), axis=1)), args.repeat)
+    for backend in backends:
+        merge_sorted(muons[:10], electrons[:10], backend=backend)
+        t_new, merged = timeit(lambda: merge_sorted(muons, electrons, backend=backend), args.repeat)
+        same = ak.to_list(merged) == ak.to_list(reference)
+        failed |= not same
+        print(f"{'LeptonGood':<16} {backend:>8} {str(same):>9} {1e3*t_ref:>13.1f} {1e3*t_new:>9.1f} {t_ref/t_new:>7.1f}x")
+
+    if failed:
+        print("Parity check FAILED: different objects or order")
+        sys.exit(1)
+    print("Parity check passed")
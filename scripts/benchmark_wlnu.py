@@ -0,0 +1,133 @@
+'''
+Parity check and benchmark of the fused WLNu kernel (kinematics.wlnu_candidates, numba and NumPy backends)
+against the awkward steps of the WLNu features it replaces in workflow_VHcc.py (copied below): the W
+candidate, the b-jet closest to the lead lepton, its tagger scores and angles, and the top-candidate mass.
+
+Leptons, MET and b-jets are sampled with WLNu-like spectra, with a fraction of events without a lepton
+(None) and a Poisson b-jet multiplicity, so that some events have no b-jet. The parity check runs on
+float64 inputs (the float32 W mass of the awkward steps loses digits in E^2 - p^2), the timing on the
+float32 inputs of NanoAOD as in the workflow.
+'''
+import os, sys, time
+import argparse
+import numpy as np
+import awkward as ak
+from coffea.nanoevents.methods import candidate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from kinematics import wlnu_candidates, neutrino_from_W, numba
+from pocket_coffea.lib.deltaR_matching import delta_phi
+
+TAGS = {"b_CvsL": "btagCvL", "b_CvsB": "btagCvB", "b_Btag": "btagB"}
+
+def wlnu_awkward(lead_lep, PuppiMET, BJetGood):
+    out = {}
+    MET_used = ak.zip({
+                    "pt": PuppiMET.pt,
+                    "eta": ak.zeros_like(PuppiMET.pt),
+                    "phi": PuppiMET.phi,
+                    "mass": ak.zeros_like(PuppiMET.pt),
+                    "charge": ak.zeros_like(PuppiMET.pt),
+                    },with_name="PtEtaPhiMCandidate")
+    W_candidate = lead_lep + MET_used
+    out["W_m"] = W_candidate.mass
+    out["W_pt"] = W_candidate.pt
+    out["W_candidate_phi"] = W_candidate.phi
+    out["W_mt"] = np.sqrt(2*lead_lep.pt*MET_used.pt*(1-np.cos(lead_lep.delta_phi(MET_used))))
+
+    delta_rs = BJetGood.delta_r(lead_lep)
+    min_delta_r_index = ak.argmin(delta_rs, axis=1, keepdims=True)
+    b_jet = BJetGood[min_delta_r_index]
+
+    out["deltaPhi_l1_b"] = np.abs(delta_phi(lead_lep.phi, b_jet.phi))
+    out["deltaEta_l1_b"] = np.abs(lead_lep.eta - b_jet.eta)
+    out["deltaR_l1_b"] = np.sqrt((lead_lep.eta - b_jet.eta)**2 + (lead_lep.phi - b_jet.phi)**2)
+    for name, field in TAGS.items():
+        out[name] = b_jet[field]
+    neutrino = neutrino_from_W(lead_lep, MET_used)
+    out["top_mass"] = (lead_lep + b_jet + neutrino).mass
+    return out
+
+def sample(nevents, missing, multiplicity, rng, dtype):
+    leptons = {
+        "pt": 25 + rng.exponential(30, nevents),
+        "eta": rng.uniform(-2.5, 2.5, nevents),
+        "phi": rng.uniform(-np.pi, np.pi, nevents),
+        "mass": np.where(rng.random(nevents) < 0.5, 0.000511, 0.10566),
+        "charge": np.ones(nevents),
+    }
+    counts = (rng.random(nevents) >= missing).astype(np.int64)
+    lepton = ak.zip({k: ak.unflatten(v[counts == 1].astype(dtype), counts) for k, v in leptons.items()},
+                    with_name="PtEtaPhiMCandidate", behavior=candidate.behavior)
+    met = ak.zip({"pt": rng.exponential(40, nevents).astype(dtype),
+                  "phi": rng.uniform(-np.pi, np.pi, nevents).astype(dtype)})
+
+    counts = rng.poisson(multiplicity, nevents)
+    n = counts.sum()
+    bjets = {
+        "pt": 20 + rng.exponential(40, n),
+        "eta": rng.uniform(-2.5, 2.5, n),
+        "phi": rng.uniform(-np.pi, np.pi, n),
+        "mass": rng.exponential(8, n),
+    }
+    bjets.update({field: rng.random(n) for field in TAGS.values()})
+    # Four-vectors without charge, as the NanoAOD jets
+    bjets = ak.zip({k: ak.unflatten(v.astype(dtype), counts) for k, v in bjets.items()},
+                   with_name="PtEtaPhiMLorentzVector", behavior=candidate.behavior)
+    return ak.firsts(lepton), met, bjets
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def compare(new, reference):
+    # Largest difference relative to the value, and whether the None and the lists are the same
+    x, y = ak.flatten(new, axis=None), ak.flatten(reference, axis=None)
+    same = (len(x) == len(y) and np.array_equal(ak.to_numpy(ak.is_none(new)), ak.to_numpy(ak.is_none(reference)))
+            and np.array_equal(ak.to_numpy(ak.is_none(x)), ak.to_numpy(ak.is_none(y))))
+    if not same:
+        return np.inf, False
+    x, y = ak.to_numpy(ak.fill_none(x, 0.)).astype(np.float64), ak.to_numpy(ak.fill_none(y, 0.)).astype(np.float64)
+    return np.max(np.abs(x - y)/np.maximum(np.abs(y), 1.), initial=0.), True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the fused WLNu kernel with the awkward WLNu features")
+    parser.add_argument("-n", "--nevents", type=int, default=300000, help="Number of events (default: chunksize of run_options.yaml)")
+    parser.add_argument("-m", "--multiplicity", type=float, default=1.2, help="Mean number of b-jets per event")
+    parser.add_argument("--missing", type=float, default=0.05, help="Fraction of events without a lepton")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of timed repetitions, the fastest is reported")
+    parser.add_argument("--tolerance", type=float, default=1e-9, help="Maximum allowed difference, relative to the value")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    inputs64 = sample(args.nevents, args.missing, args.multiplicity, rng, np.float64)
+    rng = np.random.default_rng(args.seed)
+    lepton, met, bjets = sample(args.nevents, args.missing, args.multiplicity, rng, np.float32)
+    reference = wlnu_awkward(*inputs64)
+    t_ref, _ = timeit(lambda: wlnu_awkward(lepton, met, bjets), args.repeat)
+    backends = ["numba", "numpy"] if numba is not None else ["numpy"]
+
+    print(f"{args.nevents} events, {ak.sum(ak.num(bjets) == 0)} without b-jet, {ak.sum(ak.is_none(lepton))} without lepton")
+    print(f"{'backend':>8} {'max rel diff':>13} {'worst field':>14} {'None ok':>8} {'awkward [ms]':>13} {'new [ms]':>9} {'speedup':>8}")
+    failed = False
+    for backend in backends:
+        wlnu_candidates(lepton[:10], met[:10], bjets[:10], TAGS, backend=backend)  # compile outside of the timing
+        t_new, _ = timeit(lambda: wlnu_candidates(lepton, met, bjets, TAGS, backend=backend), args.repeat)
+        new = wlnu_candidates(*inputs64, TAGS, backend=backend)
+        diffs, none_ok = {}, True
+        for field, values in reference.items():
+            diffs[field], same = compare(new[field], values)
+            none_ok &= same
+        worst = max(diffs, key=diffs.get)
+        failed |= not (diffs[worst] <= args.tolerance and none_ok)
+        print(f"{backend:>8} {diffs[worst]:>13.2e} {worst:>14} {str(none_ok):>8} {1e3*t_ref:>13.1f} {1e3*t_new:>9.1f} {t_ref/t_new:>7.1f}x")
+
+    if failed:
+        print(f"Parity check FAILED: differences above {args.tolerance} or different None")
+        sys.exit(1)
+    print("Parity check passed")
@@ -0,0 +1,77 @@
+'''
+Convert the Keras DNN models (.h5) into NumPy weight bundles (.npz) evaluated by MVA/dnn_inference.py,
+so that the workers never import TensorFlow. Batch normalisation is folded into the Dense layers.
+
+With --check the converted network is compared to Keras (if installed) or, otherwise, to a
+layer-by-layer NumPy evaluation of the original weights without folding, and both are timed.
+'''
+import os, sys, glob, json, time
+import argparse
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MVA.dnn_inference import DenseNetwork, _find_weights
+
+def reference_predict(model_file, X):
+    try:
+        from keras.models import load_model
+    except ImportError:
+        pass
+    else:
+        return load_model(model_file).predict(X, batch_size=32, verbose=0), "keras"
+
+    h = X.astype(np.float64)
+    with h5py.File(model_file, "r") as f:
+        group = f["model_weights"] if "model_weights" in f else f
+        for layer in json.loads(f.attrs["model_config"])["config"]["layers"]:
+            kind, cfg = layer["class_name"], layer["config"]
+            if kind == "Dense":
+                w = _find_weights(group, cfg["name"])
+                h = h @ w["kernel"] + w["bias"]
+                if cfg["activation"] == "sigmoid":
+                    h = 1/(1 + np.exp(-h))
+                elif cfg["activation"] == "relu":
+                    h = np.maximum(h, 0)
+            elif kind == "BatchNormalization":
+                w = _find_weights(group, cfg["name"])
+                h = (h - w["moving_mean"])/np.sqrt(w["moving_variance"] + cfg["epsilon"])*w["gamma"] + w["beta"]
+            elif kind == "LeakyReLU":
+                h = np.where(h > 0, h, cfg.get("negative_slope", cfg.get("alpha", 0.3))*h)
+    return h, "numpy reference"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Keras DNN models to NumPy weight bundles")
+    parser.add_argument("models", nargs="*", default=sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../MVA/DNN_models/*.h5"))), help="Keras .h5 models (default: MVA/DNN_models/*.h5)")
+    parser.add_argument("-o", "--outdir", type=str, default=None, help="Output folder (default: next to each model)")
+    parser.add_argument("--check", action="store_true", help="Compare the converted models with the original ones")
+    parser.add_argument("-n", "--nevents", type=int, default=300000, help="Number of random events used with --check")
+    parser.add_argument("--tolerance", type=float, default=1e-5, help="Maximum allowed absolute score difference with --check")
+    args = parser.parse_args()
+
+    failed = False
+    rng = np.random.default_rng(42)
+    for model_file in args.models:
+        network = DenseNetwork.from_h5(model_file)
+        outdir = args.outdir if args.outdir else os.path.dirname(model_file)
+        os.makedirs(outdir, exist_ok=True)
+        bundle_file = os.path.join(outdir, os.path.basename(model_file).replace(".h5", ".npz"))
+        network.save(bundle_file)
+        print(f"{model_file} -> {bundle_file} ({len(network.weights)} layers, {network.num_inputs()} inputs)")
+
+        if args.check:
+            network = DenseNetwork.from_npz(bundle_file)
+            X = rng.normal(size=(args.nevents, network.num_inputs())).astype(np.float32)
+            start = time.perf_counter()
+            reference, name = reference_predict(model_file, X)
+            t_ref = time.perf_counter() - start
+            start = time.perf_counter()
+            scores = network.predict(X)
+            t_new = time.perf_counter() - start
+            diff = np.max(np.abs(scores - reference))
+            failed |= not diff <= args.tolerance
+            print(f"    max|diff| vs {name}: {diff:.2e}, {name}: {1e3*t_ref:.1f} ms, bundle: {1e3*t_new:.1f} ms ({args.nevents/t_new:.3g} events/s)")
+
+    if failed:
+        print(f"Check FAILED: differences above {args.tolerance}")
+        sys.exit(1)
@@ -0,0 +1,100 @@
+'''
+Accuracy and speed of the int8 dynamic-quantized GNN (gnn_inference.quantize_gnn) against the float
+model, on the columns saved by the workflows (Saved_columnar_arrays_*). The quantized model is not
+available in the workflows: the attention projections stay in float and it is not faster than the
+float model on the CPU.
+
+The events of the signal region of each sample are read as in MVA/training.py, grouped by channel
+and era, and scored by both models. For each group the maximum score shift, the AUC of both models
+(signal: the Hto2C samples) and the inference time are reported. The script exits with an error
+if an AUC changes by more than --tolerance.
+'''
+import os, sys, glob, time
+import argparse
+import numpy as np
+import awkward as ak
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MVA.training import load_files, addmissingcols, getchannel, getera, getcols, get_SR_name
+from MVA.inputs import gnn_inputs
+from MVA.model_registry import load_gnn
+from MVA.gnn_inference import run_batched, set_threads, FLOAT_LAYERS
+
+def sample_dirs(paths):
+    # Saved_columnar_arrays_* folders, or folders containing one, as for the GNN training
+    out = []
+    for path in paths:
+        if "Saved_columnar_arrays" not in path:
+            subdirs = [d for d in glob.glob(f"{path}/*") if "Saved_columnar_arrays" in d]
+            if not subdirs:
+                raise ValueError(f"{path} is neither a `Saved_columnar_arrays*` folder, nor contains one")
+            path = subdirs[0]
+        out.extend(sorted(d for d in glob.glob(f"{path}/*") if os.path.isdir(d)))
+    return out
+
+def load_groups(paths, signal, test):
+    '''Inputs and labels of the signal-region events, per (channel, era).'''
+    groups = {}
+    for dr in sample_dirs(paths):
+        if "DATA_" in dr:
+            continue
+        channel, ich = getchannel(dr)
+        SR = get_SR_name(channel)
+        if not glob.glob(f"{dr}/**/{SR}/*.parquet", recursive=True):
+            print(f"No {SR} files in {dr}, skipped")
+            continue
+        events = addmissingcols(load_files(dr, SR, getcols(channel, "gnn")[0], test))
+        events["channel"] = ich
+        events["era"] = getera(dr)
+        labels = np.full(len(events), int(signal in dr))
+        groups.setdefault((channel, getera(dr)), []).append((events, labels))
+    return {key: (ak.concatenate([e for e, _ in samples]), np.concatenate([l for _, l in samples]))
+            for key, samples in groups.items()}
+
+def auc(labels, scores):
+    from sklearn.metrics import roc_auc_score
+    if labels.min() == labels.max():
+        return np.nan
+    return roc_auc_score(labels, scores)
+
+def timed(model, inputs, batch_size):
+    # One batch to warm up, the TorchScript executor optimizes the graph in the first calls
+    run_batched(model, {k: v[:batch_size] for k, v in inputs.items()}, batch_size)
+    start = time.perf_counter()
+    scores = run_batched(model, inputs, batch_size)
+    return scores, time.perf_counter() - start
+
+if __name__ == "__main__":
+    modeldir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../MVA/GNN_models/Global")
+    parser = argparse.ArgumentParser(description="Compare the scores of the quantized and float GNN on saved columns")
+    parser.add_argument("dir_path", type=str, nargs="+", help="Saved_columnar_arrays_* folders (or the output folders containing them)")
+    parser.add_argument("--model-file", type=str, default=f"{modeldir}/gnn.pt", help="GNN state dict")
+    parser.add_argument("--params-file", type=str, default=f"{modeldir}/modelparams.pkl", help="GNN hyperparameters")
+    parser.add_argument("--float-layers", nargs="*", default=FLOAT_LAYERS, help="Linear layers kept in float")
+    parser.add_argument("--signal", type=str, default="Hto2C", help="Samples with this name are the signal")
+    parser.add_argument("--no-export", action="store_true", help="Compare the eager models instead of the TorchScript exports")
+    parser.add_argument("-b", "--batch-size", type=int, default=4096, help="Inference batch size")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Intra-op threads")
+    parser.add_argument("--tolerance", type=float, default=0.002, help="Maximum allowed change of the AUC")
+    parser.add_argument("--test", action="store_true", help="Read at most 5 files per sample")
+    args = parser.parse_args()
+
+    set_threads(args.threads)
+    export = not args.no_export
+    reference = load_gnn(args.model_file, args.params_file, export=export)
+    quantized = load_gnn(args.model_file, args.params_file, export=export, quantize=True, float_layers=args.float_layers)
+    groups = load_groups(args.dir_path, args.signal, args.test)
+
+    print(f"{'channel':<8} {'era':>3} {'events':>9} {'signal':>8} {'max|shift|':>10} {'AUC float':>9} {'AUC int8':>9} "
+          f"{'dAUC':>8} {'float [s]':>9} {'int8 [s]':>8} {'speedup':>8}")
+    failed = False
+    for (channel, era), (events, labels) in sorted(groups.items()):
+        inputs = gnn_inputs(events)
+        ref, t_ref = timed(reference, inputs, args.batch_size)
+        new, t_new = timed(quantized, inputs, args.batch_size)
+        auc_ref, auc_new = auc(labels, ref), auc(labels, new)
+        failed |= abs(auc_new - auc_ref) > args.tolerance
+        print(f"{channel:<8} {era:>3} {len(labels):>9} {labels.sum():>8} {np.abs(new - ref).max():>10.2e} {auc_ref:>9.4f} "
+              f"{auc_new:>9.4f} {auc_new - auc_ref:>+8.4f} {t_ref:>9.2f} {t_new:>8.2f} {t_ref/t_new:>7.2f}x")
+    if failed:
+        sys.exit(f"The AUC changed by more than {args.tolerance} in some groups")
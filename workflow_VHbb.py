@@ -5,19 +5,20 @@ import pandas as pd
 import math
 import warnings
 import os, pickle
-import lightgbm as lgb
 import gc
-# import tensorflow as tf
-# from keras.models import Sequential
-# from keras.layers import Dense
-# from keras.callbacks import EarlyStopping
-# from keras.models import load_model
 import CommonSelectors
 from CommonSelectors import *
 import inspect
 
-import torch
-from MVA.gnnmodels import GraphAttentionClassifier
+from MVA.lazy import lazy_import
+from MVA.model_registry import get_registry, load_bdt, load_dnn, load_gnn
+from MVA.inputs import feature_frame, feature_matrix, evaluate_masked, evaluate_partitions, partition_key, pad_objects
+# Heavy frameworks are only imported on the workers, when run_gnn needs them
+torch = lazy_import("torch")
+gnn_inference = lazy_import("MVA.gnn_inference", by_value=True)
+# Compiled kernels (numba), shipped as source and compiled on the workers
+kinematics = lazy_import("kinematics", by_value=True)
+from functools import partial
 
 from pocket_coffea.utils.utils import dump_ak_array
 
@@ -30,127 +31,20 @@ from pocket_coffea.lib.objects import (
     lepton_selection,
     jet_selection,
     btagging,
-    CvsLsorted,
-    get_dilepton,
-    get_dijet
+    get_dilepton
 )
 
-def get_nu_4momentum(Lepton, MET):
-    mW = 80.38
-
-    # Convert pt, eta, phi, m to px, py, pz, E
-    px = Lepton.pt * np.cos(Lepton.phi)
-    py = Lepton.pt * np.sin(Lepton.phi)
-    pz = Lepton.pt * np.sinh(Lepton.eta)
-    E = np.sqrt(Lepton.mass**2 + Lepton.pt**2 * np.cosh(Lepton.eta)**2)
-    
-    MET_px = MET.pt * np.cos(MET.phi)
-    MET_py = MET.pt * np.sin(MET.phi)
-    
-    MisET2 = (MET_px**2 + MET_py**2)
-    mu = (mW**2) / 2 + MET_px * px + MET_py * py
-    a = (mu * pz) / (E**2 - pz**2)
-    a2 = a**2
-    b = ((E**2) * (MisET2) - mu**2) / (E**2 - pz**2)
-    
-    condition = a2 - b >= 0
-
-    # Vectorized handling of conditions
-    root = np.sqrt(ak.where(condition, a2 - b, ak.zeros_like(a2)))
-    pz1 = a + root
-    pz2 = a - root
-    pznu = ak.where(np.abs(pz1) < np.abs(pz2), pz1, pz2)
-    Enu = np.sqrt(MisET2 + pznu**2)
-
-    # Handle cases where condition is False using your fallback logic
-    # Adapted to take into account the real parts of the roots if discriminant is negative
-    real_part = ak.where(condition, ak.zeros_like(a), a)  # Use 'a' as the real part when condition is False
-    pznu = ak.where(condition, pznu, real_part)  # Update pznu to use real_part when condition is False
-    Enu = np.sqrt(MisET2 + pznu**2)  # Recalculate Enu with the updated pznu
-
-    p4nu_rec = ak.Array([MET_px, MET_py, pznu, Enu])
-    pt = np.sqrt(MET_px**2 + MET_py**2)
-    phi = np.arctan2(MET_py, MET_px)
-    theta = np.arctan2(pt, pznu)
-    eta = -np.log(np.tan(theta / 2))
-    m = np.sqrt(np.maximum(Enu**2 - (MET_px**2 + MET_py**2 + pznu**2), 0))
-
-    return ak.zip({"pt": pt, "eta": eta, "phi": phi, "mass": m},with_name="PtEtaPhiMCandidate")
-
-def BvsLsorted(jets, tagger):
-    if tagger == "PNet":
-        btag = "btagPNetB"
-    elif tagger == "DeepFlav":
-        btag = "btagDeepFlavB"
-    elif tagger == "RobustParT":
-        btag = "btagRobustParTAK4B"
-    else:
+def BvsLsorted(jets, tagger, k=None, backend=None):
+    if tagger not in kinematics.TAGGER_FIELDS:
         raise NotImplementedError(f"This tagger is not implemented: {tagger}")
+    # The k jets with the highest score, all of them sorted if k is None
+    return kinematics.top_k(jets, jets[kinematics.TAGGER_FIELDS[tagger]["BvsL"]], k, backend=backend)
     
-    return jets[ak.argsort(jets[btag], axis=1, ascending=False)]
-    
-def get_dibjet(jets, tagger = 'PNet'):
-    
-    fields = {
-        "pt": 0.,
-        "eta": 0.,
-        "phi": 0.,
-        "mass": 0.,
-    }
-
-    jets = ak.pad_none(jets, 2)
-    njet = ak.num(jets[~ak.is_none(jets, axis=1)])
-    
-    dijet = jets[:, 0] + jets[:, 1]
-
-    for var in fields.keys():
-        fields[var] = ak.where(
-            (njet >= 2),
-            getattr(dijet, var),
-            fields[var]
-        )
-
-    fields["deltaR"] = ak.where( (njet >= 2), jets[:,0].delta_r(jets[:,1]), -1)
-    fields["deltaPhi"] = ak.where( (njet >= 2), abs(jets[:,0].delta_phi(jets[:,1])), -1)
-    fields["deltaEta"] = ak.where( (njet >= 2), abs(jets[:,0].eta - jets[:,1].eta), -1)
-    fields["j1Phi"] = ak.where( (njet >= 2), jets[:,0].phi, -1)
-    fields["j2Phi"] = ak.where( (njet >= 2), jets[:,1].phi, -1)
-    fields["j1pt"] = ak.where( (njet >= 2), jets[:,0].pt, -1)
-    fields["j2pt"] = ak.where( (njet >= 2), jets[:,1].pt, -1)
-    fields["j1mass"] = ak.where( (njet >= 2), jets[:,0].mass, -1)
-    fields["j2mass"] = ak.where( (njet >= 2), jets[:,1].mass, -1)
-    
-    if tagger == "PNet":
-        BvL = "btagPNetB"
-        CvL = "btagPNetCvL"
-        CvB = "btagPNetCvB"
-    elif tagger == "DeepFlav":
-        BvL = "btagDeepFlavB"
-        CvL = "btagDeepFlavCvL"
-        CvB = "btagDeepFlavCvB"
-    elif tagger == "RobustParT":
-        BvL = "btagRobustParTAK4B"
-        CvL = "btagRobustParTAK4CvL"
-        CvB = "btagRobustParTAK4CvB"
-    else:
+def get_dibjet(jets, tagger = 'PNet', backend=None):
+    if tagger not in kinematics.TAGGER_FIELDS:
         raise NotImplementedError(f"This tagger is not implemented: {tagger}")
-
-    if tagger:
-        fields["j1BvsL"] = ak.where( (njet >= 2), jets[:,0][BvL], -1)
-        fields["j2BvsL"] = ak.where( (njet >= 2), jets[:,1][BvL], -1)
-        fields["j1CvsL"] = ak.where( (njet >= 2), jets[:,0][CvL], -1)
-        fields["j2CvsL"] = ak.where( (njet >= 2), jets[:,1][CvL], -1)
-        fields["j1CvsB"] = ak.where( (njet >= 2), jets[:,0][CvB], -1)
-        fields["j2CvsB"] = ak.where( (njet >= 2), jets[:,1][CvB], -1)
-        
-    # Lead b-jet pt: larger of the first two jets' pt
-    fields["leadb_pt"] = ak.where( njet >= 2, ak.max(ak.Array([jets[:, 0].pt, jets[:, 1].pt]), axis=0), -1)
-
-    # Sublead b-jet pt: smaller of the first two jets' pt
-    fields["subleadb_pt"] = ak.where(njet >= 2, ak.min(ak.Array([jets[:, 0].pt, jets[:, 1].pt]), axis=0), -1)
-    
-    dibjet = ak.zip(fields, with_name="PtEtaPhiMCandidate")
-    return dibjet
+    # Lead and sublead b-jet pt: larger and smaller of the first two jets' pt
+    return kinematics.build_dijet(jets, kinematics.TAGGER_FIELDS[tagger], pt_ordered=("leadb_pt", "subleadb_pt"), backend=backend)
   
 def get_additionalleptons(electrons, muons, baseNum=0):
 
@@ -167,58 +61,6 @@ def get_additionalleptons(electrons, muons, baseNum=0):
     NAL = nlep - baseNum
     return NAL
 
-def LorentzBooster(array_pt, array_eta, array_phi, array_mass):
-    
-    # Flatten arrays
-    flat_pt = ak.to_numpy(ak.flatten(array_pt))
-    flat_eta = ak.to_numpy(ak.flatten(array_eta))
-    flat_phi = ak.to_numpy(ak.flatten(array_phi))
-    flat_mass = ak.to_numpy(ak.flatten(array_mass))
-    
-    compute_lib = ctypes.CDLL('/afs/cern.ch/work/l/lichengz/private/VHbb/VHccPoCo/scripts/interface/compute_vectors.so')
-    # TODO can add it into another parameter yml file
-    
-    # Define the argument types for the C++ function
-    compute_lib.compute_4vectors.argtypes = [
-        ctypes.POINTER(ctypes.c_double),  # pt
-        ctypes.POINTER(ctypes.c_double),  # eta
-        ctypes.POINTER(ctypes.c_double),  # phi
-        ctypes.POINTER(ctypes.c_double),  # mass
-        ctypes.POINTER(ctypes.c_double),  # px
-        ctypes.POINTER(ctypes.c_double),  # py
-        ctypes.POINTER(ctypes.c_double),  # pz
-        ctypes.POINTER(ctypes.c_double),  # energy
-        ctypes.c_int                      # size
-    ]
-    
-    # Allocate arrays for the outputs
-    size = len(flat_pt)
-    px = np.zeros(size, dtype=np.float64)
-    py = np.zeros(size, dtype=np.float64)
-    pz = np.zeros(size, dtype=np.float64)
-    energy = np.zeros(size, dtype=np.float64)
-    
-    # Call the C++ function
-    compute_lib.compute_4vectors(
-        flat_pt.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        flat_eta.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        flat_phi.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        flat_mass.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        px.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        py.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        pz.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        energy.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        size
-    )
-    
-    # Print the results
-    print("px:", px)
-    print("py:", py)
-    print("pz:", pz)
-    print("energy:", energy)
-    
-    return 0
-  
 class VHbbBaseProcessor(BaseProcessorABC):
     def __init__(self, cfg: Configurator):
         super().__init__(cfg)
@@ -227,6 +69,13 @@ class VHbbBaseProcessor(BaseProcessorABC):
         self.run_bdt         = self.params["run_bdt"]
         self.run_dnn         = self.params["run_dnn"]
         self.separate_models = self.params["separate_models"]
+        self.run_gnn         = self.params.get("run_gnn", False)
+        # numba or numpy, default numba if installed on the workers
+        self.kinematics_backend = self.params.get("kinematics_backend", None)
+        # Jets kept in the tagger-sorted collections (JetsCvsL, JetsBvsL), at least 2; None keeps all
+        self.tagger_top_k = self.params.get("tagger_top_k", 2)
+        if self.tagger_top_k is not None and self.tagger_top_k < 2:
+            raise ValueError(f"tagger_top_k must be at least 2 for the dijet candidates (or None), got {self.tagger_top_k}")
 
         print("Processor initialized")
         
@@ -246,11 +95,11 @@ class VHbbBaseProcessor(BaseProcessorABC):
         self.events["ElectronGood"] = lepton_selection(
             self.events, "Electron", self.params
         )
-        leptons = ak.with_name(
-            ak.concatenate((self.events.MuonGood, self.events.ElectronGood), axis=1),
+        # MuonGood and ElectronGood are pt-sorted: merged instead of sorting their concatenation
+        self.events["LeptonGood"] = ak.with_name(
+            kinematics.merge_sorted(self.events.MuonGood, self.events.ElectronGood, backend=self.kinematics_backend),
             name='PtEtaPhiMCandidate',
         )
-        self.events["LeptonGood"] = leptons[ak.argsort(leptons.pt, ascending=False)]
 
         self.events["ll"] = get_dilepton(
             self.events.ElectronGood, self.events.MuonGood
@@ -277,128 +126,57 @@ class VHbbBaseProcessor(BaseProcessorABC):
         # self.events["nfatjet"]   = ak.num(self.events.FatJetGood)
 
 
+    def get_model(self, kind, channel, loader, *paths):
+        # Models are cached per worker process, so each one is read from disk only once,
+        # and with a store_dir their weights are memory-mapped and shared by the processes of a node
+        if self.params.ModelRegistry.store_dir:
+            loader = partial(loader, store_dir=self.params.ModelRegistry.store_dir)
+        registry = get_registry(self.params.ModelRegistry.max_size_mb)
+        return registry.get(kind, channel, self._year, loader, *paths)
+
     def evaluateBDT(self, data):
-        print(self.params.Models.BDT[self.channel][self.events.metadata["year"]].model_file)
-        print()
-        # Read the model file
-        model = lgb.Booster(model_file=self.params.Models.BDT[self.channel][self.events.metadata["year"]].model_file)
-        #bdt_score = self.bdt_model.predict(data)
+        model = self.get_model("BDT", self.channel, load_bdt,
+                               self.params.Models.BDT[self.channel][self._year].model_file)
         bdt_score = model.predict(data)
-        # Release memory
-        del model
-        gc.collect()
 
         return bdt_score
     
     def evaluateseparateBDTs(self, data):
-        data_df_low = data[data['dilep_pt'] < 150]
-        data_df_high = data[data['dilep_pt'] >= 150]
-        
-        # Initialize empty arrays for scores
-        bdt_score_low = np.array([])
-        bdt_score_high = np.array([])
-        
-        # Read the model files
-        model_low = lgb.Booster(model_file=self.params.Models.BDT[f'{self.channel}_low'][self.events.metadata["year"]].model_file)
-        model_high = lgb.Booster(model_file=self.params.Models.BDT[f'{self.channel}_high'][self.events.metadata["year"]].model_file)
-        
-        # Predict only if data_df_low is non-empty
-        if not data_df_low.empty:
-            #bdt_score_low = self.bdt_low_model.predict(data_df_low)
-            bdt_score_low = model_low.predict(data_df_low)
-        
-        # Predict only if data_df_high is non-empty
-        if not data_df_high.empty:
-            #bdt_score_high = self.bdt_high_model.predict(data_df_high)
-            bdt_score_high = model_high.predict(data_df_high)
-        
-        # Concatenate the scores from low and high dataframes
-        bdt_score = np.concatenate((bdt_score_low, bdt_score_high), axis=0)
-        
-        # Release memory
-        del model_low, model_high
-        gc.collect()
-
-        return bdt_score
+        return self.evaluate_split("BDT", load_bdt, data)
     
     def evaluateDNN(self, data):
-        
-        #print("Evaluating DNN...")
-        #print(self.params.Models.DNN[self.channel][self.events.metadata["year"]].model_file)
-        #print()
-        # Load the model on demand
-        with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues
-            model = load_model(self.params.Models.DNN[self.channel][self.events.metadata["year"]].model_file)
-            dnn_score = model.predict(data, batch_size=32).ravel()
-        # Release memory
-        tf.keras.backend.clear_session()
-        del model
-        gc.collect()
-        #print("DNN evaluation completed.")
+        model = self.get_model("DNN", self.channel, load_dnn,
+                               self.params.Models.DNN[self.channel][self._year].model_file)
+        dnn_score = model.predict(data).ravel()
         return dnn_score
     
     def evaluateseparateDNNs(self, data):
-        
-        data_df_low = data[data['dilep_pt'] < 150]
-        data_df_high = data[data['dilep_pt'] >= 150]
-        
-        # Initialize empty arrays for scores
-        dnn_score_low = np.array([])
-        dnn_score_high = np.array([])
-        
-        # Read the model file
-        model_low = load_model(self.params.Models.DNN[f'{self.channel}_low'][self.events.metadata["year"]].model_file)
-        model_high = load_model(self.params.Models.DNN[f'{self.channel}_high'][self.events.metadata["year"]].model_file)
-        
-        # Predict only if data_df_low is non-empty
-        if not data_df_low.empty:
-            print("Predicting for low dilep_pt...")
-            with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues
-                model_low = load_model(self.params.DNN_low)
-                dnn_score_low = model_low.predict(data_df_low, batch_size=32).ravel()
-            tf.keras.backend.clear_session()
-            del model_low
-            gc.collect()
-            print("Prediction for low dilep_pt completed.")
-        
-        # Predict only if data_df_high is non-empty
-        if not data_df_high.empty:
-            print("Predicting for high dilep_pt...")
-            with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues
-                model_high = load_model(self.params.DNN_high)
-                dnn_score_high = model_high.predict(data_df_high, batch_size=32).ravel()
-            tf.keras.backend.clear_session()
-            del model_high
-            gc.collect()
-            print("Prediction for high dilep_pt completed.")
-        
-        
-        
-        dnn_score = np.concatenate((dnn_score_low, dnn_score_high), axis=0)
-        
-        print("Separate DNN evaluation completed.")
-        
-        return dnn_score
-    
-    def resize_tensor(self,tensor,target):
-        m, n, p = tensor.shape
-        
-        if n > target:
-            return tensor[:, :target, :]
-        elif n < target:
-            padding = torch.zeros((m, target - n, p), device=tensor.device, dtype=tensor.dtype)
-            return torch.cat((tensor, padding), dim=1)
-        else:
-            return tensor
+        return self.evaluate_split("DNN", load_dnn, data)
 
+    def evaluate_split(self, kind, loader, data):
+        '''
+        Score each event with the model of its partition, '{channel}_{name}' in Models, with the
+        partitions of the channel defined in SplitModels. The scores keep the order of the events.
+        '''
+        split = self.params.SplitModels[self.channel]
+        key = partition_key(self.events[split.variable], split.get("edges"), split.get("modulo"))
+        # The index of data is the event position, also when only a subset of the events is scored
+        key = key[np.asarray(data.index)]
+        models = {i: partial(self.predict_split, kind, f'{self.channel}_{name}', loader)
+                  for i, name in enumerate(split.names)}
+        return evaluate_partitions(data, key, models)
+
+    def predict_split(self, kind, channel, loader, data):
+        model = self.get_model(kind, channel, loader,
+                               self.params.Models[kind][channel][self._year].model_file)
+        return model.predict(data).ravel()
+    
     def evaluateGNN(self,data):
-        # model = torch.jit.load(self.params.Models.GNN[self.channel][self.events.metadata["year"]].model_file) #TODO This would be the most elegant way, but the current model does not work with torch.jit
-
-        modelparams = pickle.load(open(self.params.Models.GNN[self.channel][self.events.metadata["year"]].params,'rb'))
-        model = GraphAttentionClassifier(**modelparams)
-        model.load_state_dict(torch.load(self.params.Models.GNN[
-            self.channel][self.events.metadata["year"]].model_file,weights_only=True,map_location=self.device))
-        model.eval()
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model = self.get_model("GNN", self.channel, partial(load_gnn, device=device),
+                               self.params.Models.GNN[self.channel][self._year].model_file,
+                               self.params.Models.GNN[self.channel][self._year].params)
+        gnn_inference.set_threads(self.params.GNNInference.num_threads)
 
         if self.proc_type=="ZLL":
             varsdict = {
@@ -448,37 +226,23 @@ class VHbbBaseProcessor(BaseProcessorABC):
             'cat'   : catpad
         }
 
-        tensordict = {}  
+        inputs = {}
         for arr in varsdict:  
             maxelem = pads[arr] 
             if maxelem is None or len(varsdict[arr])==0:
-                tensordict[arr] = torch.tensor([1])
-                continue           
-            for field in varsdict[arr]:
-                var = data[field]
-                
-                if maxelem > 0:
-                    N = np.max(ak.num(var, axis=1))  
-                    padded = ak.fill_none(ak.pad_none(var,N,axis=1),0)
-                else: 
-                    padded = var
-                if arr not in tensordict:
-                    tensordict[arr] = []
-                dtype = torch.float32
-                if arr == 'cat': dtype = torch.int64
-                tensordict[arr].append(torch.tensor(padded,dtype=dtype))
-
-            stacked = torch.stack(tensordict[arr],dim=-1)
+                inputs[arr] = torch.tensor([1])
+                continue
             if maxelem > 0:
-                stacked = self.resize_tensor(stacked,maxelem)
-            tensordict[arr] = stacked
-        
-        with torch.no_grad():
-            prediction = model(tensordict["jet"],tensordict["jetp4"],tensordict["lep"],tensordict["lepp4"],tensordict["ll"],tensordict["glo"],tensordict["cat"])[:,0]
-        
-        del model, tensordict
+                stacked = pad_objects(data, varsdict[arr], maxelem)
+            else:
+                stacked, _ = feature_matrix(data, varsdict[arr])
+            if arr == 'cat': stacked = stacked.astype(np.int64)
+            inputs[arr] = stacked
 
-        return prediction.detach().cpu().numpy()    
+        # The batches are views of the padded arrays, sized from the memory budget
+        batch_size = gnn_inference.batch_size_for(self.params.GNNInference.memory_mb)
+        return gnn_inference.run_batched(model, inputs, batch_size, device, report=self.params.GNNInference.report,
+                                         names=["jet", "jetp4", "lep", "lepp4", "ll", "glo", "cat"])
         
     # Function that defines common variables employed in analyses and save them as attributes of `events`
     def define_common_variables_before_presel(self, variation):
@@ -512,14 +276,19 @@ class VHbbBaseProcessor(BaseProcessorABC):
         
         self.myJetTagger = self.params.ctagging[self._year]["tagger"]
         
-        self.events["dijet"] = get_dijet(self.events.JetGood)
-        self.events["JetsCvsL"] = CvsLsorted(self.events["JetGood"],
-                                             tagger = self.params.object_preselection.bJet_algorithm)
+        self.events["dijet"] = kinematics.build_dijet(self.events.JetGood, {"CvsL": "btagCvL", "CvsB": "btagCvB"},
+                                                      backend=self.kinematics_backend)
+        CvL = kinematics.TAGGER_FIELDS[self.params.object_preselection.bJet_algorithm]["CvsL"]
+        self.events["JetsCvsL"] = kinematics.top_k(self.events.JetGood, self.events.JetGood[CvL],
+                                                   self.tagger_top_k, backend=self.kinematics_backend)
         self.events["dijet_csort"] = get_dibjet(self.events.JetsCvsL, 
-                                                tagger = self.params.object_preselection.bJet_algorithm)
+                                                tagger = self.params.object_preselection.bJet_algorithm,
+                                                backend = self.kinematics_backend)
         
-        self.events["JetsBvsL"] = BvsLsorted(self.events["JetGood"], self.params.object_preselection.bJet_algorithm)
-        self.events["dijet_bsort"] = get_dibjet(self.events.JetsBvsL, self.params.object_preselection.bJet_algorithm)
+        self.events["JetsBvsL"] = BvsLsorted(self.events["JetGood"], self.params.object_preselection.bJet_algorithm,
+                                             k = self.tagger_top_k, backend = self.kinematics_backend)
+        self.events["dijet_bsort"] = get_dibjet(self.events.JetsBvsL, self.params.object_preselection.bJet_algorithm,
+                                                backend = self.kinematics_backend)
         
         self.events["MET_used"] = ak.zip({
                                         "pt": self.events.MET.pt,
@@ -552,12 +321,6 @@ class VHbbBaseProcessor(BaseProcessorABC):
 #             self.events["GenPart_status"] = self.events.GenPart.status
 #             self.events["GenPart_statusFlags"] = self.events.GenPart.statusFlags
             
-#             # a C++ interface test
-#             # LorentzBooster(self.events.GenPart_pt, 
-#             #                self.events.GenPart_eta, 
-#             #                self.events.GenPart_phi, 
-#             #                self.events.GenPart_mass)
-
 #             self.events["LHE_AlphaS"] = self.events.LHE.AlphaS
 #             self.events["LHE_HT"] = self.events.LHE.HT
 #             self.events["LHE_HTIncoming"] = self.events.LHE.HTIncoming
@@ -698,14 +461,9 @@ class VHbbBaseProcessor(BaseProcessorABC):
                         "events_VHbb_deltaR": self.events["VHbb_deltaR"]
                     })
 
-                    df = ak.to_pandas(variables_to_process)
-
-                    df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-                    bdt_predictions = self.evaluateBDT(df_final, "Hbb")
-                    bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-                    # Convert NaN to None
-                    bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-                    self.events["BDT_Hbb"] = bdt_predictions
+                    # Events with missing inputs (valid False) are not scored
+                    df_final, valid = feature_frame(variables_to_process, variables_to_process.fields)
+                    self.events["BDT_Hbb"] = evaluate_masked(lambda data: self.evaluateBDT(data, "Hbb"), df_final, valid)
 
                     ## just for now
                     self.events["GNN_Hbb"] = np.zeros_like(self.events["BDT_Hbb"])
@@ -721,14 +479,9 @@ class VHbbBaseProcessor(BaseProcessorABC):
                         self.events["GNN"] = np.zeros_like(self.events["BDT_Hbb"])
 
                 else:
-                    df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-                    bdt_predictions = self.evaluateseparateBDTs(df_final)
-                    bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-                    # Convert NaN to None
-                    bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-                    self.events["BDT"] = bdt_predictions
+                    self.events["BDT"] = evaluate_masked(self.evaluateseparateBDTs, df_final, valid)
                     if self.run_dnn:
-                        self.events["DNN"] = self.evaluateseparateDNNs(df_final)
+                        self.events["DNN"] = evaluate_masked(self.evaluateseparateDNNs, df_final, valid)
                     else:
                         self.events["DNN"] = np.zeros_like(self.events["BDT"])
 
@@ -819,7 +572,7 @@ class VHbbBaseProcessor(BaseProcessorABC):
             # self.events["b_CvsB"] = self.events.b_jet.btagDeepFlavCvB
             # self.events["b_Btag"] = self.events.b_jet.btagDeepFlavB
             
-            self.events["neutrino_from_W"] = get_nu_4momentum(self.events.lead_lep, self.events.MET_used)
+            self.events["neutrino_from_W"] = kinematics.neutrino_from_W(self.events.lead_lep, self.events.MET_used, backend=self.kinematics_backend)
             self.events["top_candidate"] = self.events.lead_lep + self.events.lead_b + self.events.neutrino_from_W
             self.events["top_mass"] = (self.events.lead_lep + self.events.lead_b + self.events.neutrino_from_W).mass
             
@@ -853,33 +606,21 @@ class VHbbBaseProcessor(BaseProcessorABC):
                     "top_mass": self.events["top_mass"]
                 })
             
-                df = ak.to_pandas(variables_to_process)
-                df = df.drop(columns=columns_to_exclude, errors='ignore')
+                # Events with missing inputs (valid False) are not scored
+                df_final, valid = feature_frame(variables_to_process, variables_to_process.fields)
                 self.channel = "1L"
                 if not self.params.separate_models: 
-                    df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-
-                    bdt_predictions = self.evaluateBDT(df_final)
-                    bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-                    # Convert NaN to None
-                    bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-                    self.events["BDT"] = bdt_predictions
+                    self.events["BDT"] = evaluate_masked(self.evaluateBDT, df_final, valid)
 
                     if self.run_dnn:
-                        self.events["DNN"] = self.evaluateDNN(df_final)
+                        self.events["DNN"] = evaluate_masked(self.evaluateDNN, df_final, valid)
                     else:
                         self.events["DNN"] = np.zeros_like(self.events["BDT"])
                 else:
-                    df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-
-                    bdt_predictions = self.evaluateseparateBDTs(df_final)
-                    bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-                    # Convert NaN to None
-                    bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-                    self.events["BDT"] = bdt_predictions
+                    self.events["BDT"] = evaluate_masked(self.evaluateseparateBDTs, df_final, valid)
 
                     if self.run_dnn:
-                        self.events["DNN"] = self.evaluateseparateDNNs(df_final)
+                        self.events["DNN"] = evaluate_masked(self.evaluateseparateDNNs, df_final, valid)
                     else:
                         self.events["DNN"] = np.zeros_like(self.events["BDT"])
 
@@ -947,34 +688,21 @@ class VHbbBaseProcessor(BaseProcessorABC):
                     "Z_pt": self.events["Z_pt"]
                 })
             
-                df = ak.to_pandas(variables_to_process)
-                # columns_to_exclude = ['dilep_m']
-                df = df.drop(columns=columns_to_exclude, errors='ignore')
+                # Events with missing inputs (valid False) are not scored
+                df_final, valid = feature_frame(variables_to_process, variables_to_process.fields)
                 self.channel = "0L"
                 if not self.params.separate_models: 
-                    df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-
-                    bdt_predictions = self.evaluateBDT(df_final)
-                    bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-                    # Convert NaN to None
-                    bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-                    self.events["BDT"] = bdt_predictions
+                    self.events["BDT"] = evaluate_masked(self.evaluateBDT, df_final, valid)
 
                     if self.run_dnn:
-                        self.events["DNN"] = self.evaluateDNN(df_final)
+                        self.events["DNN"] = evaluate_masked(self.evaluateDNN, df_final, valid)
                     else:
                         self.events["DNN"] = np.zeros_like(self.events["BDT"])
                 else:
-                    df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-
-                    bdt_predictions = self.evaluateseparateBDTs(df_final)
-                    bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-                    # Convert NaN to None
-                    bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-                    self.events["BDT"] = bdt_predictions
+                    self.events["BDT"] = evaluate_masked(self.evaluateseparateBDTs, df_final, valid)
 
                     if self.run_dnn:
-                        self.events["DNN"] = self.evaluateseparateDNNs(df_final)
+                        self.events["DNN"] = evaluate_masked(self.evaluateseparateDNNs, df_final, valid)
                     else:
                         self.events["DNN"] = np.zeros_like(self.events["BDT"])
 
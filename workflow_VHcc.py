@@ -5,20 +5,23 @@ import pandas as pd
 import math
 import warnings
 import os, pickle
-import lightgbm as lgb
 import gc
-import tensorflow as tf
-from keras.models import Sequential
-from keras.layers import Dense
-from keras.callbacks import EarlyStopping
-from keras.models import load_model
 import CommonSelectors
 from CommonSelectors import *
 import inspect
 
-import torch
-from MVA.gnnmodels import GraphAttentionClassifier
-from MVA.training import process_gnn_inputs
+from MVA.lazy import lazy_import
+from MVA.model_registry import get_registry, load_bdt, load_dnn, load_gnn
+from MVA.inputs import evaluate_partitions, partition_key, event_field, PROJECTIONS, GNN_FLAT
+from MVA.stage import MVAStage, memory_mb
+from features import FeatureRegistry, cut_fields, find_cuts
+# Heavy frameworks are only imported on the workers, when run_gnn needs them
+torch = lazy_import("torch")
+gnn_inference = lazy_import("MVA.gnn_inference", by_value=True)
+# Compiled kernels (numba), shipped as source and compiled on the workers
+kinematics = lazy_import("kinematics", by_value=True)
+from functools import partial
+from concurrent.futures import Future
 
 from pocket_coffea.utils.utils import dump_ak_array
 from pocket_coffea.workflows.base import BaseProcessorABC
@@ -30,54 +33,155 @@ from pocket_coffea.lib.objects import (
     lepton_selection,
     jet_selection,
     btagging,
-    CvsLsorted,
-    get_dilepton,
-    get_dijet
+    get_dilepton
 )
 import awkward as ak
 import numpy as np
 
-def get_nu_4momentum(Lepton, PuppiMET):
-    mW = 80.38
-
-    # Convert pt, eta, phi, m to px, py, pz, E
-    px = Lepton.pt * np.cos(Lepton.phi)
-    py = Lepton.pt * np.sin(Lepton.phi)
-    pz = Lepton.pt * np.sinh(Lepton.eta)
-    E = np.sqrt(Lepton.mass**2 + Lepton.pt**2 * np.cosh(Lepton.eta)**2)
-    
-    MET_px = PuppiMET.pt * np.cos(PuppiMET.phi)
-    MET_py = PuppiMET.pt * np.sin(PuppiMET.phi)
-    
-    MisET2 = (MET_px**2 + MET_py**2)
-    mu = (mW**2) / 2 + MET_px * px + MET_py * py
-    a = (mu * pz) / (E**2 - pz**2)
-    a2 = a**2
-    b = ((E**2) * (MisET2) - mu**2) / (E**2 - pz**2)
-    
-    condition = a2 - b >= 0
-
-    # Vectorized handling of conditions
-    root = np.sqrt(ak.where(condition, a2 - b, ak.zeros_like(a2)))
-    pz1 = a + root
-    pz2 = a - root
-    pznu = ak.where(np.abs(pz1) < np.abs(pz2), pz1, pz2)
-    Enu = np.sqrt(MisET2 + pznu**2)
-
-    # Handle cases where condition is False using your fallback logic
-    # Adapted to take into account the real parts of the roots if discriminant is negative
-    real_part = ak.where(condition, ak.zeros_like(a), a)  # Use 'a' as the real part when condition is False
-    pznu = ak.where(condition, pznu, real_part)  # Update pznu to use real_part when condition is False
-    Enu = np.sqrt(MisET2 + pznu**2)  # Recalculate Enu with the updated pznu
-
-    p4nu_rec = ak.Array([MET_px, MET_py, pznu, Enu])
-    pt = np.sqrt(MET_px**2 + MET_py**2)
-    phi = np.arctan2(MET_py, MET_px)
-    theta = np.arctan2(pt, pznu)
-    eta = -np.log(np.tan(theta / 2))
-    m = np.sqrt(np.maximum(Enu**2 - (MET_px**2 + MET_py**2 + pznu**2), 0))
-
-    return ak.zip({"pt": pt, "eta": eta, "phi": phi, "mass": m},with_name="PtEtaPhiMCandidate")
+# Era index of the GNN inputs
+ERAS = {"2022_preEE": 0, "2022_postEE": 1, "2023_preBPix": 2, "2023_postBPix": 3}
+# Channel of the MVA models and of the event features of each proc_type
+CHANNELS = {"ZLL": "2L", "WLNu": "1L", "ZNuNu": "0L"}
+
+# Event features of the channels, computed in define_common_variables_after_presel only if a histogram,
+# a cut, the saved columns or the MVA stage read them (or the features depending on them)
+FEATURES = FeatureRegistry()
+
+### General
+for name, field in [("dijet_m", "mass"), ("dijet_pt", "pt"), ("dijet_dr", "deltaR"),
+                    ("dijet_deltaPhi", "deltaPhi"), ("dijet_deltaEta", "deltaEta"),
+                    ("dijet_CvsL_max", "j1CvsL"), ("dijet_CvsL_min", "j2CvsL"),
+                    ("dijet_CvsB_max", "j1CvsB"), ("dijet_CvsB_min", "j2CvsB"),
+                    ("dijet_pt_max", "j1pt"), ("dijet_pt_min", "j2pt")]:
+    FEATURES.alias(name, f"dijet_csort.{field}")
+
+### 2L
+for name, field in [("dilep_m", "mass"), ("dilep_pt", "pt"), ("dilep_dr", "deltaR"),
+                    ("dilep_deltaPhi", "deltaPhi"), ("dilep_deltaEta", "deltaEta")]:
+    FEATURES.alias(name, f"ll.{field}", channels=["2L"])
+
+@FEATURES.feature("LeptonCategory", channels=["2L"])
+def _(events, processor):
+    return ak.values_astype(events["nMuonGood"]==2,"int32")
+
+@FEATURES.feature("ZH_pt_ratio", channels=["2L"])
+def _(events, processor):
+    return events.dijet_csort.pt/events.ll.pt
+
+@FEATURES.feature("ZH_deltaPhi", channels=["2L"])
+def _(events, processor):
+    return np.abs(events.ll.delta_phi(events.dijet_csort))
+
+@FEATURES.feature("deltaPhi_l2_j1", channels=["2L"])
+def _(events, processor):
+    return np.abs(delta_phi(events.ll.l2phi, events.dijet_csort.j1Phi))
+
+@FEATURES.feature("deltaPhi_l2_j2", channels=["2L"])
+def _(events, processor):
+    # why cant't we use delta_phi function here?
+    angle22_gen = (abs(events.ll.l2phi - events.dijet_csort.j2Phi) < np.pi)
+    return ak.where(angle22_gen, abs(events.ll.l2phi - events.dijet_csort.j2Phi), 2*np.pi - abs(events.ll.l2phi - events.dijet_csort.j2Phi))
+
+### 1L and 0L
+@FEATURES.feature("MET_used", channels=["1L", "0L"])
+def _(events, processor):
+    return ak.zip({
+        "pt": events.PuppiMET.pt,
+        "eta": ak.zeros_like(events.PuppiMET.pt),
+        "phi": events.PuppiMET.phi,
+        "mass": ak.zeros_like(events.PuppiMET.pt),
+        "charge": ak.zeros_like(events.PuppiMET.pt),
+        },with_name="PtEtaPhiMCandidate")
+
+@FEATURES.feature("deltaPhi_jet1_MET", channels=["1L", "0L"])
+def _(events, processor):
+    return np.abs(events.PuppiMET.delta_phi(events.JetGood[:,0]))
+
+@FEATURES.feature("deltaPhi_jet2_MET", channels=["1L", "0L"])
+def _(events, processor):
+    return np.abs(events.PuppiMET.delta_phi(events.JetGood[:,1]))
+
+### 1L
+@FEATURES.feature("lead_lep", channels=["1L"])
+def _(events, processor):
+    return ak.firsts(events.LeptonGood)
+
+# W candidate, b-jet closest to the lead lepton and top candidate in one compiled pass
+@FEATURES.feature("WLNu_kinematics", depends=["lead_lep", "MET_used"], channels=["1L"])
+def _(events, processor):
+    return kinematics.wlnu_candidates(events.lead_lep, events.MET_used, events.BJetGood,
+                                      {"b_CvsL": "btagCvL", "b_CvsB": "btagCvB", "b_Btag": "btagB"},
+                                      backend=processor.kinematics_backend, dtype=processor.feature_dtype)
+
+for name in ["W_m", "W_pt", "W_mt", "deltaPhi_l1_b", "deltaEta_l1_b", "deltaR_l1_b",
+             "b_CvsL", "b_CvsB", "b_Btag", "top_mass"]:
+    FEATURES.alias(name, f"WLNu_kinematics.{name}", channels=["1L"])
+FEATURES.alias("W_phi", "MET_used.phi", channels=["1L"])
+FEATURES.alias("pt_miss", "MET_used.pt", channels=["1L"])
+
+@FEATURES.feature("W_eta", depends=["W_pt"], channels=["1L"])
+def _(events, processor):
+    return ak.zeros_like(events.W_pt)
+
+@FEATURES.feature("LeptonCategory", channels=["1L"])
+def _(events, processor):
+    return ak.values_astype(events["nMuonGood"]==1,"int32")
+
+@FEATURES.feature("WH_deltaPhi", depends=["WLNu_kinematics"], channels=["1L"])
+def _(events, processor):
+    return np.abs(delta_phi(events.WLNu_kinematics.W_candidate_phi, events.dijet_csort.phi))
+
+@FEATURES.feature("deltaPhi_l1_j1", depends=["lead_lep"], channels=["1L"])
+def _(events, processor):
+    return np.abs(delta_phi(events.lead_lep.phi, events.dijet_csort.j1Phi))
+
+@FEATURES.feature("deltaPhi_l1_MET", depends=["lead_lep", "MET_used"], channels=["1L"])
+def _(events, processor):
+    return np.abs(delta_phi(events.lead_lep.phi, events.MET_used.phi))
+
+# The objects, for the histograms and columns reading them
+@FEATURES.feature("W_candidate", depends=["lead_lep", "MET_used"], channels=["1L"])
+def _(events, processor):
+    return events.lead_lep + events.MET_used
+
+@FEATURES.feature("b_jet", depends=["lead_lep"], channels=["1L"])
+def _(events, processor):
+    # b-jet closest to the leading lepton
+    ### FIXME: Check if we need to mask events with no b-jets
+    min_delta_r_index = ak.argmin(events.BJetGood.delta_r(events.lead_lep), axis=1, keepdims=True)
+    return events.BJetGood[min_delta_r_index]
+
+@FEATURES.feature("neutrino_from_W", depends=["lead_lep", "MET_used"], channels=["1L"])
+def _(events, processor):
+    return kinematics.neutrino_from_W(events.lead_lep, events.MET_used, backend=processor.kinematics_backend)
+
+@FEATURES.feature("top_candidate", depends=["lead_lep", "b_jet", "neutrino_from_W"], channels=["1L"])
+def _(events, processor):
+    return events.lead_lep + events.b_jet + events.neutrino_from_W
+
+### 0L
+@FEATURES.feature("Z_candidate", depends=["MET_used"], channels=["0L"])
+def _(events, processor):
+    return events.MET_used
+
+FEATURES.alias("Z_pt", "Z_candidate.pt", channels=["0L"])
+FEATURES.alias("Z_phi", "Z_candidate.phi", channels=["0L"])
+
+@FEATURES.feature("Z_eta", depends=["Z_candidate"], channels=["0L"])
+def _(events, processor):
+    return ak.zeros_like(events.Z_candidate.pt)
+
+@FEATURES.feature("Z_m", depends=["Z_candidate"], channels=["0L"])
+def _(events, processor):
+    return ak.ones_like(events.Z_candidate.pt)*91.1876
+
+@FEATURES.feature("ZH_pt_ratio", depends=["Z_candidate"], channels=["0L"])
+def _(events, processor):
+    return events.dijet_csort.pt/events.Z_candidate.pt
+
+@FEATURES.feature("ZH_deltaPhi", depends=["Z_candidate"], channels=["0L"])
+def _(events, processor):
+    return np.abs(events.Z_candidate.delta_phi(events.dijet_csort))
 
 class VHccBaseProcessor(BaseProcessorABC):
     def __init__(self, cfg: Configurator):
@@ -87,23 +191,30 @@ class VHccBaseProcessor(BaseProcessorABC):
         self.save_arrays = self.params["save_arrays"]
         self.run_dnn     = self.params["run_dnn"]
         self.run_gnn     = self.params["run_gnn"]
-        #self.bdt_model = lgb.Booster(model_file=self.params.LightGBM_model)
-        #self.bdt_low_model = lgb.Booster(model_file=self.params.LigtGBM_low)
-        #self.bdt_high_model = lgb.Booster(model_file=self.params.LigtGBM_high)
-        #self.dnn_model = load_model(self.params.DNN_model)
-        #self.dnn_low_model = load_model(self.params.DNN_low)
-        #self.dnn_high_model = load_model(self.params.DNN_high)
-    
-        # Define the prediction functions with @tf.function
-        #self.predict_dnn = tf.function(self.model.predict, reduce_retracing=True)
-        #self.predict_dnn_low = tf.function(self.model_low.predict, reduce_retracing=True)
-        #self.predict_dnn_high = tf.function(self.model_high.predict, reduce_retracing=True)
-
-        if self.run_gnn:
-            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # numba or numpy, default numba if installed on the workers
+        self.kinematics_backend = self.params.get("kinematics_backend", None)
+        # Jets kept in the tagger-sorted collection JetsCvsL, at least 2; None keeps all
+        self.tagger_top_k = self.params.get("tagger_top_k", 2)
+        if self.tagger_top_k is not None and self.tagger_top_k < 2:
+            raise ValueError(f"tagger_top_k must be at least 2 for the dijet candidates (or None), got {self.tagger_top_k}")
+        # Category and subsample cuts evaluated once per chunk and variation, shared by all the selections
+        self._cut_cache = CommonSelectors.CutCache()
+        self._categories = CommonSelectors.MemoizedSelection.from_selection(self._categories, self._cut_cache)
+        self._subsamples = {sample: CommonSelectors.MemoizedSelection.from_selection(subsamples, self._cut_cache)
+                            for sample, subsamples in self._subsamples.items()}
+        # Event features computed in define_common_variables_after_presel (None: all of them)
+        self.requested_features = self.feature_consumers() if self.params.Features.lazy else None
+        # dtype of the objects the features are aliases of (dijet_csort, WLNu_kinematics), None keeps the jet dtype
+        self.feature_dtype = np.float32 if self.params.Features.float32 else None
 
         print("Processor initialized")
         
+    def process_extra_after_skim(self):
+        super().process_extra_after_skim()
+        # MVA score cache of this chunk, shared by its shape variations (run_mva_stage)
+        self._mva_cache = {}
+        self._mva_stage = None
+
     def apply_object_preselection(self, variation):
         '''
         
@@ -120,11 +231,11 @@ class VHccBaseProcessor(BaseProcessorABC):
         self.events["ElectronGood"] = lepton_selection(
             self.events, "Electron", self.params
         )
-        leptons = ak.with_name(
-            ak.concatenate((self.events.MuonGood, self.events.ElectronGood), axis=1),
+        # MuonGood and ElectronGood are pt-sorted: merged instead of sorting their concatenation
+        self.events["LeptonGood"] = ak.with_name(
+            kinematics.merge_sorted(self.events.MuonGood, self.events.ElectronGood, backend=self.kinematics_backend),
             name='PtEtaPhiMCandidate',
         )
-        self.events["LeptonGood"] = leptons[ak.argsort(leptons.pt, ascending=False)]
 
         self.events["ll"] = get_dilepton(
             self.events.ElectronGood, self.events.MuonGood
@@ -180,523 +291,359 @@ class VHccBaseProcessor(BaseProcessorABC):
         # self.events["nfatjet"]   = ak.num(self.events.FatJetGood)
 
 
+    def get_model(self, kind, channel, loader, *paths):
+        # Models are cached per worker process, so each one is read from disk only once,
+        # and with a store_dir their weights are memory-mapped and shared by the processes of a node
+        if self.params.ModelRegistry.store_dir:
+            loader = partial(loader, store_dir=self.params.ModelRegistry.store_dir)
+        registry = get_registry(self.params.ModelRegistry.max_size_mb)
+        return registry.get(kind, channel, self._year, loader, *paths)
+
+    def mva_consumers(self, *fields):
+        '''
+        Categories that read any of the given event fields, in a histogram or in the saved
+        columns of the current sample. None if all the categories do.
+        '''
+        all_categories = set(self._categories.keys())
+        categories = set()
+        for histconf in self.cfg.variables.values():
+            if not any(axis.coll == "events" and axis.field in fields for axis in histconf.axes):
+                continue
+            if histconf.only_samples is not None and self._sample not in histconf.only_samples:
+                continue
+            if histconf.exclude_samples is not None and self._sample in histconf.exclude_samples:
+                continue
+            if histconf.only_categories is not None:
+                categories.update(histconf.only_categories)
+            elif histconf.exclude_categories is not None:
+                categories.update(all_categories - set(histconf.exclude_categories))
+            else:
+                return None
+        for sample, columns in self._columns.items():
+            if sample != self._sample and not sample.startswith(f"{self._sample}__"):
+                continue
+            for category, colouts in columns.items():
+                if any(c.collection == "events" and set(fields) & set(c.columns) for c in colouts):
+                    categories.add(category)
+        return None if categories >= all_categories else categories
+
+    def feature_consumers(self):
+        '''
+        Event fields read by the histograms, the saved columns, the category and subsample cuts and
+        the MVA stage of the channel, and the ones in Features.always. None if the fields read by a
+        cut are not declared (CommonSelectors.reads), then all the features are computed.
+        '''
+        fields = set(self.params.Features.always)
+        for histconf in self.cfg.variables.values():
+            fields.update(axis.field if axis.coll == "events" else axis.coll for axis in histconf.axes)
+        for columns in self._columns.values():
+            for colouts in columns.values():
+                for c in colouts:
+                    fields.update(c.columns if c.collection == "events" else [c.collection])
+        for cut in find_cuts([self._categories, self._subsamples]):
+            read = cut_fields(cut)
+            if read is None:
+                print(f"Fields read by the cut {cut.name} not declared, all the event features are computed")
+                return None
+            fields |= read
+        channel = CHANNELS[self.proc_type]
+        if channel in self.params.MVAStage:
+            config = self.params.MVAStage[channel]
+            fields.update(config.features)
+            fields.update(s for s in (config.gnn.get(name, name) for name in GNN_FLAT) if isinstance(s, str))
+        if channel in self.params.SplitModels:
+            fields.add(self.params.SplitModels[channel].variable)
+        return fields
+
+    def feature_memory(self, nbytes, variation):
+        '''
+        Bytes owned by the event features of the chunk as computed and as stored (cast to float32 with
+        Features.float32; the aliases own none), and the memory of the process, kept in the feature_memory output.
+        '''
+        computed = sum(n[0] for n in nbytes.values())/1024**2
+        stored = sum(n[1] for n in nbytes.values())/1024**2
+        rss, peak = memory_mb()
+        output = self.output.setdefault("feature_memory", {}).setdefault(self._dataset, {}).setdefault(variation, {})
+        stats = {"events": len(self.events), "features": len(nbytes), "computed_mb": computed,
+                 "stored_mb": stored, "rss_mb": rss, "peak_mb": peak}
+        for key, value in stats.items():
+            output[key] = [value]
+        if self.params.Features.report:
+            print(f"Event features {self.channel} ({self._dataset}, {variation}): {len(nbytes)} features of "
+                  f"{len(self.events)} events, {computed:.1f} MB as computed, {stored:.1f} MB stored, "
+                  f"process {rss:.0f} MB (peak {peak:.0f} MB)")
+
+    def mva_rows(self, *fields):
+        '''
+        Mask of the events to score for the given MVA outputs: the union of the categories
+        that use them. None means all the events.
+        '''
+        if not self.params.MVAEvaluation.selection_aware:
+            return None
+        categories = self.mva_consumers(*fields)
+        if categories is None:
+            return None
+        # The cuts do not depend on the scores, so the category masks can be computed now.
+        # define_categories computes them again after the MVA evaluation.
+        if not self._categories_ready:
+            self._categories.prepare(
+                events=self.events,
+                processor_params=self.params,
+                year=self._year,
+                sample=self._sample,
+                isMC=self._isMC,
+            )
+            self._categories_ready = True
+        if isinstance(self._categories, CommonSelectors.MemoizedSelection):
+            return self._categories.any_of(categories)
+        rows = np.zeros(len(self.events), dtype=bool)
+        for category in categories:
+            rows |= np.asarray(self._categories.get_mask(category))
+        return rows
+
+    def count_events(self, variation):
+        '''
+        As BaseProcessorABC.count_events, with the cutflow of the categories and subsamples counted by
+        popcount on their bitsets (MemoizedSelection.count); the sums of weights use the decoded masks.
+        '''
+        def bitset(selection):
+            return isinstance(selection, CommonSelectors.MemoizedSelection) and selection.membership is not None
+        categories, subsamples = self._categories, self._subsamples[self._sample]
+        if not bitset(categories) or (self._hasSubsamples and not bitset(subsamples)):
+            return super().count_events(variation)
+        for category in categories.keys():
+            cutflow = self.output["cutflow"][category].setdefault(self._dataset, {})
+            cutflow.setdefault(self._sample, {})[variation] = categories.count(category)
+            if self._isMC:
+                mask = categories.get_mask(category)
+                w = self.weights_manager.get_weight(category)
+                self.output["sumw"][category].setdefault(self._dataset, {}).setdefault(self._sample, {})[variation] = ak.sum(w * mask)
+                self.output["sumw2"][category].setdefault(self._dataset, {}).setdefault(self._sample, {})[variation] = ak.sum((w**2) * mask)
+
+            if self._hasSubsamples:
+                for subs in subsamples.keys():
+                    cutflow.setdefault(f"{self._sample}__{subs}", {})[variation] = categories.count(category, subsamples, subs)
+                    if self._isMC:
+                        mask_withsub = mask & subsamples.get_mask(subs)
+                        w_tot = w * self.weights_manager.get_weight_only_subsample(subsample=f"{self._sample}__{subs}",
+                                                                                   category=category)
+                        self.output["sumw"][category].setdefault(self._dataset, {}).setdefault(f"{self._sample}__{subs}", {})[variation] = ak.sum(w_tot * mask_withsub)
+                        self.output["sumw2"][category].setdefault(self._dataset, {}).setdefault(f"{self._sample}__{subs}", {})[variation] = ak.sum(((w_tot)**2) * mask_withsub)
+
+    def define_categories(self, variation):
+        super().define_categories(variation)
+        # Cuts evaluated and reused for the categories and subsamples, kept in the cut_cache output
+        output = self.output.setdefault("cut_cache", {}).setdefault(self._dataset, {}).setdefault(variation, {})
+        output["evaluated"] = [self._cut_cache.evaluated]
+        output["reused"] = [self._cut_cache.reused]
+        # The categories and subsamples of the chunk are in their bitsets, the cut masks are not needed anymore
+        self._cut_cache.reset()
+
     def evaluateBDT(self, data):
-        #print(self.params.Models.BDT[self.channel][self.events.metadata["year"]].model_file)
-        #print()
-        # Read the model file
-        model = lgb.Booster(model_file=self.params.Models.BDT[self.channel][self.events.metadata["year"]].model_file)
-        #bdt_score = self.bdt_model.predict(data)
+        model = self.get_model("BDT", self.channel, load_bdt,
+                               self.params.Models.BDT[self.channel][self._year].model_file)
         bdt_score = model.predict(data)
-        # Release memory
-        del model
-        gc.collect()
 
         return bdt_score
     
     def evaluateseparateBDTs(self, data):
-        data_df_low = data[data['dilep_pt'] < 150]
-        data_df_high = data[data['dilep_pt'] >= 150]
-        
-        # Initialize empty arrays for scores
-        bdt_score_low = np.array([])
-        bdt_score_high = np.array([])
-        
-        # Read the model files
-        model_low = lgb.Booster(model_file=self.params.Models.BDT[f'{self.channel}_low'][self.events.metadata["year"]].model_file)
-        model_high = lgb.Booster(model_file=self.params.Models.BDT[f'{self.channel}_high'][self.events.metadata["year"]].model_file)
-        
-        # Predict only if data_df_low is non-empty
-        if not data_df_low.empty:
-            #bdt_score_low = self.bdt_low_model.predict(data_df_low)
-            bdt_score_low = model_low.predict(data_df_low)
-        
-        # Predict only if data_df_high is non-empty
-        if not data_df_high.empty:
-            #bdt_score_high = self.bdt_high_model.predict(data_df_high)
-            bdt_score_high = model_high.predict(data_df_high)
-        
-        # Concatenate the scores from low and high dataframes
-        bdt_score = np.concatenate((bdt_score_low, bdt_score_high), axis=0)
-        
-        # Release memory
-        del model_low, model_high
-        gc.collect()
-
-        return bdt_score
+        return self.evaluate_split("BDT", load_bdt, data)
     
     def evaluateDNN(self, data):
-        
-        #print("Evaluating DNN...")
-        #print(self.params.Models.DNN[self.channel][self.events.metadata["year"]].model_file)
-        #print()
-        # Load the model on demand
-        with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues
-            model = load_model(self.params.Models.DNN[self.channel][self.events.metadata["year"]].model_file)
-            dnn_score = model.predict(data, batch_size=32).ravel()
-        # Release memory
-        tf.keras.backend.clear_session()
-        del model
-        gc.collect()
-        #print("DNN evaluation completed.")
+        model = self.get_model("DNN", self.channel, load_dnn,
+                               self.params.Models.DNN[self.channel][self._year].model_file)
+        dnn_score = model.predict(data).ravel()
         return dnn_score
 
     
     def evaluateseparateDNNs(self, data):
-        
-        data_df_low = data[data['dilep_pt'] < 150]
-        data_df_high = data[data['dilep_pt'] >= 150]
-        
-        # Initialize empty arrays for scores
-        dnn_score_low = np.array([])
-        dnn_score_high = np.array([])
-        
-        # Read the model file
-        model_low = load_model(self.params.Models.DNN[f'{self.channel}_low'][self.events.metadata["year"]].model_file)
-        model_high = load_model(self.params.Models.DNN[f'{self.channel}_high'][self.events.metadata["year"]].model_file)
-        
-        # Predict only if data_df_low is non-empty
-        if not data_df_low.empty:
-            print("Predicting for low dilep_pt...")
-            with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues
-                model_low = load_model(self.params.DNN_low)
-                dnn_score_low = model_low.predict(data_df_low, batch_size=32).ravel()
-            tf.keras.backend.clear_session()
-            del model_low
-            gc.collect()
-            print("Prediction for low dilep_pt completed.")
-        
-        # Predict only if data_df_high is non-empty
-        if not data_df_high.empty:
-            print("Predicting for high dilep_pt...")
-            with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues
-                model_high = load_model(self.params.DNN_high)
-                dnn_score_high = model_high.predict(data_df_high, batch_size=32).ravel()
-            tf.keras.backend.clear_session()
-            del model_high
-            gc.collect()
-            print("Prediction for high dilep_pt completed.")
-        
-        
-        
-        dnn_score = np.concatenate((dnn_score_low, dnn_score_high), axis=0)
-        
-        print("Separate DNN evaluation completed.")
-        
-        return dnn_score
-    
-    def resize_tensor(self,tensor,target):
-        m, n, p = tensor.shape
-        
-        if n > target:
-            return tensor[:, :target, :]
-        elif n < target:
-            padding = torch.zeros((m, target - n, p), device=tensor.device, dtype=tensor.dtype)
-            return torch.cat((tensor, padding), dim=1)
-        else:
-            return tensor
-
-    def evaluateGNN(self,data):
-        # model = torch.jit.load(self.params.Models.GNN[self.channel][self.events.metadata["year"]].model_file) #TODO This would be the most elegant way, but the current model does not work with torch.jit
-
-        modelparams = pickle.load(open(self.params.Models.GNN["Global"].params,'rb'))
-        model = GraphAttentionClassifier(**modelparams)
-        model.load_state_dict(torch.load(self.params.Models.GNN["Global"].model_file,weights_only=True,map_location=self.device))
-        model.eval()
-
-        eramap = {  "2022_preEE":   0,
-                    "2022_postEE":  1,
-                    "2023_preBPix": 2,
-                    "2023_postBPix":3,
-                }
-
-        data["era"] = eramap[self._year]
-        ln = len(data)
-
-        if self.proc_type=="ZLL":
-            data["V_pt"] = data["ll_pt"]
-            data["V_eta"] = data["ll_eta"]
-            data["V_phi"] = data["ll_phi"]
-            data["V_mass"] = data["ll_mass"]
-            data["W_m"] = ak.zeros_like(data["PuppiMET_pt"])
-            data["channel"] = ak.ones_like(data["PuppiMET_pt"])*2
-
-        elif self.proc_type=="WLNu":
-            data["V_pt"] = data["W_pt"]
-            data["V_eta"] = data["W_eta"]
-            data["V_phi"] = data["W_phi"]
-            data["V_mass"] = data["W_mt"]
-            data["channel"] = ak.ones_like(data["PuppiMET_pt"])
-
-        elif self.proc_type=="ZNuNu":
-            data["V_pt"] = data["Z_pt"]
-            data["V_eta"] = data["Z_eta"]
-            data["V_phi"] = data["Z_phi"]
-            data["V_mass"] = data["Z_m"]
-            data["W_m"] = ak.zeros_like(data["PuppiMET_pt"])
-            data["channel"] = ak.zeros_like(data["PuppiMET_pt"])
-            data["LeptonCategory"] = ak.zeros_like(data["PuppiMET_pt"])
-
-        optionaljagged = ['LeptonGood_miniPFRelIso_all',
-            'LeptonGood_pfRelIso03_all', 'LeptonGood_pt',
-            'LeptonGood_eta', 'LeptonGood_phi',
-            'LeptonGood_mass'
-        ]
-        for opt in optionaljagged:
-            if opt not in data.fields:
-                data[opt] = np.zeros([ln, 1]).tolist()
-
-
-        varslist =  ["JetGood_btagCvL","JetGood_btagCvB",
-                    "JetGood_pt","JetGood_eta","JetGood_phi","JetGood_mass",
-                    "LeptonGood_miniPFRelIso_all","LeptonGood_pfRelIso03_all",
-                    "LeptonGood_pt","LeptonGood_eta","LeptonGood_phi","LeptonGood_mass",
-                    "V_pt","V_eta","V_phi","V_mass",
-                    "PuppiMET_pt","PuppiMET_phi","nPV","W_m",
-                    "LeptonCategory","channel","era"]
-
-        batch_size = 1024*8
-        all_predictions = []
-
-        for start_idx in range(0, ln, batch_size):
-            batch_data = data[start_idx:start_idx + batch_size]
-
-            X = batch_data[varslist]
-            tensordict, _ = process_gnn_inputs(X, removenans=False)
-
-            with torch.no_grad():
-                batch_prediction = model(
-                    tensordict["jet"],
-                    tensordict["jetP4"],
-                    tensordict["lep"],
-                    tensordict["lepP4"],
-                    tensordict["VP4"],
-                    tensordict["global"],
-                    tensordict["category"]
-                )[:, 0]
-
-            all_predictions.append(batch_prediction.cpu())
-
-            del tensordict
-            gc.collect()
-
-        all_predictions = torch.cat(all_predictions)
-        all_predictions = torch.nan_to_num(all_predictions)
-
-        return all_predictions.numpy()
+        return self.evaluate_split("DNN", load_dnn, data)
 
-        
-            
+    def evaluate_split(self, kind, loader, data):
+        '''
+        Score each event with the model of its partition, '{channel}_{name}' in Models, with the
+        partitions of the channel defined in SplitModels. The scores keep the order of the events.
+        '''
+        # The index of data is the event position, also when only a subset of the events is scored
+        key = self.split_partition()[np.asarray(data.index)]
+        models = {i: partial(self.predict_split, kind, f'{self.channel}_{name}', loader)
+                  for i, name in enumerate(self.params.SplitModels[self.channel].names)}
+        return evaluate_partitions(data, key, models)
+
+    def split_partition(self):
+        split = self.params.SplitModels[self.channel]
+        return partition_key(self.events[split.variable], split.get("edges"), split.get("modulo"))
+
+    def predict_split(self, kind, channel, loader, data):
+        model = self.get_model(kind, channel, loader,
+                               self.params.Models[kind][channel][self._year].model_file)
+        return model.predict(data).ravel()
     
+    def gnn_model(self):
+        # The exported model is a frozen TorchScript trace of the GraphAttentionClassifier.
+        # torch.set_num_threads is process-wide: the threads are set here, in the main thread,
+        # and not by the background thread while the histograms are filled
+        gnn_inference.set_threads(self.params.GNNInference.num_threads)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        export = self.params.GNNInference.export
+        kind = "GNN_exported" if export else "GNN"
+        model = self.get_model(kind, "Global", partial(load_gnn, device=device, export=export),
+                               self.params.Models.GNN["Global"].model_file,
+                               self.params.Models.GNN["Global"].params)
+        return model, device
+
+    def evaluateGNN(self, inputs, model=None):
+        # model is loaded beforehand (gnn_model) when the GNN is evaluated in a background thread
+        model, device = model if model is not None else self.gnn_model()
+
+        # inputs are the padded arrays of gnn_inputs, the batches are views of them
+        batch_size = gnn_inference.batch_size_for(self.params.GNNInference.memory_mb)
+        scores = gnn_inference.run_batched(model, inputs, batch_size, device,
+                                           report=self.params.GNNInference.report)
+        return np.nan_to_num(scores)
+
+    def run_mva_stage(self, variation):
+        '''
+        Evaluate the MVA heads of the channel in one MVAStage, with the inputs configured in MVAStage
+        of params/trainings.yaml, and write their scores into the events. The heads not run (run_dnn,
+        run_gnn) get zeros.
+
+        With MVAStage.background the GNN is evaluated in a background thread: its scores are only
+        written by join_mva, once the histograms that do not use them are filled.
+        '''
+        config = self.params.MVAStage[self.channel]
+        # The scores of the chunk are cached by input row, so the shape variations
+        # only evaluate the events whose inputs they change
+        cache = self._mva_cache.setdefault(self.channel, {}) if self.params.MVAStage.cache else None
+        stage = MVAStage(config.features, {**config.gnn, "era": ERAS[self._year]}, cache)
+        separate = self.params.get("separate_models", False) and self.channel in self.params.SplitModels
+        # The partition of the split models is part of the cache key
+        extra = [self.split_partition()] if separate else None
+        stage.add_head("BDT", self.evaluateseparateBDTs if separate else self.evaluateBDT, rows=self.mva_rows("BDT"), extra=extra)
+        if self.run_dnn:
+            stage.add_head("DNN", self.evaluateseparateDNNs if separate else self.evaluateDNN, rows=self.mva_rows("DNN"), extra=extra)
+        if self.run_gnn:
+            background = self.params.MVAStage.background
+            evaluate = partial(self.evaluateGNN, model=self.gnn_model()) if background else self.evaluateGNN
+            stage.add_head("GNN", evaluate, "gnn", self.mva_rows("GNN", "GNN_transformed"), background=background)
+        scores = stage.run(self.events)
+
+        zeros = np.zeros_like(scores["BDT"])
+        self._mva_scores = {"BDT": scores["BDT"], "DNN": scores.get("DNN", zeros), "GNN": scores.get("GNN", zeros)}
+        self._mva_stage = (stage, variation)
+        # The scores evaluated in the background are futures until join_mva
+        for name, values in self._mva_scores.items():
+            if not isinstance(values, Future):
+                self.events[name] = values
+        if not self.mva_pending():
+            self.join_mva()
+
+    def mva_pending(self):
+        '''Event fields of the scores still evaluated in the background.'''
+        if self._mva_stage is None:
+            return set()
+        pending = {name for name, values in self._mva_scores.items() if isinstance(values, Future)}
+        if pending:
+            pending |= {"MVA", "GNN_transformed"} if "GNN" in pending else {"MVA"}
+        return pending
+
+    def join_mva(self):
+        '''
+        Wait for the scores evaluated in the background and write the MVA record and the
+        BDT, DNN, GNN and GNN_transformed fields of the events, and the stage stats.
+        '''
+        if self._mva_stage is None:
+            return
+        stage, variation = self._mva_stage
+        self._mva_stage = None
+        mva = {name: values.result() if isinstance(values, Future) else values for name, values in self._mva_scores.items()}
+        mva["GNN_transformed"] = np.power(mva["GNN"], 9)
+        self.events["MVA"] = ak.zip(mva, depth_limit=1)
+        # The histograms and the saved columns read the scores as event fields (the same arrays)
+        for name, values in mva.items():
+            self.events[name] = values
+
+        # Per-chunk time and memory of each head, concatenated over the chunks by the accumulator
+        output = self.output.setdefault("mva_stage", {}).setdefault(self._dataset, {}).setdefault(variation, {})
+        for name, stats in stage.stats.items():
+            output[name] = {k: [v] for k, v in stats.items()}
+        if self.params.MVAStage.report:
+            print(f"MVA stage {self.channel} ({self._dataset}, {variation}): {stage.report()}")
+
+    def score_histograms(self, fields):
+        '''Names of the histograms with an axis reading one of the given event fields or the MVA record.'''
+        return {name for name, histconf in self.cfg.variables.items()
+                if any((axis.coll == "events" and axis.field in fields) or axis.coll == "MVA" for axis in histconf.axes)}
+
+    def fill_histograms(self, variation):
+        pending = self.mva_pending()
+        if not pending:
+            return super().fill_histograms(variation)
+        # The histograms that do not use the background scores are filled while they are computed,
+        # the others once they are joined. Each pass only autofills its histograms (HistConf.autofill)
+        autofill = {(sub, name): h.autofill for sub, hists in self.hists_manager.histograms.items()
+                    for name, h in hists.items()}
+        waiting = self.score_histograms(pending)
+        def select(scores):
+            for (sub, name), enabled in autofill.items():
+                self.hists_manager.histograms[sub][name].autofill = enabled and (name in waiting) == scores
+        try:
+            select(scores=False)
+            super().fill_histograms(variation)
+            self.join_mva()
+            select(scores=True)
+            super().fill_histograms(variation)
+        finally:
+            for (sub, name), enabled in autofill.items():
+                self.hists_manager.histograms[sub][name].autofill = enabled
+
+    def fill_column_accumulators(self, variation):
+        self.join_mva()
+        # The projections saved as event columns (e.g. events_JetGood_pt) are added to a copy of the
+        # events record that only lives while the columns are filled
+        names = {name for columns in self._columns.values() for colouts in columns.values()
+                 for c in colouts if c.collection == "events" for name in c.columns
+                 if name in PROJECTIONS and name not in self.events.fields}
+        events = self.events
+        for name in sorted(names):
+            self.events = ak.with_field(self.events, event_field(events, name), name)
+        try:
+            super().fill_column_accumulators(variation)
+        finally:
+            self.events = events
+
     # Function that defines common variables employed in analyses and save them as attributes of `events`
     def define_common_variables_before_presel(self, variation):
         self.events["JetGood_Ht"] = ak.sum(abs(self.events.JetGood.pt), axis=1)
-
-        jetvars = ["btagCvL","btagCvB"]
-        leptonvars = ["miniPFRelIso_all","pfRelIso03_all"]
-        p4vars = ["pt","eta","phi","mass"]
-
-        for var in jetvars+p4vars:
-            self.events["JetGood_"+var] = self.events.JetGood[var]
-        for var in leptonvars+p4vars:
-            self.events["LeptonGood_"+var] = self.events.LeptonGood[var]
-        for var in p4vars:
-            self.events["ll_"+var] = self.events.ll[var]
-
-        self.events["PuppiMET_pt"] = self.events.PuppiMET.pt
-        self.events["PuppiMET_phi"] = self.events.PuppiMET.phi
-        self.events["nPV"] = self.events.PV.npvsGood
+        # JetGood_pt, LeptonGood_pt, ll_pt, PuppiMET_pt, nPV, ... are not copied into the events:
+        # the MVA inputs read them from their collection (MVA.inputs.PROJECTIONS) and the saved
+        # columns only get them while they are filled (fill_column_accumulators)
 
 
 
     def define_common_variables_after_presel(self, variation):
-        
-        self.events["dijet"] = get_dijet(self.events.JetGood)
+        # Category masks of this chunk and variation, computed on demand by mva_rows
+        self._categories_ready = False
+        self._cut_cache.reset()
 
         if self.newjetdefiniton:
-            self.events["JetsCvsL"] = CvsLsorted(self.events["JetGood"])
-            self.events["dijet_csort"] = get_dijet(self.events.JetsCvsL)
+            tags = {"CvsL": "btagCvL", "CvsB": "btagCvB"}
         else:
-            #TODO: This is temporary
-            self.events["JetsCvsL"] = CvsLsorted(self.events["JetGood"], tagger = self.myJetTagger)
-            self.events["dijet_csort"] = get_dijet(self.events.JetsCvsL, tagger = self.myJetTagger)
-
-        #self.events["dijet_pt"] = self.events.dijet.pt
-        
-        if self.proc_type=="ZLL":
-
-            ### General
-            self.events["dijet_m"] = self.events.dijet_csort.mass
-            self.events["dijet_pt"] = self.events.dijet_csort.pt
-            self.events["dijet_dr"] = self.events.dijet_csort.deltaR
-            self.events["dijet_deltaPhi"] = self.events.dijet_csort.deltaPhi
-            self.events["dijet_deltaEta"] = self.events.dijet_csort.deltaEta
-            self.events["dijet_CvsL_max"] = self.events.dijet_csort.j1CvsL
-            self.events["dijet_CvsL_min"] = self.events.dijet_csort.j2CvsL
-            self.events["dijet_CvsB_max"] = self.events.dijet_csort.j1CvsB
-            self.events["dijet_CvsB_min"] = self.events.dijet_csort.j2CvsB
-            self.events["dijet_pt_max"] = self.events.dijet_csort.j1pt
-            self.events["dijet_pt_min"] = self.events.dijet_csort.j2pt
-
-            self.events["dilep_m"] = self.events.ll.mass
-            self.events["dilep_pt"] = self.events.ll.pt
-            self.events["dilep_dr"] = self.events.ll.deltaR
-            self.events["dilep_deltaPhi"] = self.events.ll.deltaPhi
-            self.events["dilep_deltaEta"] = self.events.ll.deltaEta
-
-            self.events["LeptonCategory"] = ak.values_astype(self.events["nMuonGood"]==2,"int32")
-            
-            self.events["ZH_pt_ratio"] = self.events.dijet_csort.pt/self.events.ll.pt
-            self.events["ZH_deltaPhi"] = np.abs(self.events.ll.delta_phi(self.events.dijet_csort))
-
-            # why cant't we use delta_phi function here?
-            self.angle21_gen = (abs(self.events.ll.l2phi - self.events.dijet_csort.j1Phi) < np.pi)
-            self.angle22_gen = (abs(self.events.ll.l2phi - self.events.dijet_csort.j2Phi) < np.pi)
-            self.events["deltaPhi_l2_j1"] = ak.where(self.angle21_gen, abs(self.events.ll.l2phi - self.events.dijet_csort.j1Phi), 2*np.pi - abs(self.events.ll.l2phi - self.events.dijet_csort.j1Phi))              
-            self.events["deltaPhi_l2_j2"] = ak.where(self.angle22_gen, abs(self.events.ll.l2phi - self.events.dijet_csort.j2Phi), 2*np.pi - abs(self.events.ll.l2phi - self.events.dijet_csort.j2Phi))
-            self.events["deltaPhi_l2_j1"] = np.abs(delta_phi(self.events.ll.l2phi, self.events.dijet_csort.j1Phi))
-            
-            #events = self.events[odd_event_mask]
-            # Create a record of variables to be dumped as root/parquete file:
-
-            variables_for_MVA_eval_list = ["dilep_m","dilep_pt","dilep_dr","dilep_deltaPhi","dilep_deltaEta",
-                                    "dijet_m","dijet_pt","dijet_dr","dijet_deltaPhi","dijet_deltaEta",
-                                    "dijet_CvsL_max","dijet_CvsL_min","dijet_CvsB_max","dijet_CvsB_min",
-                                    "dijet_pt_max","dijet_pt_min",
-                                    "ZH_pt_ratio","ZH_deltaPhi","deltaPhi_l2_j1","deltaPhi_l2_j2"]
-
-            variables_for_MVA_eval = ak.zip({v:self.events[v] for v in variables_for_MVA_eval_list})  #TODO: use odd_events instead
-
-            gnn_vars = ["JetGood_btagCvL","JetGood_btagCvB",
-                        "JetGood_pt","JetGood_eta","JetGood_phi","JetGood_mass",
-                        "LeptonGood_miniPFRelIso_all","LeptonGood_pfRelIso03_all",
-                        "LeptonGood_pt","LeptonGood_eta","LeptonGood_phi","LeptonGood_mass",
-                        "ll_pt","ll_eta","ll_phi","ll_mass",
-                        "PuppiMET_pt","PuppiMET_phi","nPV","LeptonCategory"]
-
-            ak_gnn = self.events[gnn_vars] #TODO: use odd_events instead
-            
-            df = ak.to_pandas(variables_for_MVA_eval)
-            columns_to_exclude = ['dilep_m']
-            df = df.drop(columns=columns_to_exclude, errors='ignore')
-
-            self.channel = "2L"
-            if not self.params.separate_models: 
-                df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-
-                bdt_predictions = self.evaluateBDT(df_final)
-                bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-                # Convert NaN to None
-                bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-                self.events["BDT"] = bdt_predictions
-                
-                if self.run_dnn:
-                    self.events["DNN"] = self.evaluateDNN(df_final)
-                else:
-                    self.events["DNN"] = np.zeros_like(self.events["BDT"])
-
-                if self.run_gnn:
-                    self.events["GNN"] = self.evaluateGNN(ak_gnn)
-                    self.events["GNN_transformed"] = np.power(self.events["GNN"],9)
-                else:
-                    self.events["GNN"] = np.zeros_like(self.events["BDT"])
-                    self.events["GNN_transformed"] = np.zeros_like(self.events["BDT"])
-            else:
-                df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-
-                bdt_predictions = self.evaluateseparateBDTs(df_final)
-                bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-                # Convert NaN to None
-                bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-                self.events["BDT"] = bdt_predictions
-                
-                if self.run_dnn:
-                    self.events["DNN"] = self.evaluateseparateDNNs(df_final)
-                else:
-                    self.events["DNN"] = np.zeros_like(self.events["BDT"])
-                
-        if self.proc_type=="WLNu":
-            self.events["MET_used"] = ak.zip({
-                                        "pt": self.events.PuppiMET.pt,
-                                        "eta": ak.zeros_like(self.events.PuppiMET.pt),
-                                        "phi": self.events.PuppiMET.phi,
-                                        "mass": ak.zeros_like(self.events.PuppiMET.pt),
-                                        "charge": ak.zeros_like(self.events.PuppiMET.pt),
-                                        },with_name="PtEtaPhiMCandidate")
-            self.events["lead_lep"] = ak.firsts(self.events.LeptonGood)
-            self.events["W_candidate"] = self.events.lead_lep + self.events.MET_used
-            #print("W_candidate", self.events.W_candidate, self.events.W_candidate.mass, self.events.W_candidate.pt)
-            self.events["W_m"] = self.events.W_candidate.mass
-            self.events["W_pt"] = self.events.W_candidate.pt
-            self.events["W_eta"] = ak.zeros_like(self.events.W_candidate.pt)
-            self.events["W_phi"] = self.events.MET_used.phi
-            self.events["W_mt"] = np.sqrt(2*self.events.lead_lep.pt*self.events.MET_used.pt*(1-np.cos(self.events.lead_lep.delta_phi(self.events.MET_used))))
-            self.events["pt_miss"] = self.events.MET_used.pt
-            self.events["LeptonCategory"] = ak.values_astype(self.events["nMuonGood"]==1,"int32")
-
-            # Step 1: Calculate delta_r for each b_jet with respect to lead_lep
-            delta_rs = self.events.BJetGood.delta_r(self.events.lead_lep)
-
-            # Step 2: Find the index of the b_jet with the minimum delta_r
-            min_delta_r_index = ak.argmin(delta_rs, axis=1, keepdims=True)
-
-            # Step 3: Select the b_jet with the minimum delta_r
-            self.events["b_jet"] = self.events.BJetGood[min_delta_r_index]
-            
-            # Create a mask to ensure at least one b_jet is present
-            bjet_mask = ak.num(self.events.BJetGood) > 0
-            ### FIXME: Check if we need to mask events with no b-jets
-            
-            self.events["dijet_m"] = self.events.dijet_csort.mass
-            self.events["dijet_pt"] = self.events.dijet_csort.pt
-            self.events["dijet_dr"] = self.events.dijet_csort.deltaR
-            self.events["dijet_deltaPhi"] = self.events.dijet_csort.deltaPhi
-            self.events["dijet_deltaEta"] = self.events.dijet_csort.deltaEta
-            self.events["dijet_CvsL_max"] = self.events.dijet_csort.j1CvsL
-            self.events["dijet_CvsL_min"] = self.events.dijet_csort.j2CvsL
-            self.events["dijet_CvsB_max"] = self.events.dijet_csort.j1CvsB
-            self.events["dijet_CvsB_min"] = self.events.dijet_csort.j2CvsB
-            self.events["dijet_pt_max"] = self.events.dijet_csort.j1pt
-            self.events["dijet_pt_min"] = self.events.dijet_csort.j2pt
-            
-            self.events["deltaPhi_jet1_MET"] = np.abs(self.events.PuppiMET.delta_phi(self.events.JetGood[:,0]))
-            self.events["deltaPhi_jet2_MET"] = np.abs(self.events.PuppiMET.delta_phi(self.events.JetGood[:,1]))
-        
-            self.events["WH_deltaPhi"] = np.abs(self.events.W_candidate.delta_phi(self.events.dijet_csort))
-            self.events["deltaPhi_l1_j1"] = np.abs(delta_phi(self.events.lead_lep.phi, self.events.dijet_csort.j1Phi))
-            self.events["deltaPhi_l1_MET"] = np.abs(delta_phi(self.events.lead_lep.phi, self.events.MET_used.phi))
-            self.events["deltaPhi_l1_b"] = np.abs(delta_phi(self.events.lead_lep.phi, self.events.b_jet.phi))
-            self.events["deltaEta_l1_b"] = np.abs(self.events.lead_lep.eta - self.events.b_jet.eta)
-            self.events["deltaR_l1_b"] = np.sqrt((self.events.lead_lep.eta - self.events.b_jet.eta)**2 + (self.events.lead_lep.phi - self.events.b_jet.phi)**2)
-            self.events["b_CvsL"] = self.events.b_jet["btagCvL"]
-            self.events["b_CvsB"] = self.events.b_jet["btagCvB"]
-            self.events["b_Btag"] = self.events.b_jet["btagB"]
-            
-            self.events["neutrino_from_W"] = get_nu_4momentum(self.events.lead_lep, self.events.MET_used)
-            self.events["top_candidate"] = self.events.lead_lep + self.events.b_jet + self.events.neutrino_from_W
-            #print("top_candidate", self.events.top_candidate, self.events.top_candidate.mass, self.events.top_candidate.pt)
-
-            self.events["top_mass"] = (self.events.lead_lep + self.events.b_jet + self.events.neutrino_from_W).mass
-            #events = self.events[event_mask & bjet_mask]
-            #self.events = self.events[bjet_mask]
-
-            variables_for_MVA_eval_list = ["dijet_m","dijet_pt","dijet_dr","dijet_deltaPhi","dijet_deltaEta",
-                                    "dijet_CvsL_max","dijet_CvsL_min","dijet_CvsB_max","dijet_CvsB_min",
-                                    "dijet_pt_max","dijet_pt_min",
-                                    "W_mt","W_pt","pt_miss","WH_deltaPhi",
-                                    "deltaPhi_l1_j1","deltaPhi_l1_MET","deltaPhi_l1_b","deltaEta_l1_b","deltaR_l1_b",
-                                    "b_CvsL","b_CvsB","b_Btag","top_mass"]
-
-            variables_for_MVA_eval = ak.zip({v:self.events[v] for v in variables_for_MVA_eval_list})
-
-            gnn_vars = ["JetGood_btagCvL","JetGood_btagCvB",
-                        "JetGood_pt","JetGood_eta","JetGood_phi","JetGood_mass",
-                        "LeptonGood_miniPFRelIso_all","LeptonGood_pfRelIso03_all",
-                        "LeptonGood_pt","LeptonGood_eta","LeptonGood_phi","LeptonGood_mass",
-                        "W_pt","W_eta","W_phi","W_mt",
-                        "PuppiMET_pt","PuppiMET_phi","nPV","W_m","LeptonCategory"]
-
-            ak_gnn = self.events[gnn_vars]
-
-            df = ak.to_pandas(variables_for_MVA_eval)
-
-            # Remove the 'subentry' column
-            df = df.reset_index(level='subentry', drop=True)
-            
-            # Ensure the DataFrame has a simple index
-            if isinstance(df.index, pd.MultiIndex):
-                df = df.reset_index(drop=True)
-            #columns_to_exclude = []
-            #df = df.drop(columns=columns_to_exclude, errors='ignore')
-            self.channel = "1L"
-            df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-
-            bdt_predictions = self.evaluateBDT(df_final)
-            bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-            # Convert NaN to None
-            bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-            self.events["BDT"] = bdt_predictions
-            
-            if self.run_dnn:
-                self.events["DNN"] = self.evaluateDNN(df_final)
-            else:
-                self.events["DNN"] = np.zeros_like(self.events["BDT"])
-
-            if self.run_gnn:
-                self.events["GNN"] = self.evaluateGNN(ak_gnn)
-                self.events["GNN_transformed"] = np.power(self.events["GNN"],9)
-            else:
-                self.events["GNN"] = np.zeros_like(self.events["BDT"])
-                self.events["GNN_transformed"] = np.zeros_like(self.events["BDT"])
-
-
-        if self.proc_type=="ZNuNu":
-            ### General
-            self.events["MET_used"] = ak.zip({
-                                        "pt": self.events.PuppiMET.pt,
-                                        "eta": ak.zeros_like(self.events.PuppiMET.pt),
-                                        "phi": self.events.PuppiMET.phi,
-                                        "mass": ak.zeros_like(self.events.PuppiMET.pt),
-                                        "charge": ak.zeros_like(self.events.PuppiMET.pt),
-                                        },with_name="PtEtaPhiMCandidate")
-            self.events["Z_candidate"] = self.events.MET_used
-            self.events["Z_pt"] = self.events.Z_candidate.pt
-            self.events["Z_eta"] = ak.zeros_like(self.events.Z_candidate.pt)
-            self.events["Z_phi"] = self.events.Z_candidate.phi
-            self.events["Z_m"] = ak.ones_like(self.events.Z_candidate.pt)*91.1876
-            
-            self.events["dijet_m"] = self.events.dijet_csort.mass
-            self.events["dijet_pt"] = self.events.dijet_csort.pt
-            self.events["dijet_dr"] = self.events.dijet_csort.deltaR
-            self.events["dijet_deltaPhi"] = self.events.dijet_csort.deltaPhi
-            self.events["dijet_deltaEta"] = self.events.dijet_csort.deltaEta
-            self.events["dijet_CvsL_max"] = self.events.dijet_csort.j1CvsL
-            self.events["dijet_CvsL_min"] = self.events.dijet_csort.j2CvsL
-            self.events["dijet_CvsB_max"] = self.events.dijet_csort.j1CvsB
-            self.events["dijet_CvsB_min"] = self.events.dijet_csort.j2CvsB
-            self.events["dijet_pt_max"] = self.events.dijet_csort.j1pt
-            self.events["dijet_pt_min"] = self.events.dijet_csort.j2pt
-            
-            self.events["ZH_pt_ratio"] = self.events.dijet_csort.pt/self.events.Z_candidate.pt
-            self.events["ZH_deltaPhi"] = np.abs(self.events.Z_candidate.delta_phi(self.events.dijet_csort))
-            self.events["deltaPhi_jet1_MET"] = np.abs(self.events.PuppiMET.delta_phi(self.events.JetGood[:,0]))
-            self.events["deltaPhi_jet2_MET"] = np.abs(self.events.PuppiMET.delta_phi(self.events.JetGood[:,1]))
+            tags = {tag: kinematics.TAGGER_FIELDS[self.myJetTagger][tag] for tag in ("CvsL", "CvsB")}
+        self.events["dijet"] = kinematics.build_dijet(self.events.JetGood, tags, backend=self.kinematics_backend,
+                                                      dtype=self.feature_dtype)
 
-            # odd_events = self.events[odd_event_mask]
+        self.events["JetsCvsL"] = kinematics.top_k(self.events.JetGood, self.events.JetGood[tags["CvsL"]],
+                                                   self.tagger_top_k, backend=self.kinematics_backend)
+        self.events["dijet_csort"] = kinematics.build_dijet(self.events.JetsCvsL, tags, backend=self.kinematics_backend,
+                                                            dtype=self.feature_dtype)
 
-            variables_for_MVA_eval_list = ["dijet_m","dijet_pt","dijet_dr","dijet_deltaPhi","dijet_deltaEta",
-                                    "dijet_CvsL_max","dijet_CvsL_min","dijet_CvsB_max","dijet_CvsB_min",
-                                    "dijet_pt_max","dijet_pt_min",
-                                    "ZH_pt_ratio","ZH_deltaPhi","Z_pt"]
-
-            variables_for_MVA_eval = ak.zip({v:self.events[v] for v in variables_for_MVA_eval_list})
-
-            gnn_vars = ["JetGood_btagCvL","JetGood_btagCvB",
-                        "JetGood_pt","JetGood_eta","JetGood_phi","JetGood_mass",
-                        "Z_pt","Z_eta","Z_phi","Z_m",
-                        "PuppiMET_pt","PuppiMET_phi","nPV"]
+        #self.events["dijet_pt"] = self.events.dijet.pt
 
-            ak_gnn = self.events[gnn_vars]
-            
-            df = ak.to_pandas(variables_for_MVA_eval)
-            #columns_to_exclude = []
-            #df = df.drop(columns=columns_to_exclude, errors='ignore')
-            self.channel = "0L"
-            df_final = df.reindex(range(len(self.events)), fill_value=np.nan)
-
-            bdt_predictions = self.evaluateBDT(df_final)
-            bdt_predictions = np.where(df_final.isnull().any(axis=1), np.nan, bdt_predictions)
-            # Convert NaN to None
-            bdt_predictions = [None if np.isnan(x) else x for x in bdt_predictions]
-            self.events["BDT"] = bdt_predictions
-            if self.run_dnn:
-                self.events["DNN"] = self.evaluateDNN(df_final)
-            else:
-                self.events["DNN"] = np.zeros_like(self.events["BDT"])
-            if self.run_gnn:
-                self.events["GNN"] = self.evaluateGNN(ak_gnn)
-                self.events["GNN_transformed"] = np.power(self.events["GNN"],9)
-            else:
-                self.events["GNN"] = np.zeros_like(self.events["BDT"])
-                self.events["GNN_transformed"] = np.zeros_like(self.events["BDT"])
+        self.channel = CHANNELS[self.proc_type]
+        nbytes = FEATURES.compute(self, self.requested_features, self.channel,
+                                  float32=self.params.Features.float32, float64=self.params.Features.float64)
+        self.feature_memory(nbytes, variation)
+        self.run_mva_stage(variation)
             
         